@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Measure the cost of the authorization decorators end to end through the Flask test client.
+MongoDB is replaced by benchmarks.fake_mongo (with a configurable latency per query) and LDAP by the fake_ldapsearch script.
+Each scenario reports the throughput and the mean/p50/p99 latency per request; the results are printed as JSON.
+Save the results with --output and compare two runs using python -m benchmarks.compare.
+Run this from the root folder, for example, python -m benchmarks.authz -n 200 --mongo-latency 0.001 --output before.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+
+from flask_authnz.flask_authnz import FlaskAuthnz
+from flask_authnz.mongodb_dal import MongoDBRoles
+from flask_authnz.usergroups import UserGroups
+from flask_authnz.ldap_backends import SubprocessLDAPBackend
+from flask_authnz.cache_backends import InProcessCache
+from benchmarks.fake_mongo import FakeMongoClient, make_roles_databases, experiment_name
+from benchmarks.results import summarize, environment
+
+# user0000 has the Reader role in every experiment through one of its groups.
+BENCHMARK_USER = "user0000"
+
+
+class AuthzBenchmark(object):
+    """
+    A Flask app with one endpoint protected by authorization_required and one that calls filter_experiments.
+    """
+
+    def __init__(self, args, extra_roles=0):
+        self.mongoclient = FakeMongoClient(make_roles_databases(experiments=args.experiments, extra_roles=extra_roles, groups=args.groups), args.mongo_latency, args.mongo_jitter)
+        fake_ldapsearch = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ldapsearch.py")
+        self.groups_cache = InProcessCache(args.users, 3600)
+        self.usergroups = UserGroups(backend=SubprocessLDAPBackend([sys.executable, fake_ldapsearch]), group_index_refresh_interval=0, cache=self.groups_cache)
+        self.security = FlaskAuthnz(MongoDBRoles(self.mongoclient, self.usergroups), "LogBook")
+        self.experiment_names = [experiment_name(x) for x in range(args.experiments)]
+        self.app = flask.Flask(__name__)
+        self.app.secret_key = "A secret key for the benchmarks."
+        security = self.security
+
+        @self.app.route("/read/<experiment_name>")
+        @security.authentication_required
+        @security.authorization_required("read")
+        def read(experiment_name):
+            return "OK"
+
+        @self.app.route("/experiments")
+        @security.authentication_required
+        def experiments():
+            return flask.jsonify(security.filter_experiments("read", self.experiment_names))
+
+    def request(self, client, url):
+        """
+        :return: The time taken for the request in seconds.
+        """
+        start = time.perf_counter()
+        response = client.get(url, headers={"REMOTE_USER": BENCHMARK_USER})
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise Exception("Request for %s failed with status %s" % (url, response.status_code))
+        return elapsed
+
+    def run(self, iterations, url_fn, new_session=False, clear_groups=False):
+        """
+        Make iterations requests one after the other.
+        :param url_fn: Called with the iteration number to get the URL.
+        :param new_session: Use a new client (and so a new session) for each request.
+        :param clear_groups: Clear the group membership cache before each request.
+        """
+        client = self.app.test_client()
+        # The first request loads the privileges/scope caches; we do not time it.
+        self.request(client, url_fn(0))
+        queries, latencies = self.mongoclient.queries, []
+        for i in range(iterations):
+            if clear_groups:
+                self.groups_cache.clear()
+            latencies.append(self.request(self.app.test_client() if new_session else client, url_fn(i)))
+        return self.summary(latencies, queries)
+
+    def run_concurrently(self, iterations, threads, url_fn):
+        """
+        Make iterations requests from these many threads; each request has a new session.
+        """
+        self.request(self.app.test_client(), url_fn(0))
+        queries = self.mongoclient.queries
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = list(executor.map(lambda i: self.request(self.app.test_client(), url_fn(i)), range(iterations)))
+        return self.summary(latencies, queries, time.perf_counter() - start)
+
+    def summary(self, latencies, queries_before, elapsed=None):
+        result = summarize(latencies, elapsed)
+        result["mongo_queries_per_request"] = (self.mongoclient.queries - queries_before) / float(len(latencies))
+        return result
+
+
+def run_scenarios(args):
+    benchmark = AuthzBenchmark(args)
+    same_experiment = lambda i: "/read/" + benchmark.experiment_names[0]
+    results = {}
+    results["warm_session"] = benchmark.run(args.iterations, same_experiment)
+    results["cold_session_warm_groups"] = benchmark.run(args.iterations, same_experiment, new_session=True)
+    # Each request forks ldapsearch; so we make fewer requests.
+    results["cold_session_cold_groups"] = benchmark.run(max(1, args.iterations // 10), same_experiment, new_session=True, clear_groups=True)
+    results["many_experiments"] = benchmark.run(args.iterations, lambda i: "/read/" + benchmark.experiment_names[i % len(benchmark.experiment_names)])
+    results["filter_experiments"] = benchmark.run(max(1, args.iterations // 10), lambda i: "/experiments")
+    results["concurrent_threads"] = benchmark.run_concurrently(args.iterations, args.threads, same_experiment)
+    many_roles = AuthzBenchmark(args, extra_roles=args.roles_per_privilege)
+    results["many_roles_per_privilege"] = many_roles.run(args.iterations, lambda i: "/read/" + many_roles.experiment_names[0], new_session=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Number of requests per scenario; the scenarios that fork ldapsearch use a tenth of these')
+    parser.add_argument('--threads', type=int, default=8, help='Number of threads for the concurrent scenario')
+    parser.add_argument('--experiments', type=int, default=1000, help='Number of experiment databases')
+    parser.add_argument('--roles-per-privilege', type=int, default=50, help='Number of roles with the read privilege in the many roles scenario')
+    parser.add_argument('--mongo-latency', type=float, default=0.0005, help='Seconds added to each MongoDB query')
+    parser.add_argument('--mongo-jitter', type=float, default=0.0, help='Up to these many seconds are added at random to each MongoDB query')
+    parser.add_argument('--ldap-delay', type=float, default=0.0, help='Seconds added to each ldapsearch')
+    parser.add_argument('--users', type=int, default=1000, help='Number of users in the fake directory')
+    parser.add_argument('--groups', type=int, default=200, help='Number of groups in the fake directory')
+    parser.add_argument('-o', '--output', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    # The decorators log each decision at INFO; we are measuring the authorization, not the log handlers.
+    logging.basicConfig(level=logging.WARNING)
+    os.environ["FAKE_LDAP_USERS"] = str(args.users)
+    os.environ["FAKE_LDAP_GROUPS"] = str(args.groups)
+    os.environ["FAKE_LDAP_GROUPS_PER_USER"] = "10"
+    os.environ["FAKE_LDAP_DELAY"] = str(args.ldap_delay)
+
+    results = {"environment": environment(), "parameters": vars(args), "scenarios": run_scenarios(args)}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Compare two result files from python -m benchmarks.authz, for example, from two commits.
+The exit status is 1 if any scenario's p50/p99 latency is higher (or its throughput lower) by more than the threshold.
+Run this from the root folder, for example, python -m benchmarks.compare before.json after.json --threshold 10
+"""
+import sys
+import json
+import argparse
+
+# Metric -> True if higher is better.
+COMPARED_METRICS = {"throughput": True, "p50_ms": False, "p99_ms": False}
+
+
+def compare(baseline, current, threshold):
+    """
+    :param threshold: A change worse than these many percent is a regression.
+    :return: A list of rows (scenario, metric, baseline, current, change in percent, is_regression).
+    """
+    rows = []
+    for scenario in sorted(set(baseline["scenarios"].keys()) & set(current["scenarios"].keys())):
+        for metric, higher_is_better in sorted(COMPARED_METRICS.items()):
+            before, after = baseline["scenarios"][scenario][metric], current["scenarios"][scenario][metric]
+            change = 100.0 * (after - before) / before if before else 0.0
+            regression = (change < -threshold) if higher_is_better else (change > threshold)
+            rows.append((scenario, metric, before, after, change, regression))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline', help='Results file to compare against')
+    parser.add_argument('current', help='Results file to compare')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Flag changes worse than these many percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    print("Comparing %s (%s) against %s (%s)" % (args.current, current["environment"]["commit"], args.baseline, baseline["environment"]["commit"]))
+    rows = compare(baseline, current, args.threshold)
+    print("%-28s %-12s %12s %12s %9s" % ("scenario", "metric", "baseline", "current", "change"))
+    for scenario, metric, before, after, change, regression in rows:
+        print("%-28s %-12s %12.3f %12.3f %+8.1f%%%s" % (scenario, metric, before, after, change, "  REGRESSION" if regression else ""))
+    sys.exit(1 if any([x[5] for x in rows]) else 0)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+A stand-in for ldapsearch that answers the queries made by UserGroups from a synthetic directory.
+Use this as FLASK_AUTHNZ_LDAPSEARCH_COMMAND="python benchmarks/fake_ldapsearch.py".
+The directory has FAKE_LDAP_USERS users (user0000...) and FAKE_LDAP_GROUPS groups (group0000...);
+user N is a member of FAKE_LDAP_GROUPS_PER_USER groups starting at group N.
+To simulate a slow or distant server, set FAKE_LDAP_DELAY to the number of seconds to wait before answering.
+To simulate a server size limit, set FAKE_LDAP_SIZE_LIMIT; searches without the paged results control (-E pr=...) are then cut off at this limit.
+"""
+import os
+import re
+import sys
+import time
+import fnmatch
+import argparse
+
+fake_ldap_users = int(os.environ.get("FAKE_LDAP_USERS", "1000"))
+fake_ldap_groups = int(os.environ.get("FAKE_LDAP_GROUPS", "200"))
+fake_ldap_groups_per_user = int(os.environ.get("FAKE_LDAP_GROUPS_PER_USER", "10"))
+fake_ldap_delay = float(os.environ.get("FAKE_LDAP_DELAY", "0"))
+fake_ldap_size_limit = int(os.environ.get("FAKE_LDAP_SIZE_LIMIT", "0"))
+base_dn = "dc=example,dc=com"
+
+
+def make_directory(users=None, groups=None, groups_per_user=None):
+    """
+    Make the synthetic directory.
+    :return: A dict of DN -> attributes.
+    """
+    users = users if users is not None else fake_ldap_users
+    groups = groups if groups is not None else fake_ldap_groups
+    groups_per_user = groups_per_user if groups_per_user is not None else fake_ldap_groups_per_user
+    directory = {}
+    members = [[] for _ in range(groups)]
+    for u in range(users):
+        uid = "user%04d" % u
+        directory["uid=%s,ou=People,%s" % (uid, base_dn)] = {"objectClass": ["top", "posixAccount"], "uid": uid, "cn": "User %04d" % u, "gecos": "User %04d" % u, "uidNumber": str(10000 + u)}
+        if groups:
+            for g in range(u, u + min(groups_per_user, groups)):
+                members[g % groups].append(uid)
+    for g in range(groups):
+        cn = "group%04d" % g
+        directory["cn=%s,ou=Group,%s" % (cn, base_dn)] = {"objectClass": ["top", "posixGroup"], "cn": cn, "gidNumber": str(20000 + g), "memberUid": members[g]}
+    return directory
+
+
+def matches(attrs, filterstr):
+    """
+    Just enough of a LDAP filter matcher for the queries made by UserGroups; all (name=value) terms are AND'ed, except for |(...) groups.
+    """
+    lower_attrs = {k.lower(): v for k, v in attrs.items()}
+    def term_matches(name, value):
+        vals = lower_attrs.get(name.lower(), [])
+        vals = vals if isinstance(vals, list) else [vals]
+        return any(fnmatch.fnmatchcase(v.lower(), value.lower()) for v in vals)
+    for orterms in re.findall(r"\(\|((?:\([^()]*\))+)\)", filterstr):
+        if not any(term_matches(n, v) for n, v in re.findall(r"\((\w+)=([^()]*)\)", orterms)):
+            return False
+    anded = re.sub(r"\(\|((?:\([^()]*\))+)\)", "", filterstr)
+    return all(term_matches(n, v) for n, v in re.findall(r"\((\w+)=([^()]*)\)", anded))
+
+
+def write_ldif(directory, filterstr, attributes, out, limit=None):
+    """
+    :return: True if there were more than limit matching entries; like ldapsearch, the caller then exits with 4 (size limit exceeded).
+    """
+    out.write("# extended LDIF\n#\n# filter: %s\n# requesting: %s\n#\n\n" % (filterstr, " ".join(attributes)))
+    count = 0
+    truncated = False
+    for dn, attrs in directory.items():
+        if not matches(attrs, filterstr):
+            continue
+        if limit and count >= limit:
+            truncated = True
+            break
+        count += 1
+        out.write("dn: %s\n" % dn)
+        for name in attributes:
+            vals = attrs.get(name, [])
+            for v in (vals if isinstance(vals, list) else [vals]):
+                out.write("%s: %s\n" % (name, v))
+        out.write("\n")
+    out.write("# search result\nsearch: 2\nresult: %s\n\n# numEntries: %d\n" % ("4 Size limit exceeded" if truncated else "0 Success", count))
+    return truncated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-x', action='store_true', help='Simple authentication; ignored')
+    parser.add_argument('-z', type=int, help='Size limit')
+    parser.add_argument('-E', action='append', default=[], help='Search extensions; only pr=<size>/noprompt is understood')
+    parser.add_argument('filter')
+    parser.add_argument('attributes', nargs='*')
+    args = parser.parse_args()
+    if fake_ldap_delay:
+        time.sleep(fake_ldap_delay)
+    paged = any([x.startswith("pr=") for x in args.E])
+    limits = [x for x in [args.z, None if paged else fake_ldap_size_limit] if x]
+    sys.exit(4 if write_ldif(make_directory(), args.filter, args.attributes, sys.stdout, min(limits) if limits else None) else 0)
@@ -0,0 +1,123 @@
+"""
+An in-memory stand-in for a MongoClient that adds a configurable latency to each query.
+It answers the queries made by MongoDBRoles and AuthorizationIndex; equality, $in and dotted field names.
+make_roles_databases lays out synthetic roles that match the synthetic directory in fake_ldapsearch.
+"""
+import time
+import random
+import threading
+
+
+def _get_field(doc, name):
+    for part in name.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part, None)
+    return doc
+
+
+def _matches(doc, query):
+    for name, criterion in (query or {}).items():
+        value = _get_field(doc, name)
+        if isinstance(criterion, dict) and "$in" in criterion:
+            if value not in criterion["$in"]:
+                return False
+        elif value != criterion:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    fields = set([k.split(".")[0] for k, v in projection.items() if v])
+    if projection.get("_id", 1):
+        fields.add("_id")
+    return {k: v for k, v in doc.items() if k in fields}
+
+
+class FakeCollection(object):
+    def __init__(self, client, docs):
+        self.client = client
+        self.docs = docs
+
+    def find(self, query=None, projection=None):
+        self.client.wait()
+        return [_project(x, projection) for x in self.docs if _matches(x, query)]
+
+    def find_one(self, query=None, projection=None):
+        self.client.wait()
+        for doc in self.docs:
+            if _matches(doc, query):
+                return _project(doc, projection)
+        return None
+
+
+class FakeDatabase(dict):
+    def list_collection_names(self):
+        return list(self.keys())
+
+
+class FakeMongoClient(dict):
+    """
+    A dict of database name -> FakeDatabase; each query sleeps for latency seconds plus up to jitter seconds.
+    """
+
+    def __init__(self, databases, latency=0.0, jitter=0.0):
+        """
+        :param databases: A dict of database name -> collection name -> list of documents.
+        :param latency: Seconds to sleep for each query.
+        :param jitter: Sleep for up to these many more seconds, chosen at random.
+        """
+        super(FakeMongoClient, self).__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.queries = 0
+        self.lock = threading.Lock()
+        for dbname, collections in databases.items():
+            self[dbname] = FakeDatabase({collname: FakeCollection(self, docs) for collname, docs in collections.items()})
+
+    def list_database_names(self):
+        return list(self.keys())
+
+    def wait(self):
+        with self.lock:
+            self.queries += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+
+def experiment_name(e):
+    return "exp%05d" % e
+
+
+def make_roles_databases(application_name="LogBook", experiments=100, extra_roles=0, groups=200, groups_per_user=10):
+    """
+    Make the roles for a synthetic facility.
+    The site has the Editor and Reader roles; Reader has the read privilege, Editor has read and edit.
+    extra_roles more roles (Role000...) also have the read privilege; these are granted to groups nobody is a member of.
+    In each experiment, Reader is granted to one of the groups of user0000 (in the fake_ldapsearch directory) and Editor to the uid of user0001.
+    The XPP instrument grants Editor to the last group.
+    :return: A dict of database name -> collection name -> list of documents; pass this to FakeMongoClient.
+    """
+    site_roles = [
+        {"app": application_name, "name": "Editor", "privileges": ["read", "edit"], "players": ["uid:admin"]},
+        {"app": application_name, "name": "Reader", "privileges": ["read"], "players": []}
+    ]
+    for r in range(extra_roles):
+        site_roles.append({"app": application_name, "name": "Role%03d" % r, "privileges": ["read"], "players": ["nobody%03d" % r]})
+    databases = {
+        "site": {
+            "roles": site_roles,
+            "instruments": [{"_id": "XPP", "name": "XPP", "roles": [{"app": application_name, "name": "Editor", "players": ["group%04d" % (groups - 1)]}]}]
+        }
+    }
+    for e in range(experiments):
+        databases[experiment_name(e)] = {
+            "info": [{"_id": experiment_name(e), "params": {"is_restricted": "false"}}],
+            "roles": [
+                {"app": application_name, "name": "Reader", "players": ["group%04d" % (e % groups_per_user)]},
+                {"app": application_name, "name": "Editor", "players": ["uid:user0001"]}
+            ]
+        }
+    return databases
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Compare the cost of a LDAP query using ldapsearch subprocesses and using pooled ldap3 connections.
+By default, this runs against local stand-ins; the fake_ldapsearch script and an in-process ldap3 mock server.
+The ldap3 mock server evaluates filters slowly, so the local comparison uses a small directory; this measures the per query overhead.
+To compare against a real directory, pass in --uri and --base; this uses ldapsearch -x against the same server.
+Run this from the root folder, for example, python -m benchmarks.ldap_backends -n 200
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+import ldap3
+
+from flask_authnz.ldap_backends import SubprocessLDAPBackend, PooledLDAPBackend
+from benchmarks.fake_ldapsearch import make_directory
+from benchmarks.results import percentile
+
+
+def mock_connection_factory(directory):
+    def factory():
+        conn = ldap3.Connection(ldap3.Server("mock_ldap"), client_strategy=ldap3.MOCK_SYNC)
+        for dn, attrs in directory.items():
+            conn.strategy.add_entry(dn, attrs)
+        conn.bind()
+        return conn
+    return factory
+
+
+def time_backend(backend, queries, iterations):
+    latencies = []
+    for i in range(iterations):
+        filterstr, attributes = queries[i % len(queries)]
+        start = time.perf_counter()
+        backend.search(filterstr, attributes)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "iterations": iterations,
+        "mean_ms": 1000.0 * sum(latencies) / len(latencies),
+        "p50_ms": 1000.0 * percentile(latencies, 50),
+        "p99_ms": 1000.0 * percentile(latencies, 99),
+        "qps": len(latencies) / sum(latencies)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', type=int, default=100, help='Number of queries per backend')
+    parser.add_argument('--uri', help='LDAP server; if not specified, we use local stand-ins')
+    parser.add_argument('--base', help='Search base for the LDAP server')
+    parser.add_argument('--uid', action='append', help='User ids to look up the groups for; defaults to users in the synthetic directory')
+    parser.add_argument('--users', type=int, default=50, help='Number of users in the synthetic directory')
+    parser.add_argument('--groups', type=int, default=20, help='Number of groups in the synthetic directory')
+    args = parser.parse_args()
+
+    uids = args.uid or ["user%04d" % x for x in range(0, args.users, 7)]
+    queries = [("(&(objectclass=posixGroup)(memberUid={0}))".format(x), ["cn"]) for x in uids]
+    if args.uri:
+        subprocess_backend = SubprocessLDAPBackend(["ldapsearch", "-x", "-H", args.uri, "-b", args.base])
+        pooled_backend = PooledLDAPBackend(uri=args.uri, base=args.base)
+    else:
+        os.environ["FAKE_LDAP_USERS"] = str(args.users)
+        os.environ["FAKE_LDAP_GROUPS"] = str(args.groups)
+        fake_ldapsearch = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ldapsearch.py")
+        subprocess_backend = SubprocessLDAPBackend([sys.executable, fake_ldapsearch])
+        pooled_backend = PooledLDAPBackend(base="dc=example,dc=com", connection_factory=mock_connection_factory(make_directory(args.users, args.groups)))
+
+    # Make sure both backends give us the same answers before timing them.
+    for filterstr, attributes in queries[:3]:
+        assert sorted(x["cn"] for x in subprocess_backend.search(filterstr, attributes)) == sorted(x["cn"] for x in pooled_backend.search(filterstr, attributes))
+
+    print(json.dumps({
+        "subprocess": time_backend(subprocess_backend, queries, args.iterations),
+        "pooled": time_backend(pooled_backend, queries, args.iterations)
+        }, indent=2))
@@ -0,0 +1,45 @@
+"""
+Helpers to summarize benchmark latencies and to record the environment they were measured in.
+"""
+import sys
+import time
+import platform
+import subprocess
+
+
+def percentile(latencies, p):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def summarize(latencies, elapsed=None):
+    """
+    :param latencies: The latency of each operation in seconds.
+    :param elapsed: Optional; the wall clock time for all the operations; use this when the operations ran concurrently.
+    :return: A dict with the count, throughput and mean/p50/p99 latencies in milliseconds.
+    """
+    elapsed = elapsed if elapsed is not None else sum(latencies)
+    return {
+        "iterations": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": 1000.0 * sum(latencies) / len(latencies),
+        "p50_ms": 1000.0 * percentile(latencies, 50),
+        "p99_ms": 1000.0 * percentile(latencies, 99)
+    }
+
+
+def environment():
+    """
+    :return: A dict describing the commit and the machine; this is stored alongside the results so that they can be compared later.
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.node()
+    }
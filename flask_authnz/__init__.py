@@ -1,3 +1,4 @@
 from .flask_authnz import FlaskAuthnz
 from .mongodb_dal import MongoDBRoles
-from .usergroups import UserGroups
\ No newline at end of file
+from .usergroups import UserGroups
+from .decision_cache import DecisionCache
@@ -0,0 +1,255 @@
+import os
+import time
+import asyncio
+import logging
+from functools import wraps
+
+from flask import request, url_for, abort, session, g
+from werkzeug.utils import redirect
+
+from .session_roles import SessionRoles, scope_for
+from .metrics import get_registry
+from .tracing import trace_event, trace_span
+from .audit import get_default_audit_log
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFlaskAuthnz(object):
+    """
+    The asyncio counterpart of FlaskAuthnz for async def views.
+    The decorators wrap coroutines and all the role lookups are awaited; so the event loop is not blocked.
+    Use this with an async roles DAL like AsyncMongoDBRoles.
+    As the privilege -> roles mapping cannot be loaded in the constructor, it is loaded on the first request;
+    call `await load_privileges()` at startup (or pass in priv2roles) to load it earlier.
+    As with FlaskAuthnz, every decision is counted in the decision metrics, added to the trace for the request and written to the audit log.
+    """
+
+    def __init__(self, roles_dal, application_name, redirect_url=None, decision_cache=None, priv2roles=None, audit_log=None):
+        """
+        :param roles_dal: An async data access object to get to the roles/privileges.
+        :param application_name: The name of this application.
+        :param redirect_url: Redirect to this URL if we fail authentication.
+        :param decision_cache: Optional; a DecisionCache used to remember grants and denials across requests.
+        :param priv2roles: Optional; the privilege -> roles mapping if this has already been loaded.
+        :param audit_log: Optional; an AuditLog to which every decision is written; defaults to a log written to FLASK_AUTHNZ_AUDIT_FILE, if set.
+        """
+        self.roles_dal = roles_dal
+        self.application_name = application_name
+        self.redirect_url = redirect_url
+        self.decision_cache = decision_cache
+        self.priv2roles = priv2roles
+        self.session_roles_name = "APPLICATION_ROLES_" + self.application_name
+        self.decisions_counter = get_registry().counter("flask_authnz_decisions_total", "Authorization decisions by the layer that answered them and the result", ["layer", "result"])
+        self.decision_latency = get_registry().histogram("flask_authnz_decision_seconds", "Time taken for authorization decisions by the layer that answered them", ["layer"])
+        self.audit_log = audit_log if audit_log is not None else get_default_audit_log()
+
+    async def load_privileges(self):
+        """
+        Load (or reload) the privilege -> roles mapping from the database.
+        :return: True if the mapping changed.
+        """
+        priv2roles = await self.roles_dal.getPrivilegesForApplicationRoles(self.application_name)
+        if priv2roles == self.priv2roles:
+            return False
+        logger.info("Loaded privileges for application %s", self.application_name)
+        self.priv2roles = priv2roles
+        if self.decision_cache is not None:
+            self.decision_cache.invalidate_application(self.application_name)
+        return True
+
+    async def _get_priv2roles(self):
+        if self.priv2roles is None:
+            await self.load_privileges()
+        return self.priv2roles
+
+    def authentication_required(self, wrapped_function):
+        """
+        Decorator to mandate that an authentication is required for this coroutine.
+        """
+        @wraps(wrapped_function)
+        async def function_interceptor(*args, **kwargs):
+            if self.is_user_authenticated():
+                return await wrapped_function(*args, **kwargs)
+            if self.redirect_url:
+                return redirect(url_for(self.redirect_url, next=request.url))
+            logger.info("User is not logged in; sending a 403 response")
+            abort(403)
+
+        return function_interceptor
+
+    def authorization_required(self, *params):
+        '''
+        Decorator for experiment specific authorization of a coroutine; use this after authentication_required.
+        As with FlaskAuthnz, pass in the privilege; the experiment_name comes from the flask variables and the instrument from flask.g.instrument.
+        '''
+        if len(params) < 1:
+            raise Exception("Application privilege not specified when specifying the authorization")
+        priv_name = params[0]
+        if self.priv2roles is not None and priv_name not in self.priv2roles:
+            raise Exception("Please specify an appropriate application privilege for the authorization_required decorator " + ",".join(self.priv2roles.keys()))
+        def wrapper(f):
+            @wraps(f)
+            async def wrapped(*args, **kwargs):
+                experiment_name = kwargs.get('experiment_name', None)
+                instrument = g.get("instrument", None)
+                logger.info("Looking to authorize %s for app %s for privilege %s for experiment %s instrument %s", self.get_current_user_id(), self.application_name, priv_name, experiment_name, instrument)
+                if not await self.check_privilege_for_experiment(priv_name, experiment_name, instrument):
+                    abort(403)
+                return await f(*args, **kwargs)
+            return wrapped
+        return wrapper
+
+    def effective_privileges_required(self, f):
+        """
+        Decorator that computes all of the current user's privileges for this experiment/instrument and makes these available as flask.g.effective_privileges.
+        """
+        @wraps(f)
+        async def wrapped(*args, **kwargs):
+            g.effective_privileges = await self.get_effective_privileges(kwargs.get('experiment_name', None), g.get("instrument", None))
+            return await f(*args, **kwargs)
+        return wrapped
+
+    def get_current_user_id(self):
+        """
+        Get the user id from the proxy; see FlaskAuthnz.get_current_user_id.
+        """
+        remote_user = request.headers.get(os.environ.get("FLASK_AUTHNZ_USER_HEADER", "REMOTE_USER"), None)
+        if remote_user and '@' in remote_user:
+            remote_user = remote_user.split("@")[0]
+        return remote_user
+
+    def is_user_authenticated(self):
+        return bool(self.get_current_user_id())
+
+    async def check_privilege_for_experiment(self, priv_name, experiment_name, instrument=None):
+        """
+        Check to see if this user has the necessary privilege for this experiment.
+        If we have a decision cache, both grants and denials are remembered for a while.
+        """
+        start = time.perf_counter()
+        user_id = self.get_current_user_id()
+        if self.decision_cache is not None:
+            decision = self.decision_cache.get(user_id, priv_name, experiment_name, instrument, application_name=self.application_name)
+            if decision is not None:
+                logger.debug("Found cached decision %s for privilege %s for user %s for experiment %s instrument %s", decision, priv_name, user_id, experiment_name, instrument)
+                self.__record_decision(user_id, priv_name, experiment_name, instrument, "decision_cache", decision, start)
+                return decision
+        decision, layer = await self.__check_privilege_for_experiment(user_id, priv_name, experiment_name, instrument)
+        if self.decision_cache is not None:
+            self.decision_cache.put(user_id, priv_name, experiment_name, instrument, decision, application_name=self.application_name)
+        self.__record_decision(user_id, priv_name, experiment_name, instrument, layer, decision, start)
+        return decision
+
+    def __record_decision(self, user_id, priv_name, experiment_name, instrument, layer, decision, start):
+        elapsed = time.perf_counter() - start
+        self.decisions_counter.inc(layer=layer, result="grant" if decision else "deny")
+        self.decision_latency.observe(elapsed, layer=layer)
+        trace_event("decision", priv_name, elapsed, experiment=experiment_name, instrument=instrument, layer=layer, result="grant" if decision else "deny")
+        if self.audit_log is not None:
+            self.audit_log.record(self.application_name, user_id, priv_name, experiment_name, instrument, decision, layer, elapsed)
+
+    async def __check_privilege_for_experiment(self, user_id, priv_name, experiment_name, instrument=None):
+        """
+        :return: The decision and the layer that made it; session, dal or no_roles.
+        """
+        role_names = sorted((await self._get_priv2roles()).get(priv_name, []))
+        if not role_names:
+            logger.warning("Privilege %s is not granted by any role in application %s", priv_name, self.application_name)
+            return False, "no_roles"
+        session_roles = self.__load_session_roles()
+        scope = scope_for(experiment_name, instrument)
+        for role_name in role_names:
+            found = session_roles.has(role_name, scope)
+            trace_event("session", role_name, scope=scope, result="hit" if found else "miss")
+            if found:
+                logger.debug("Role %s grants privilege %s for user %s for experiment %s", role_name, priv_name, user_id, experiment_name)
+                return True, "session"
+        if hasattr(self.roles_dal, "has_any_slac_user_role"):
+            with trace_span("dal", "has_any_slac_user_role", roles="|".join(role_names)):
+                role_name = await self.roles_dal.has_any_slac_user_role(user_id, self.application_name, role_names, experiment_name, instrument)
+        else:
+            role_name = await self.__check_roles_concurrently(user_id, role_names, experiment_name, instrument)
+        if role_name:
+            logger.info("Found application role %s/%s for experiment %s in db for user %s", self.application_name, role_name, experiment_name, user_id)
+            self.__add_roles_to_session([role_name], scope)
+            return True, "dal"
+        logger.warning("Did not find any role with privilege %s for user %s for experiment %s", priv_name, user_id, experiment_name)
+        return False, "dal"
+
+    async def __check_roles_concurrently(self, user_id, role_names, experiment_name, instrument):
+        """
+        For DALs that check one role at a time, check all the roles at once and return the first role (in role order) that grants.
+        We return once a role grants and all the roles before it have not; the checks for the roles after it are cancelled.
+        """
+        tasks = [asyncio.ensure_future(self.roles_dal.has_slac_user_role(user_id, self.application_name, role_name, experiment_name, instrument)) for role_name in role_names]
+        try:
+            with trace_span("dal", "has_slac_user_role", roles="|".join(role_names)):
+                for role_name, task in zip(role_names, tasks):
+                    if await task:
+                        return role_name
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_effective_privileges(self, experiment_name=None, instrument=None):
+        """
+        Get all the privileges that the current user has for this experiment/instrument; see FlaskAuthnz.get_effective_privileges.
+        :return: The set of privilege names.
+        """
+        user_id = self.get_current_user_id()
+        priv2roles = await self._get_priv2roles()
+        role_names = sorted(set([role_name for role_names in priv2roles.values() for role_name in role_names]))
+        user_roles = await self.roles_dal.get_slac_user_roles(user_id, self.application_name, role_names, experiment_name, instrument)
+        self.__add_roles_to_session(sorted(user_roles), scope_for(experiment_name, instrument))
+        privileges = set([priv_name for priv_name, priv_roles in priv2roles.items() if priv_roles & user_roles])
+        if self.decision_cache is not None:
+            for priv_name in priv2roles.keys():
+                self.decision_cache.put(user_id, priv_name, experiment_name, instrument, priv_name in privileges, application_name=self.application_name)
+        logger.info("User %s has privileges %s for experiment %s instrument %s", user_id, sorted(privileges), experiment_name, instrument)
+        return privileges
+
+    async def filter_experiments(self, priv_name, experiment_names, instrument=None):
+        """
+        Filter a list of experiments down to those where the current user has this privilege; see FlaskAuthnz.filter_experiments.
+        :return: The list of experiments where the user has this privilege, in the same order as experiment_names.
+        """
+        user_id = self.get_current_user_id()
+        role_names = sorted((await self._get_priv2roles()).get(priv_name, []))
+        if not role_names:
+            logger.warning("Privilege %s is not granted by any role in application %s", priv_name, self.application_name)
+            return []
+        decisions = {}
+        if self.decision_cache is not None:
+            for experiment_name in experiment_names:
+                decision = self.decision_cache.get(user_id, priv_name, experiment_name, instrument, application_name=self.application_name)
+                if decision is not None:
+                    decisions[experiment_name] = decision
+        to_check = [x for x in experiment_names if x not in decisions]
+        if to_check:
+            permitted = set(await self.roles_dal.get_experiments_with_any_slac_user_role(user_id, self.application_name, role_names, to_check, instrument))
+            for experiment_name in to_check:
+                decisions[experiment_name] = experiment_name in permitted
+                if self.decision_cache is not None:
+                    self.decision_cache.put(user_id, priv_name, experiment_name, instrument, decisions[experiment_name], application_name=self.application_name)
+        logger.info("User %s has privilege %s for %s of %s experiments", user_id, priv_name, sum(decisions.values()), len(decisions))
+        return [x for x in experiment_names if decisions[x]]
+
+    def get_session_roles(self):
+        """
+        Get the roles stored in the flask session
+        :return: A dict of <app>/<role> -> list of experiments/instruments (or __ALL__) for which the role has been granted.
+        """
+        return self.__load_session_roles().as_dict()
+
+    def __load_session_roles(self):
+        return SessionRoles.load(session.get(self.session_roles_name, None), self.application_name)
+
+    def __add_roles_to_session(self, role_names, scope):
+        if not role_names:
+            return
+        session_roles = self.__load_session_roles()
+        for role_name in role_names:
+            session_roles.add(role_name, scope)
+        session[self.session_roles_name] = session_roles.dump()
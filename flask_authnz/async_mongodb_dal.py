@@ -0,0 +1,230 @@
+import json
+import asyncio
+import inspect
+import logging
+from threading import RLock
+from cachetools import TTLCache
+
+from .mongodb_dal import scope_cache_time_in_seconds, scope_cache_size, bulk_query_concurrency
+from .metrics import get_registry, cache_requests
+from .tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+
+async def _value(value):
+    return value
+
+
+class AsyncMongoDBRoles(object):
+    """
+    The asyncio counterpart of MongoDBRoles, using motor; all the lookups are coroutines.
+    The roles are laid out in the databases exactly as for MongoDBRoles.
+    The queries for the global, experiment and instrument roles and the experiment restricted flag are issued concurrently.
+    The user groups getter can be an AsyncUserGroups or a synchronous UserGroups; a synchronous getter is called in the default executor so that LDAP lookups do not block the event loop.
+    """
+
+    def __init__(self, motorclient, usergroupsgetter, rolesdbname="site", scope_cache_time=None):
+        """
+        :param motorclient: The motor AsyncIOMotorClient to use.
+        :param scope_cache_time: How long (in seconds) to cache the experiment restricted flags and instrument roles; defaults to FLASK_AUTHNZ_SCOPE_CACHE_TIME.
+        """
+        self.mongoclient = motorclient
+        self.usergroupsgetter = usergroupsgetter
+        self.rolesdbname = rolesdbname
+        scope_cache_time = scope_cache_time if scope_cache_time is not None else scope_cache_time_in_seconds
+        # Experiment name -> is_restricted
+        self.restricted_cache = TTLCache(scope_cache_size, scope_cache_time)
+        # Instrument name -> { application name -> { role name -> frozenset of players } }
+        self.instrument_roles_cache = TTLCache(scope_cache_size, scope_cache_time)
+        self.scope_cache_lock = RLock()
+        self.query_latency = get_registry().histogram("flask_authnz_mongo_query_seconds", "Time taken for MongoDB queries by query type", ["query"])
+        self.cache_requests = cache_requests()
+
+    async def getPrivilegesForApplicationRoles(self, application_name):
+        """
+        Get the privileges for all the application roles for this application.
+        :param application_name
+        :return a dict mapping privileges and the roles that contain that privilege.
+        """
+        priv2roles = {}
+        for role in await self._find("privileges", self.rolesdbname, "roles", {"app": application_name}, {"_id": 0, "name": 1, "privileges": 1}):
+            for privilege in role.get("privileges", []):
+                priv2roles.setdefault(privilege, set()).add(role["name"])
+        return priv2roles
+
+    async def has_slac_user_role(self, user_id, application_name, role_name, experiment_name=None, instrument=None):
+        """
+        Check if SLAC user has the appropriate role in the application.
+        """
+        return await self.has_any_slac_user_role(user_id, application_name, [role_name], experiment_name, instrument) is not None
+
+    async def has_any_slac_user_role(self, user_id, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Check if SLAC user has any of these roles in the application.
+        :param role_names: Role names to check; these are checked in this order.
+        :return: The name of the first role that the user has; None if the user has none of these roles.
+        """
+        role_names = list(role_names)
+        role_players = await self.get_role_players(application_name, role_names, experiment_name, instrument)
+        for role_name in role_names:
+            if "uid:"+user_id in role_players[role_name]:
+                logger.info("User_id='%s' directly has role '%s' in application '%s' for experiment '%s'.", user_id, role_name, application_name, experiment_name)
+                return role_name
+        if not any([not x.startswith("uid:") for players in role_players.values() for x in players]):
+            logger.debug("User_id='%s' is not authorized for roles '%s' on application '%s'. No authorized groups for these roles either.", user_id, role_names, application_name)
+            return None
+        user_groups = await self._get_user_groups(user_id)
+        for role_name in role_names:
+            if user_groups & role_players[role_name]:
+                return role_name
+        return None
+
+    async def get_slac_user_roles(self, user_id, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Get all the roles (out of these roles) that the SLAC user has in the application.
+        :return: The set of role names that the user has.
+        """
+        role_players = await self.get_role_players(application_name, role_names, experiment_name, instrument)
+        user_roles = set([role_name for role_name, players in role_players.items() if "uid:"+user_id in players])
+        if any([not x.startswith("uid:") for role_name, players in role_players.items() if role_name not in user_roles for x in players]):
+            user_groups = await self._get_user_groups(user_id)
+            user_roles.update([role_name for role_name, players in role_players.items() if user_groups & players])
+        logger.debug("User '%s' has roles '%s' in application '%s' for experiment '%s' instrument '%s'", user_id, user_roles, application_name, experiment_name, instrument)
+        return user_roles
+
+    async def _get_user_groups(self, user_id):
+        """
+        :return: The set of posix groups for the user; an empty set if we cannot determine these.
+        """
+        try:
+            if inspect.iscoroutinefunction(self.usergroupsgetter.get_user_posix_groups):
+                user_groups = await self.usergroupsgetter.get_user_posix_groups(user_id)
+            else:
+                user_groups = await asyncio.get_running_loop().run_in_executor(None, self.usergroupsgetter.get_user_posix_groups, user_id)
+        except ValueError:
+            logger.exception("Exception when trying to determine groups for user %s", user_id)
+            return set()
+        return set(user_groups)
+
+    async def get_experiments_with_any_slac_user_role(self, user_id, application_name, role_names, experiment_names, instrument=None):
+        """
+        Filter a list of experiments down to those where the SLAC user has any of these roles in the application.
+        As with MongoDBRoles, the global and instrument players and the user's groups are fetched once.
+        The experiment specific roles are checked concurrently; at most FLASK_AUTHNZ_BULK_QUERY_CONCURRENCY at a time.
+        :return: The list of experiments where the user has any of these roles, in the same order as experiment_names.
+        """
+        role_names = list(role_names)
+        role_query = {"app": application_name, "name": {"$in": role_names}}
+        role_projection = {"_id": 0, "name": 1, "players": 1}
+        global_roles, instrument_roles, user_groups = await asyncio.gather(
+            self._find("site_roles", self.rolesdbname, "roles", role_query, role_projection),
+            self.get_instrument_roles(instrument) if instrument else _value({}),
+            self._get_user_groups(user_id))
+        unrestricted_players = set([x for role in global_roles for x in role.get("players", [])])
+        instrument_role_players = instrument_roles.get(application_name, {})
+        for role_name in role_names:
+            unrestricted_players.update(instrument_role_players.get(role_name, frozenset()))
+        user_players = set(["uid:"+user_id]) | user_groups
+        has_unrestricted_role = bool(user_players & unrestricted_players)
+        semaphore = asyncio.Semaphore(bulk_query_concurrency)
+
+        async def check_experiment(experiment_name):
+            async with semaphore:
+                if has_unrestricted_role and not await self.is_experiment_restricted(experiment_name):
+                    return True
+                for role in await self._find("experiment_roles", experiment_name, "roles", role_query, role_projection):
+                    if user_players & set(role.get("players", [])):
+                        return True
+                return False
+
+        experiment_names = list(experiment_names)
+        permitted = await asyncio.gather(*[check_experiment(x) for x in experiment_names])
+        return [experiment_name for experiment_name, is_permitted in zip(experiment_names, permitted) if is_permitted]
+
+    async def get_role_players(self, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Get the players for these roles in the application.
+        All the queries are issued at once; the global and instrument players are dropped if the experiment turns out to be restricted.
+        :return: A dict mapping each role name to the set of players (uid:<user_id> or group names) that have the role.
+        """
+        role_players = {role_name: set() for role_name in role_names}
+        role_query = {"app": application_name, "name": {"$in": list(role_players.keys())}}
+        role_projection = {"_id": 0, "name": 1, "players": 1}
+        is_restricted, global_roles, experiment_roles, instrument_roles = await asyncio.gather(
+            self.is_experiment_restricted(experiment_name) if experiment_name else _value(False),
+            self._find("site_roles", self.rolesdbname, "roles", role_query, role_projection),
+            self._find("experiment_roles", experiment_name, "roles", role_query, role_projection) if experiment_name else _value([]),
+            self.get_instrument_roles(instrument) if instrument else _value({}))
+        if is_restricted:
+            logger.info("%s is restricted; skipping adding global and instrument roles", experiment_name)
+            global_roles, instrument_roles = [], {}
+        for role in global_roles + experiment_roles:
+            role_players[role["name"]].update(role.get("players", []))
+        instrument_role_players = instrument_roles.get(application_name, {})
+        for role_name in role_players.keys():
+            role_players[role_name].update(instrument_role_players.get(role_name, frozenset()))
+        return role_players
+
+    async def is_experiment_restricted(self, experiment_name):
+        """
+        Check if the experiment is restricted; this is cached for FLASK_AUTHNZ_SCOPE_CACHE_TIME.
+        """
+        with self.scope_cache_lock:
+            is_restricted = self.restricted_cache.get(experiment_name, None)
+        self.cache_requests.inc(cache="experiment_restricted", result="miss" if is_restricted is None else "hit")
+        if is_restricted is not None:
+            return is_restricted
+        is_restricted = False
+        exp_info = await self._find_one("experiment_restricted", experiment_name, "info", {}, {"params.is_restricted": 1})
+        if exp_info:
+            is_restricted = json.loads(exp_info.get("params", {}).get("is_restricted", "False").lower())
+        with self.scope_cache_lock:
+            self.restricted_cache[experiment_name] = is_restricted
+        return is_restricted
+
+    async def get_instrument_roles(self, instrument):
+        """
+        Get the instrument level roles for this instrument; this is cached for FLASK_AUTHNZ_SCOPE_CACHE_TIME.
+        :return: A dict mapping application name -> role name -> frozenset of players.
+        """
+        with self.scope_cache_lock:
+            instrument_roles = self.instrument_roles_cache.get(instrument, None)
+        self.cache_requests.inc(cache="instrument_roles", result="miss" if instrument_roles is None else "hit")
+        if instrument_roles is not None:
+            return instrument_roles
+        instrument_roles = {}
+        instr_obj = await self._find_one("instrument_roles", self.rolesdbname, "instruments", {"_id": instrument}, {"roles": 1})
+        if instr_obj:
+            for in_role in instr_obj.get("roles", []):
+                app_roles = instrument_roles.setdefault(in_role.get("app", None), {})
+                app_roles[in_role.get("name", None)] = app_roles.get(in_role.get("name", None), frozenset()) | frozenset(in_role.get("players", []))
+        with self.scope_cache_lock:
+            self.instrument_roles_cache[instrument] = instrument_roles
+        return instrument_roles
+
+    def refresh_scope_metadata(self, experiment_name=None, instrument=None):
+        """
+        Drop the cached experiment restricted flags and instrument roles; see MongoDBRoles.refresh_scope_metadata.
+        """
+        with self.scope_cache_lock:
+            if not experiment_name and not instrument:
+                self.restricted_cache.clear()
+                self.instrument_roles_cache.clear()
+                return
+            if experiment_name:
+                self.restricted_cache.pop(experiment_name, None)
+            if instrument:
+                self.instrument_roles_cache.pop(instrument, None)
+
+    async def _find(self, query_type, dbname, collname, query, projection=None):
+        """
+        Run a query and time it; see MongoDBRoles._find.
+        :return: A list of the matching documents.
+        """
+        with self.query_latency.time(query=query_type), trace_span("mongo", query_type, db=dbname):
+            return await self.mongoclient[dbname][collname].find(query, projection).to_list(None)
+
+    async def _find_one(self, query_type, dbname, collname, query, projection=None):
+        with self.query_latency.time(query=query_type), trace_span("mongo", query_type, db=dbname):
+            return await self.mongoclient[dbname][collname].find_one(query, projection)
@@ -0,0 +1,193 @@
+import time
+import asyncio
+import logging
+
+from .ldap_backends import ldapsearchCommand, ldap_timeout, ldap_page_size, parse_ldapsearch_response, LDAPSizeLimitError, LDAP_SIZELIMIT_EXCEEDED
+from .usergroups import user_groups_cache, user_groups_cache_time_in_seconds, user_groups_cache_refresh_ahead, user_groups_cache_max_staleness_in_seconds, _group_name
+from .metrics import get_registry, cache_requests
+from .tracing import trace_event, trace_span
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLDAPBackend(object):
+    """
+    Search LDAP by running ldapsearch using asyncio.create_subprocess_exec; the event loop is not blocked while the search runs.
+    The command defaults to FLASK_AUTHNZ_LDAPSEARCH_COMMAND (ldapsearch -x).
+    As with SubprocessLDAPBackend, searches without a limit use the simple paged results control (-E pr=...);
+    if these are still cut off at the size limit, we raise a LDAPSizeLimitError.
+    """
+
+    def __init__(self, command=None, timeout=None, page_size=None):
+        """
+        :param command: Optional; the ldapsearch command as a list.
+        :param timeout: Optional; kill ldapsearch if it takes longer than these many seconds; defaults to FLASK_AUTHNZ_LDAP_TIMEOUT.
+        :param page_size: Page size for searches without a limit; defaults to FLASK_AUTHNZ_LDAP_PAGE_SIZE; 0 turns off paging.
+        """
+        self.command = command or ldapsearchCommand
+        self.timeout = timeout or ldap_timeout
+        self.page_size = page_size if page_size is not None else ldap_page_size
+
+    async def search(self, filterstr, attributes, limit=None):
+        """
+        Search LDAP.
+        :param filterstr: LDAP filter, for example (&(objectclass=posixGroup)(cn=ps-data))
+        :param attributes: List of attributes to return.
+        :param limit: Optional; stop after these many entries.
+        :return: List of dicts, one per entry. Single valued attributes are strings; multi valued attributes are lists.
+        """
+        if limit:
+            options = ["-z", str(limit)]
+        else:
+            options = ["-E", "pr={0}/noprompt".format(self.page_size)] if self.page_size else []
+        query = self.command + options + [filterstr] + list(attributes)
+        logger.debug("Running LDAP query %s", query)
+        try:
+            proc = await asyncio.create_subprocess_exec(*query, stdout=asyncio.subprocess.PIPE)
+        except Exception as e:
+            raise ValueError("Error while trying to run LDAP query: '%s'\n%s" % (query, e))
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            raise ValueError("Timed out running LDAP query: '%s'" % (query))
+        finally:
+            # On a timeout or if the caller was cancelled, we do not leave ldapsearch running.
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        if not limit and proc.returncode == LDAP_SIZELIMIT_EXCEEDED:
+            raise LDAPSizeLimitError("LDAP query '%s' was cut off at the server's size limit" % (query,))
+        entries = parse_ldapsearch_response(stdout.decode("utf-8"))
+        return entries[:limit] if limit else entries
+
+
+class AsyncUserGroups(object):
+    """
+    The asyncio counterpart of UserGroups; all the lookups are coroutines.
+    Group memberships are held in the same cache as UserGroups; so the two share cached entries.
+    Concurrent identical LDAP queries on the same event loop are coalesced into one query.
+    As with UserGroups, cached group memberships that are close to or past FLASK_AUTHNZ_CACHE_TIME are served while they are refreshed in the background,
+    up to FLASK_AUTHNZ_CACHE_MAX_STALENESS.
+    """
+
+    def __init__(self, backend=None, cache=None):
+        """
+        :param backend: Optional; an LDAP backend whose search is a coroutine; defaults to AsyncLDAPBackend.
+        :param cache: Optional; the cache backend for the group memberships. See cache_backends.
+        """
+        self.backend = backend or AsyncLDAPBackend()
+        self.cache = cache or user_groups_cache
+        # (event loop, key) -> task; tasks cannot be awaited from another event loop.
+        self.inflight = {}
+        self.refresh_after = user_groups_cache_refresh_ahead*user_groups_cache_time_in_seconds
+        self.max_staleness = user_groups_cache_max_staleness_in_seconds
+        # The event loop only keeps weak references to tasks; we keep the background refreshes here until they are done.
+        self.background_refreshes = set()
+        self.ldap_latency = get_registry().histogram("flask_authnz_ldap_query_seconds", "Time taken for LDAP queries by query type", ["query"])
+        self.cache_requests = cache_requests()
+
+    async def _coalesce(self, key, coro_fn, *args):
+        """
+        Run coro_fn(*args) unless there is already a task in flight for this key on this event loop.
+        If one of the callers is cancelled, the shared task continues for the others.
+        """
+        loop = asyncio.get_running_loop()
+        inflight_key = (loop, key)
+        task = self.inflight.get(inflight_key, None)
+        if task is None:
+            task = loop.create_task(coro_fn(*args))
+            self.inflight[inflight_key] = task
+            task.add_done_callback(lambda t: self.inflight.pop(inflight_key, None))
+        else:
+            logger.debug("Waiting for call in flight for %s", key)
+        return await asyncio.shield(task)
+
+    async def get_user_posix_groups(self, user_id):
+        """
+        Get the complete list of posix groups for the user.
+        If the cached entry is getting old, we return it anyway and refresh it in the background.
+        Entries past the maximum staleness are not served; we wait for LDAP instead.
+        :param user_id: User id to get the posix groups for.
+        :return: List of posix groups.
+        """
+        cached_entry = self.cache.get((user_id,))
+        if cached_entry is not None and time.time() - cached_entry[1] >= self.max_staleness:
+            cached_entry = None
+        if cached_entry is not None:
+            user_groups, fetched_at = cached_entry
+            if time.time() - fetched_at > self.refresh_after:
+                self.cache_requests.inc(cache="user_groups", result="stale")
+                trace_event("ldap_cache", user_id, result="stale")
+                self.__refresh_in_background(user_id)
+            else:
+                self.cache_requests.inc(cache="user_groups", result="hit")
+                trace_event("ldap_cache", user_id, result="hit")
+            return user_groups
+        self.cache_requests.inc(cache="user_groups", result="miss")
+        trace_event("ldap_cache", user_id, result="miss")
+        return await self._coalesce(("user_posix_groups", user_id), self.__search_user_posix_groups, user_id)
+
+    def __refresh_in_background(self, user_id):
+        loop = asyncio.get_running_loop()
+        if (loop, ("user_posix_groups", user_id)) in self.inflight:
+            return
+        logger.debug("Refreshing the groups for user %s in the background", user_id)
+        task = loop.create_task(self.__background_refresh(user_id))
+        self.background_refreshes.add(task)
+        task.add_done_callback(self.background_refreshes.discard)
+
+    async def __background_refresh(self, user_id):
+        try:
+            await self._coalesce(("user_posix_groups", user_id), self.__search_user_posix_groups, user_id)
+        except Exception:
+            logger.exception("Exception refreshing the groups for user %s in the background; continuing to use the cached groups", user_id)
+
+    async def _search(self, query_type, filterstr, attributes, limit=None):
+        """
+        Search LDAP using the backend and time the search.
+        :param query_type: The query type for the latency histogram.
+        """
+        with self.ldap_latency.time(query=query_type), trace_span("ldap", query_type):
+            return await self.backend.search(filterstr, attributes, limit)
+
+    async def __search_user_posix_groups(self, user_id):
+        user_groups = [_group_name(x) for x in await self._search("user_groups", "(&(objectclass=posixGroup)(memberUid={0}))".format(user_id), ["cn"])]
+        logger.debug("User_id='%s' is member of groups %s.", user_id, user_groups)
+        self.cache.set((user_id,), (user_groups, time.time()))
+        return user_groups
+
+    async def get_group_members(self, group_name):
+        """
+        Get the members in a group
+        :param group_name: Group name to get the members for.
+        :return: List of member user id's
+        """
+        grpobj = await self._coalesce(("group_members", group_name), self._search, "group_members", "(&(objectclass=posixGroup)(cn={0}))".format(group_name), ["memberUid"])
+        logger.debug("Group '%s' has members %s.", group_name, grpobj)
+        if grpobj:
+            if 'memberUid' in grpobj[0] and isinstance(grpobj[0]['memberUid'], str):
+                return [grpobj[0]['memberUid']]
+            return grpobj[0].get('memberUid', [])
+        return []
+
+    async def get_groups_matching_pattern(self, group_pattern, limit=None):
+        """
+        Get all the groups in the system matching a pattern.
+        :param group_pattern: Pattern to match against
+        :param limit: Optional; return at most these many groups.
+        :return: List of group names
+        """
+        groupnames = [_group_name(x) for x in await self._coalesce(("groups_matching_pattern", group_pattern, limit), self._search, "groups_matching_pattern", "(&(objectclass=posixGroup)(cn={0}))".format(group_pattern), ["cn", "gidNumber"], limit)]
+        logger.debug("Group pattern '%s' has groups %s.", group_pattern, groupnames)
+        return groupnames
+
+    async def get_userids_matching_pattern(self, userid_pattern, limit=None):
+        """
+        Get all the userids in the system matching a pattern.
+        :param userid_pattern: Pattern to match against
+        :param limit: Optional; return at most these many users.
+        :return: List of dicts with the uid, cn and gecos
+        """
+        userobjs = await self._coalesce(("userids_matching_pattern", userid_pattern, limit), self._search, "userids_matching_pattern", "(&(objectClass=posixAccount)(|(uid={0})(cn={0})))".format(userid_pattern), ["uid", "cn", "gecos", "uidNumber"], limit)
+        logger.debug("Users matching pattern '%s' has entries %s.", userid_pattern, userobjs)
+        return userobjs
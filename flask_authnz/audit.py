@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import logging.handlers
+
+from .metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+audit_file = os.environ.get("FLASK_AUTHNZ_AUDIT_FILE", None)
+audit_file_max_bytes = int(os.environ.get("FLASK_AUTHNZ_AUDIT_MAX_BYTES", str(100*1024*1024)))
+audit_file_backup_count = int(os.environ.get("FLASK_AUTHNZ_AUDIT_BACKUP_COUNT", "5"))
+audit_batch_size = int(os.environ.get("FLASK_AUTHNZ_AUDIT_BATCH_SIZE", "100"))
+audit_flush_interval = float(os.environ.get("FLASK_AUTHNZ_AUDIT_FLUSH_INTERVAL", "1.0"))
+# Denials are always written; only this fraction of the grants is written.
+audit_grant_sample_rate = float(os.environ.get("FLASK_AUTHNZ_AUDIT_GRANT_SAMPLE_RATE", "1.0"))
+# If the writer falls behind by these many records, we drop records rather than grow without bound.
+audit_max_pending = int(os.environ.get("FLASK_AUTHNZ_AUDIT_MAX_PENDING", "100000"))
+
+_STOP = object()
+
+default_audit_log = None
+default_audit_log_lock = threading.Lock()
+
+
+class RotatingFileAuditSink(object):
+    """
+    Write audit records as JSON lines to a file; the file is rotated once it reaches max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=None, backup_count=None):
+        """
+        :param path: Path to the audit file.
+        :param max_bytes: Optional; rotate the file at this size; defaults to FLASK_AUTHNZ_AUDIT_MAX_BYTES.
+        :param backup_count: Optional; keep these many rotated files; defaults to FLASK_AUTHNZ_AUDIT_BACKUP_COUNT.
+        """
+        self.handler = logging.handlers.RotatingFileHandler(path,
+            maxBytes=max_bytes if max_bytes is not None else audit_file_max_bytes,
+            backupCount=backup_count if backup_count is not None else audit_file_backup_count)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+    def write(self, records):
+        for record in records:
+            self.handler.emit(logging.makeLogRecord({"msg": json.dumps(record), "levelno": logging.INFO, "levelname": "INFO"}))
+        self.handler.flush()
+
+    def close(self):
+        self.handler.close()
+
+
+class MongoAuditSink(object):
+    """
+    Insert audit records into a MongoDB collection; each batch is one insert_many.
+    Use a capped collection or a TTL index on time to bound its size.
+    """
+
+    def __init__(self, collection):
+        """
+        :param collection: The pymongo collection to insert into.
+        """
+        self.collection = collection
+
+    def write(self, records):
+        self.collection.insert_many(records, ordered=False)
+
+    def close(self):
+        pass
+
+
+class AuditLog(object):
+    """
+    An audit trail of authorization decisions.
+    record is called in the request thread and only puts the record on a queue.
+    A background thread writes the records to the sink in batches of up to batch_size, at least every flush_interval seconds.
+    The writer is started on the first record in each process; so this can be created before a fork.
+    """
+
+    def __init__(self, sink, batch_size=None, flush_interval=None, grant_sample_rate=None, max_pending=None):
+        """
+        :param sink: Where to write the records; an object with write(records) and close(); for example, RotatingFileAuditSink or MongoAuditSink.
+        :param batch_size: Optional; write at most these many records at a time; defaults to FLASK_AUTHNZ_AUDIT_BATCH_SIZE.
+        :param flush_interval: Optional; write pending records at least every so many seconds; defaults to FLASK_AUTHNZ_AUDIT_FLUSH_INTERVAL.
+        :param grant_sample_rate: Optional; the fraction of grants to write; denials are always written. Defaults to FLASK_AUTHNZ_AUDIT_GRANT_SAMPLE_RATE.
+        :param max_pending: Optional; drop records if these many are waiting to be written; defaults to FLASK_AUTHNZ_AUDIT_MAX_PENDING.
+        """
+        self.sink = sink
+        self.batch_size = batch_size or audit_batch_size
+        self.flush_interval = flush_interval or audit_flush_interval
+        self.grant_sample_rate = grant_sample_rate if grant_sample_rate is not None else audit_grant_sample_rate
+        self.max_pending = max_pending or audit_max_pending
+        self.pending = queue.SimpleQueue()
+        self.writer = None
+        self.writer_pid = None
+        self.writer_lock = threading.Lock()
+        self.records_counter = get_registry().counter("flask_authnz_audit_records_total", "Authorization audit records by outcome", ["outcome"])
+
+    def record(self, application_name, user_id, priv_name, experiment_name, instrument, decision, layer, latency):
+        """
+        Queue an audit record for this decision; this does not block on the sink.
+        :param layer: The layer that made the decision; decision_cache, session, dal or no_roles.
+        :param latency: The time taken for the decision in seconds.
+        """
+        if decision and self.grant_sample_rate < 1.0 and random.random() >= self.grant_sample_rate:
+            self.records_counter.inc(outcome="sampled_out")
+            return
+        if self.pending.qsize() >= self.max_pending:
+            self.records_counter.inc(outcome="dropped")
+            return
+        if self.writer_pid != os.getpid():
+            self.__start_writer()
+        self.pending.put({
+            "time": time.time(),
+            "app": application_name,
+            "user": user_id,
+            "privilege": priv_name,
+            "experiment": experiment_name,
+            "instrument": instrument,
+            "result": "grant" if decision else "deny",
+            "layer": layer,
+            "latency": latency
+        })
+
+    def flush(self, timeout=None):
+        """
+        Wait for the records queued so far to be written.
+        :return: False if we timed out.
+        """
+        if self.writer_pid != os.getpid():
+            return True
+        written = threading.Event()
+        self.pending.put(written)
+        return written.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Write the pending records, stop the writer and close the sink.
+        """
+        with self.writer_lock:
+            writer = self.writer if self.writer_pid == os.getpid() else None
+            self.writer, self.writer_pid = None, None
+        if writer is not None:
+            self.pending.put(_STOP)
+            writer.join(timeout)
+        self.sink.close()
+
+    def __start_writer(self):
+        with self.writer_lock:
+            if self.writer_pid == os.getpid():
+                return
+            self.writer = threading.Thread(target=self.__write_batches, name="flask_authnz_audit", daemon=True)
+            self.writer_pid = os.getpid()
+            self.writer.start()
+
+    def __write_batches(self):
+        while True:
+            batch, waiters, stop = [], [], False
+            deadline = None
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.pending.get(timeout=max(deadline - time.monotonic(), 0.001) if batch else None)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                if deadline is None:
+                    # We wait at most flush_interval after the first record in the batch.
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+            if batch:
+                self.__write(batch)
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+    def __write(self, batch):
+        try:
+            self.sink.write(batch)
+            self.records_counter.inc(len(batch), outcome="written")
+        except Exception:
+            logger.exception("Exception writing %s authorization audit records", len(batch))
+            self.records_counter.inc(len(batch), outcome="failed")
+
+
+def get_default_audit_log():
+    """
+    The AuditLog writing to FLASK_AUTHNZ_AUDIT_FILE; this is shared by all the FlaskAuthnz instances in the process.
+    :return: None if FLASK_AUTHNZ_AUDIT_FILE is not set.
+    """
+    global default_audit_log
+    if not audit_file:
+        return None
+    with default_audit_log_lock:
+        if default_audit_log is None:
+            default_audit_log = AuditLog(RotatingFileAuditSink(audit_file))
+        return default_audit_log
@@ -0,0 +1,313 @@
+import sys
+import json
+import time
+import logging
+import threading
+from threading import RLock
+from cachetools import TTLCache
+
+from .metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+# Databases that never have experiment roles.
+SYSTEM_DATABASES = set(["admin", "config", "local"])
+
+SITE_SCOPE = ("site", None)
+
+# Experiment names that are not in the index and do not have an info or roles collection; these come from the client, so we keep a bounded number of them (with their restricted flags) for a short while.
+unknown_experiments_cache_size = 1024
+unknown_experiments_cache_time = 60
+
+
+def experiment_scope(experiment_name):
+    return ("experiment", experiment_name)
+
+
+def instrument_scope(instrument):
+    return ("instrument", instrument)
+
+
+class AuthorizationIndex(object):
+    """
+    An in-memory index over all the roles collections; this lets MongoDBRoles authorize without any database I/O.
+    We bulk scan the site roles, the site instruments and the roles and info collections in each experiment database.
+    For each scope (the site, an experiment or an instrument), we keep the players for each (app, role).
+    We also keep the inverse; for each player (uid:<user_id> or group), the scopes for each (app, role).
+    The restricted flags for the experiments are kept as well; global and instrument roles do not apply to restricted experiments.
+    The index is rebuilt periodically; single scopes can be refreshed incrementally, for example, on change events.
+    Experiments that are not in the index (for example, experiments created since the last rebuild) are indexed on first use if their database has an info or roles collection.
+    """
+
+    def __init__(self, mongoclient, rolesdbname="site"):
+        """
+        :param mongoclient: The PyMongo client to use.
+        :param rolesdbname: The database with the site roles and instruments.
+        """
+        self.mongoclient = mongoclient
+        self.rolesdbname = rolesdbname
+        self.lock = RLock()
+        # scope -> { (app, role) -> frozenset of players }
+        self.scope_players = {}
+        # player -> { (app, role) -> set of scopes }
+        self.player_grants = {}
+        self.restricted = set()
+        # Experiment names that we looked for and did not find -> is_restricted; these are not added to the index.
+        self.unknown_experiments = TTLCache(unknown_experiments_cache_size, unknown_experiments_cache_time)
+        self.built_at = None
+        self.build_time = None
+        self.refresher = None
+        self.refresher_stop = threading.Event()
+
+    def build(self):
+        """
+        Scan all the roles collections and build a new index; the new index is swapped in once it is complete.
+        """
+        start = time.perf_counter()
+        scope_players = {}
+        restricted = set()
+        scope_players[SITE_SCOPE] = self._load_site_roles()
+        scope_players.update(self._load_instrument_roles())
+        for dbname in self.mongoclient.list_database_names():
+            if dbname == self.rolesdbname or dbname in SYSTEM_DATABASES:
+                continue
+            if not self._is_experiment_database(self.mongoclient[dbname].list_collection_names()):
+                continue
+            scope_players[experiment_scope(dbname)], is_restricted = self._load_experiment(dbname)
+            if is_restricted:
+                restricted.add(dbname)
+        player_grants = {}
+        for scope, grants in scope_players.items():
+            self._add_player_grants(player_grants, scope, grants)
+        with self.lock:
+            self.scope_players, self.player_grants, self.restricted = scope_players, player_grants, restricted
+            self.unknown_experiments.clear()
+            self.built_at = time.time()
+            self.build_time = time.perf_counter() - start
+        get_registry().gauge("flask_authnz_authz_index_build_seconds", "Time taken for the last full build of the authorization index").set(self.build_time)
+        logger.info("Built authorization index with %s scopes and %s players in %.3fs", len(scope_players), len(player_grants), self.build_time)
+
+    def _load_site_roles(self):
+        return self._role_grants(self.mongoclient[self.rolesdbname]["roles"].find({}, {"_id": 0, "app": 1, "name": 1, "players": 1}))
+
+    def _load_instrument_roles(self):
+        ret = {}
+        for instr_obj in self.mongoclient[self.rolesdbname]["instruments"].find({}, {"_id": 1, "roles": 1}):
+            ret[instrument_scope(instr_obj["_id"])] = self._role_grants(instr_obj.get("roles", []))
+        return ret
+
+    @staticmethod
+    def _is_experiment_database(collection_names):
+        return "info" in collection_names or "roles" in collection_names
+
+    def _load_restricted(self, experiment_name):
+        is_restricted = False
+        exp_info = self.mongoclient[experiment_name]["info"].find_one({}, {"params.is_restricted": 1})
+        if exp_info:
+            is_restricted = json.loads(exp_info.get("params", {}).get("is_restricted", "False").lower())
+        return is_restricted
+
+    def _load_experiment(self, experiment_name):
+        grants = self._role_grants(self.mongoclient[experiment_name]["roles"].find({}, {"_id": 0, "app": 1, "name": 1, "players": 1}))
+        return grants, self._load_restricted(experiment_name)
+
+    @staticmethod
+    def _role_grants(roles):
+        grants = {}
+        for role in roles:
+            key = (role.get("app", None), role.get("name", None))
+            grants[key] = grants.get(key, frozenset()) | frozenset(role.get("players", []))
+        return grants
+
+    @staticmethod
+    def _add_player_grants(player_grants, scope, grants):
+        for app_role, players in grants.items():
+            for player in players:
+                player_grants.setdefault(player, {}).setdefault(app_role, set()).add(scope)
+
+    @staticmethod
+    def _remove_player_grants(player_grants, scope, grants):
+        for app_role, players in grants.items():
+            for player in players:
+                scopes = player_grants.get(player, {}).get(app_role, set())
+                scopes.discard(scope)
+                if not scopes:
+                    player_grants.get(player, {}).pop(app_role, None)
+                    if not player_grants.get(player, True):
+                        del player_grants[player]
+
+    def _replace_scope(self, scope, grants):
+        with self.lock:
+            self._remove_player_grants(self.player_grants, scope, self.scope_players.get(scope, {}))
+            self.scope_players[scope] = grants
+            self._add_player_grants(self.player_grants, scope, grants)
+
+    def refresh_experiment(self, experiment_name):
+        """
+        Re-read the roles and the restricted flag for one experiment.
+        """
+        grants, is_restricted = self._load_experiment(experiment_name)
+        with self.lock:
+            self.unknown_experiments.pop(experiment_name, None)
+            self._replace_scope(experiment_scope(experiment_name), grants)
+            if is_restricted:
+                self.restricted.add(experiment_name)
+            else:
+                self.restricted.discard(experiment_name)
+
+    def refresh_site(self):
+        """
+        Re-read the site (global) roles.
+        """
+        self._replace_scope(SITE_SCOPE, self._load_site_roles())
+
+    def refresh_instruments(self):
+        """
+        Re-read the instrument roles.
+        """
+        instrument_roles = self._load_instrument_roles()
+        with self.lock:
+            for scope in [x for x in self.scope_players.keys() if x[0] == "instrument" and x not in instrument_roles]:
+                self._replace_scope(scope, {})
+                del self.scope_players[scope]
+            for scope, grants in instrument_roles.items():
+                self._replace_scope(scope, grants)
+
+    def _scopes(self, experiment_name, instrument):
+        """
+        The scopes that apply to this experiment/instrument; global and instrument roles do not apply to restricted experiments.
+        """
+        if experiment_name and self.is_experiment_restricted(experiment_name):
+            return [experiment_scope(experiment_name)]
+        scopes = [SITE_SCOPE]
+        if experiment_name:
+            scopes.append(experiment_scope(experiment_name))
+        if instrument:
+            scopes.append(instrument_scope(instrument))
+        return scopes
+
+    def is_experiment_restricted(self, experiment_name):
+        """
+        :return: True if the experiment is restricted; experiments that are not in the index yet are added to it if they have an info or roles collection.
+        """
+        with self.lock:
+            indexed = experiment_scope(experiment_name) in self.scope_players
+            unknown_is_restricted = self.unknown_experiments.get(experiment_name, None)
+        if unknown_is_restricted is not None:
+            return unknown_is_restricted
+        if not indexed:
+            if experiment_name == self.rolesdbname or experiment_name in SYSTEM_DATABASES or not self._is_experiment_database(self.mongoclient[experiment_name].list_collection_names()):
+                # We still go by the restricted flag in the info collection, just like MongoDBRoles does without the index.
+                is_restricted = self._load_restricted(experiment_name)
+                logger.debug("Experiment %s does not have an info or roles collection; not adding it to the authorization index", experiment_name)
+                with self.lock:
+                    self.unknown_experiments[experiment_name] = is_restricted
+                return is_restricted
+            logger.debug("Experiment %s is not in the authorization index; adding it", experiment_name)
+            self.refresh_experiment(experiment_name)
+        with self.lock:
+            return experiment_name in self.restricted
+
+    def get_role_players(self, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Same as MongoDBRoles.get_role_players, but answered from the index.
+        :return: A dict mapping each role name to the set of players that have the role.
+        """
+        role_players = {role_name: set() for role_name in role_names}
+        scopes = self._scopes(experiment_name, instrument)
+        with self.lock:
+            for scope in scopes:
+                grants = self.scope_players.get(scope, {})
+                for role_name in role_players.keys():
+                    role_players[role_name].update(grants.get((application_name, role_name), frozenset()))
+        return role_players
+
+    def get_roles_for_players(self, players, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Use the inverted index to get the roles (out of role_names) that any of these players has for this experiment/instrument.
+        :param players: Players; uid:<user_id> and/or group names.
+        :return: The set of role names.
+        """
+        role_names = set(role_names)
+        scopes = set(self._scopes(experiment_name, instrument))
+        ret = set()
+        with self.lock:
+            for player in players:
+                for (app, role_name), role_scopes in self.player_grants.get(player, {}).items():
+                    if app == application_name and role_name in role_names and role_scopes & scopes:
+                        ret.add(role_name)
+        return ret
+
+    def stats(self):
+        """
+        :return: A dict with the number of scopes and players, the approximate memory footprint in bytes, the build time and the age of the index.
+        """
+        with self.lock:
+            return {
+                "scopes": len(self.scope_players),
+                "players": len(self.player_grants),
+                "restricted_experiments": len(self.restricted),
+                "memory_bytes": self._sizeof(self.scope_players) + self._sizeof(self.player_grants) + self._sizeof(self.restricted),
+                "build_time": self.build_time,
+                "age": time.time() - self.built_at if self.built_at else None
+            }
+
+    @classmethod
+    def _sizeof(cls, obj):
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size += sum([cls._sizeof(k) + cls._sizeof(v) for k, v in obj.items()])
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum([cls._sizeof(x) for x in obj])
+        return size
+
+    def start_refresher(self, interval, use_change_stream=False):
+        """
+        Keep the index current in a background thread.
+        :param interval: Rebuild the whole index every so many seconds.
+        :param use_change_stream: In addition, follow a cluster wide change stream and refresh the scopes that change; this needs a replica set.
+        """
+        if self.refresher and self.refresher.is_alive():
+            return
+        self.refresher_stop.clear()
+        self.refresher = threading.Thread(target=self.__refresh, args=(interval, use_change_stream), name="flask_authnz_authorization_index_refresher", daemon=True)
+        self.refresher.start()
+
+    def stop_refresher(self):
+        self.refresher_stop.set()
+        if self.refresher:
+            self.refresher.join()
+        self.refresher = None
+
+    def __refresh(self, interval, use_change_stream):
+        while not self.refresher_stop.is_set():
+            try:
+                if use_change_stream:
+                    pipeline = [{"$match": {"ns.coll": {"$in": ["roles", "info", "instruments"]}}}]
+                    with self.mongoclient.watch(pipeline, max_await_time_ms=1000) as stream:
+                        while stream.alive and not self.refresher_stop.is_set():
+                            if time.time() - (self.built_at or 0) > interval:
+                                self.build()
+                            change = stream.try_next()
+                            if change is not None:
+                                self.apply_change(change)
+                else:
+                    if not self.refresher_stop.wait(interval):
+                        self.build()
+            except Exception:
+                logger.exception("Exception refreshing the authorization index")
+                self.refresher_stop.wait(interval)
+
+    def apply_change(self, change):
+        """
+        Refresh the scope affected by a change stream event.
+        """
+        dbname, collname = change["ns"]["db"], change["ns"]["coll"]
+        logger.debug("Refreshing the authorization index for a change to %s.%s", dbname, collname)
+        if dbname == self.rolesdbname:
+            if collname == "roles":
+                self.refresh_site()
+            elif collname == "instruments":
+                self.refresh_instruments()
+        elif collname in ("roles", "info"):
+            self.refresh_experiment(dbname)
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from threading import RLock
+from cachetools import TLRUCache
+
+logger = logging.getLogger(__name__)
+
+shared_cache_path = os.environ.get("FLASK_AUTHNZ_SHARED_CACHE", None)
+
+
+class _CountingTLRUCache(TLRUCache):
+    """
+    A TLRUCache that counts the entries that were evicted to make space; expired entries are not counted.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_CountingTLRUCache, self).__init__(*args, **kwargs)
+        self.evictions = 0
+
+    def popitem(self):
+        item = super(_CountingTLRUCache, self).popitem()
+        self.evictions += 1
+        return item
+
+
+class InProcessCache(object):
+    """
+    A cache local to this process; this is a cachetools TLRUCache with a lock.
+    Entries expire after their TTL; when the cache is full, the least recently used entries are evicted first.
+    Keys are tuples; values are stored as is.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        :param maxsize: Maximum number of entries.
+        :param ttl: Default time to live in seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = RLock()
+        # We store (ttl, value) so that each entry can have its own TTL.
+        self.cache = _CountingTLRUCache(maxsize, lambda key, entry, now: now + entry[0], timer=time.monotonic)
+
+    def get(self, key):
+        """
+        :return: The value for this key; None if we do not have it or if it has expired.
+        """
+        with self.lock:
+            entry = self.cache.get(key, None)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.cache[key] = (ttl if ttl is not None else self.ttl, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def keys(self):
+        """
+        :return: A list of the keys currently in the cache.
+        """
+        with self.lock:
+            return list(self.cache.keys())
+
+    def stats(self):
+        """
+        :return: A dict with the number of entries and the number of evictions.
+        """
+        with self.lock:
+            self.cache.expire()
+            return {"size": len(self.cache), "maxsize": self.maxsize, "evictions": self.cache.evictions}
+
+
+class SQLiteCache(object):
+    """
+    A cache shared by all the processes on this host; this is a SQLite database in WAL mode.
+    All the gunicorn workers on a node can use the same file; no network service is needed.
+    Several caches can share a file using different namespaces.
+    Keys are tuples and values are stored as JSON; so tuples come back as lists.
+    Entries expire after their TTL; when the cache grows past maxsize, the entries closest to expiry are evicted first.
+    """
+
+    def __init__(self, path, namespace, maxsize, ttl):
+        """
+        :param path: Path to the SQLite database; this is created if needed.
+        :param namespace: Namespace for the keys in this cache.
+        :param maxsize: Maximum number of entries in this namespace.
+        :param ttl: Default time to live in seconds.
+        """
+        self.path = path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self.sets_since_eviction = 0
+        self.lock = RLock()
+        self.conn = None
+        self.conn_pid = None
+
+    def _connection(self):
+        # SQLite connections cannot be shared across a fork; so each process opens its own.
+        if self.conn is None or self.conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, expires_at REAL, PRIMARY KEY (namespace, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (namespace, expires_at)")
+            self.conn = conn
+            self.conn_pid = os.getpid()
+        return self.conn
+
+    @staticmethod
+    def _encode_key(key):
+        return json.dumps(key)
+
+    @staticmethod
+    def _decode_key(key):
+        key = json.loads(key)
+        return tuple(key) if isinstance(key, list) else key
+
+    def get(self, key):
+        """
+        :return: The value for this key; None if we do not have it or if it has expired.
+        """
+        with self.lock:
+            row = self._connection().execute("SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+                                             (self.namespace, self._encode_key(key), time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self._connection().execute("INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                                       (self.namespace, self._encode_key(key), json.dumps(value), expires_at))
+            self.sets_since_eviction += 1
+            # Checking the size on every write is expensive; we let the cache go over maxsize a little.
+            if self.sets_since_eviction >= max(1, self.maxsize // 16):
+                self._evict()
+
+    def _evict(self):
+        conn = self._connection()
+        self.sets_since_eviction = 0
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time()))
+        count = conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        if count > self.maxsize:
+            conn.execute("DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache WHERE namespace = ? ORDER BY expires_at LIMIT ?)",
+                         (self.namespace, count - self.maxsize))
+            self.evictions += count - self.maxsize
+
+    def delete(self, key):
+        with self.lock:
+            self._connection().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, self._encode_key(key)))
+
+    def clear(self):
+        with self.lock:
+            self._connection().execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def keys(self):
+        """
+        :return: A list of the unexpired keys currently in the cache.
+        """
+        with self.lock:
+            rows = self._connection().execute("SELECT key FROM cache WHERE namespace = ? AND expires_at > ?", (self.namespace, time.time())).fetchall()
+        return [self._decode_key(x[0]) for x in rows]
+
+    def stats(self):
+        """
+        :return: A dict with the number of entries and the number of evictions made by this process.
+        """
+        with self.lock:
+            self._evict()
+            count = self._connection().execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        return {"size": count, "maxsize": self.maxsize, "evictions": self.evictions}
+
+
+def make_cache(namespace, maxsize, ttl):
+    """
+    Make the cache configured for this process.
+    If FLASK_AUTHNZ_SHARED_CACHE is set to the path of a SQLite database, we use a cache shared with all the processes on this host.
+    Otherwise, we use a cache local to this process.
+    """
+    if shared_cache_path:
+        logger.info("Using shared cache %s for %s", shared_cache_path, namespace)
+        return SQLiteCache(shared_cache_path, namespace, maxsize, ttl)
+    return InProcessCache(maxsize, ttl)
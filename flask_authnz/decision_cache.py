@@ -0,0 +1,104 @@
+import os
+import logging
+from threading import RLock
+
+from .cache_backends import make_cache
+from .metrics import register_cache_metrics, cache_requests
+
+logger = logging.getLogger(__name__)
+
+decision_cache_size = int(os.environ.get("FLASK_AUTHNZ_DECISION_CACHE_SIZE", "8192"))
+decision_cache_grant_ttl = int(os.environ.get("FLASK_AUTHNZ_DECISION_CACHE_GRANT_TTL", "300"))
+decision_cache_deny_ttl = int(os.environ.get("FLASK_AUTHNZ_DECISION_CACHE_DENY_TTL", "60"))
+
+
+class DecisionCache(object):
+    """
+    Cache of authorization decisions.
+    Decisions are keyed on (user, privilege, experiment, instrument, application); both grants and denials are cached.
+    The application is part of the key as the same cache (for example, a shared cache) can be used by many applications with different roles.
+    Grants and denials have separate TTLs; denials are typically kept for a shorter time so that newly added players take effect quickly.
+    Once the cache is full, the least recently used decisions are evicted.
+    The decisions are held in a cache backend (see cache_backends); by default, this is local to the process.
+    Set FLASK_AUTHNZ_SHARED_CACHE to share the decisions with all the processes on this host.
+    """
+
+    def __init__(self, maxsize=None, grant_ttl=None, deny_ttl=None, backend=None):
+        """
+        :param maxsize: Maximum number of decisions to hold; defaults to FLASK_AUTHNZ_DECISION_CACHE_SIZE.
+        :param grant_ttl: Time in seconds to hold on to a grant; defaults to FLASK_AUTHNZ_DECISION_CACHE_GRANT_TTL.
+        :param deny_ttl: Time in seconds to hold on to a denial; defaults to FLASK_AUTHNZ_DECISION_CACHE_DENY_TTL.
+        :param backend: Optional; the cache backend to use.
+        """
+        self.maxsize = maxsize if maxsize is not None else decision_cache_size
+        self.grant_ttl = grant_ttl if grant_ttl is not None else decision_cache_grant_ttl
+        self.deny_ttl = deny_ttl if deny_ttl is not None else decision_cache_deny_ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+        self.cache = backend or make_cache("decisions", self.maxsize, self.grant_ttl)
+        self.requests_counter = cache_requests()
+        register_cache_metrics("decisions", self.cache.stats)
+
+    def get(self, user_id, priv_name, experiment_name=None, instrument=None, application_name=None):
+        """
+        Look up a cached decision.
+        :return: True/False for a cached grant/denial; None if we do not have a decision for this key.
+        """
+        decision = self.cache.get((user_id, priv_name, experiment_name, instrument, application_name))
+        with self.lock:
+            if decision is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.requests_counter.inc(cache="decisions", result="miss" if decision is None else "hit")
+        return decision
+
+    def put(self, user_id, priv_name, experiment_name, instrument, decision, application_name=None):
+        """
+        Cache a decision.
+        """
+        self.cache.set((user_id, priv_name, experiment_name, instrument, application_name), bool(decision), self.grant_ttl if decision else self.deny_ttl)
+
+    def invalidate_user(self, user_id):
+        """
+        Drop all cached decisions for this user.
+        """
+        self._invalidate(lambda key: key[0] == user_id)
+
+    def invalidate_experiment(self, experiment_name):
+        """
+        Drop all cached decisions for this experiment.
+        """
+        self._invalidate(lambda key: key[2] == experiment_name)
+
+    def invalidate_instrument(self, instrument):
+        """
+        Drop all cached decisions for this instrument.
+        """
+        self._invalidate(lambda key: key[3] == instrument)
+
+    def invalidate_application(self, application_name):
+        """
+        Drop all cached decisions for this application; for example, when its privileges change.
+        """
+        self._invalidate(lambda key: key[4] == application_name)
+
+    def invalidate_all(self):
+        """
+        Drop all cached decisions.
+        """
+        self.cache.clear()
+
+    def _invalidate(self, predicate):
+        for key in [x for x in self.cache.keys() if predicate(x)]:
+            self.cache.delete(key)
+
+    def stats(self):
+        """
+        :return: A dict with the hit/miss counters, the current size of the cache and the number of evictions.
+        """
+        stats = self.cache.stats()
+        with self.lock:
+            stats.update({"hits": self.hits, "misses": self.misses})
+        return stats
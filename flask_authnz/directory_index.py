@@ -0,0 +1,129 @@
+import os
+import time
+import bisect
+import re
+import logging
+from collections import namedtuple
+
+from .ldap_index import LDAPSnapshotIndex
+
+logger = logging.getLogger(__name__)
+
+directory_index_refresh_interval_in_seconds = int(os.environ.get("FLASK_AUTHNZ_DIRECTORY_INDEX_REFRESH", "0"))
+
+# users and groups are lists of LDAP entries sorted by uid/cn.
+# The *_keys are sorted lists of (lowercased attribute value, position in users/groups); these are used for prefix searches.
+# The *_text are the lowercased searchable values for each entry, separated by newlines; these are used for other patterns.
+DirectorySnapshot = namedtuple("DirectorySnapshot", ["loaded_at", "users", "user_keys", "user_text", "groups", "group_keys", "group_text"])
+
+USER_ATTRIBUTES = ["uid", "cn", "gecos", "uidNumber"]
+USER_SEARCH_ATTRIBUTES = ["uid", "cn", "gecos"]
+GROUP_ATTRIBUTES = ["cn", "gidNumber"]
+
+
+def _values(entry, name):
+    value = entry.get(name, [])
+    return [value] if isinstance(value, str) else value
+
+
+def _first(entry, name):
+    values = _values(entry, name)
+    return values[0] if values else ""
+
+
+class DirectoryIndex(LDAPSnapshotIndex):
+    """
+    An in-memory index of all the users (uid, cn and gecos) and groups (cn) for typeahead searches; loaded using two bulk LDAP searches.
+    Patterns are LDAP style wildcard patterns and are matched without regard to case.
+    Patterns like john* are answered using a binary search over the sorted values; other patterns like *john* scan all the entries.
+    Refreshing builds a new snapshot off to the side and then swaps it in; see LDAPSnapshotIndex.
+    """
+    index_name = "directory_index"
+    description = "directory"
+
+    def __init__(self, backend, refresh_interval=None, max_age=None):
+        """
+        :param backend: The LDAP backend to use for the bulk searches.
+        :param refresh_interval: Refresh the snapshot every so many seconds; defaults to FLASK_AUTHNZ_DIRECTORY_INDEX_REFRESH.
+        :param max_age: Do not use snapshots older than this; defaults to three times the refresh interval.
+        """
+        super(DirectoryIndex, self).__init__(backend, refresh_interval or directory_index_refresh_interval_in_seconds or 600, max_age)
+
+    def refresh(self):
+        """
+        Load all the users and groups from LDAP and swap in the new snapshot.
+        """
+        start = time.time()
+        with self.ldap_latency.time(query="directory_index"):
+            users = sorted(self.backend.iter_search("(objectClass=posixAccount)", USER_ATTRIBUTES), key=lambda x: _first(x, "uid"))
+            groups = sorted(self.backend.iter_search("(objectclass=posixGroup)", GROUP_ATTRIBUTES), key=lambda x: _first(x, "cn"))
+        user_keys, user_text = self.__build_keys(users, USER_SEARCH_ATTRIBUTES)
+        group_keys, group_text = self.__build_keys(groups, ["cn"])
+        self.snapshot = DirectorySnapshot(time.time(), users, user_keys, user_text, groups, group_keys, group_text)
+        logger.info("Loaded directory snapshot with %s users and %s groups in %.3fs", len(users), len(groups), time.time() - start)
+
+    @staticmethod
+    def __build_keys(entries, attributes):
+        keys, text = [], []
+        for position, entry in enumerate(entries):
+            values = set([x.lower() for name in attributes for x in _values(entry, name)])
+            keys.extend([(x, position) for x in values])
+            text.append("\n".join(sorted(values)))
+        keys.sort()
+        return keys, text
+
+    @staticmethod
+    def __matching_positions(keys, text, pattern):
+        """
+        :return: The sorted positions of the entries that have a value matching the pattern.
+        """
+        pattern = pattern.lower()
+        wildcards = pattern.count("*")
+        if wildcards == 0 or (wildcards == 1 and pattern.endswith("*")):
+            prefix = pattern.rstrip("*")
+            positions = set()
+            i = bisect.bisect_left(keys, (prefix,))
+            while i < len(keys) and (keys[i][0].startswith(prefix) if wildcards else keys[i][0] == prefix):
+                positions.add(keys[i][1])
+                i += 1
+            return sorted(positions)
+        if wildcards == 2 and pattern.startswith("*") and pattern.endswith("*") and len(pattern) > 2:
+            substring = pattern[1:-1]
+            return [position for position, values in enumerate(text) if substring in values]
+        regex = re.compile("^" + ".*".join([re.escape(x) for x in pattern.split("*")]) + "$", re.MULTILINE)
+        return [position for position, values in enumerate(text) if regex.search(values)]
+
+    def search_users(self, userid_pattern, limit=None, offset=0):
+        """
+        :param userid_pattern: Pattern to match against the uid, cn and gecos.
+        :param limit: Optional; return at most these many users.
+        :param offset: Skip these many matching users; use this with limit for pagination.
+        :return: List of user entries (dicts with the uid, cn, gecos and uidNumber) sorted by uid; None if there is no usable snapshot.
+        """
+        snapshot = self.current_snapshot()
+        if snapshot is None:
+            return None
+        positions = self.__matching_positions(snapshot.user_keys, snapshot.user_text, userid_pattern)
+        return [snapshot.users[x] for x in positions[offset:offset+limit if limit else None]]
+
+    def search_groups(self, group_pattern, limit=None, offset=0):
+        """
+        :param group_pattern: Pattern to match against the group cn.
+        :param limit: Optional; return at most these many groups.
+        :param offset: Skip these many matching groups; use this with limit for pagination.
+        :return: List of group entries (dicts with the cn and gidNumber) sorted by cn; None if there is no usable snapshot.
+        """
+        snapshot = self.current_snapshot()
+        if snapshot is None:
+            return None
+        positions = self.__matching_positions(snapshot.group_keys, snapshot.group_text, group_pattern)
+        return [snapshot.groups[x] for x in positions[offset:offset+limit if limit else None]]
+
+    def size(self):
+        """
+        :return: A dict with the number of users and groups in the current snapshot.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {"users": 0, "groups": 0}
+        return {"users": len(snapshot.users), "groups": len(snapshot.groups)}
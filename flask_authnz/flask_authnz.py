@@ -1,14 +1,40 @@
 import os
 import logging
+import time
+import threading
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import request, jsonify, url_for, abort, session, g
 from werkzeug.utils import redirect
 
+from .session_roles import SessionRoles, scope_for
+from .metrics import get_registry
+from .tracing import trace_event, trace_span
+from .audit import get_default_audit_log
+from .snapshot import CacheSnapshot, snapshot_file as cache_snapshot_file
+
 __author__ = 'andrej.babic@cosylab.com'
 
 logger = logging.getLogger(__name__)
 
+# If more than 1, check the roles for a privilege concurrently using a pool of this many threads shared by all FlaskAuthnz instances.
+# This only applies to roles DALs without has_any_slac_user_role; MongoDBRoles checks all the roles in one batch instead.
+role_check_pool_size = int(os.environ.get("FLASK_AUTHNZ_ROLE_CHECK_CONCURRENCY", "0"))
+role_check_executor = None
+role_check_executor_lock = threading.Lock()
+
+
+def get_role_check_executor(max_workers):
+    """
+    Get the thread pool shared by all FlaskAuthnz instances for checking roles concurrently; this is created on first use.
+    """
+    global role_check_executor
+    with role_check_executor_lock:
+        if role_check_executor is None:
+            role_check_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flask_authnz_role_check")
+        return role_check_executor
+
 class FlaskAuthnz(object):
     """
     General security client for flask web services at PSDM/SLAC.
@@ -20,18 +46,42 @@ class FlaskAuthnz(object):
     --> Users/groups are assigned roles in the context of experiments/instruments.
     """
 
-    def __init__(self, roles_dal, application_name, redirect_url=None):
+    def __init__(self, roles_dal, application_name, redirect_url=None, decision_cache=None, privileges_refresh_interval=None, use_change_stream=False, role_check_concurrency=None, audit_log=None, snapshot_file=None):
         """
         Initialize the security client.
         :param roles_dal: A data access object to get to the roles/privileges.
         :param application_name: The name of this application.
         :param redirect_url: Redirect to this URL if we fail authentication. Note that with WebAuth integration, you will not be needing this.
+        :param decision_cache: Optional; a DecisionCache used to remember grants and denials across requests.
+        :param privileges_refresh_interval: Optional; if specified, reload the privilege -> roles mapping in the background every so many seconds.
+        :param use_change_stream: If reloading in the background, reload when the roles change (using a change stream) instead of polling.
+        :param role_check_concurrency: Optional; if more than 1, check the roles for a privilege concurrently; defaults to FLASK_AUTHNZ_ROLE_CHECK_CONCURRENCY.
+        This is used only if the roles DAL cannot check several roles in one batch (has_any_slac_user_role); so, not with MongoDBRoles.
+        The results are still used in role order; a grant from a later role waits for the checks of the roles before it.
+        :param audit_log: Optional; an AuditLog to which every decision is written; defaults to a log written to FLASK_AUTHNZ_AUDIT_FILE, if set.
+        :param snapshot_file: Optional; load the group membership and scope caches from this file on startup and save them to it periodically and on exit.
+        Defaults to FLASK_AUTHNZ_SNAPSHOT_FILE.
         """
         self.roles_dal = roles_dal
         self.application_name = application_name
         self.redirect_url = redirect_url
+        self.decision_cache = decision_cache
         self.priv2roles = roles_dal.getPrivilegesForApplicationRoles(application_name)
         self.session_roles_name = "APPLICATION_ROLES_" + self.application_name
+        self.privileges_refresher = None
+        self.privileges_refresher_stop = threading.Event()
+        self.role_check_concurrency = role_check_concurrency if role_check_concurrency is not None else role_check_pool_size
+        self.decisions_counter = get_registry().counter("flask_authnz_decisions_total", "Authorization decisions by the layer that answered them and the result", ["layer", "result"])
+        self.decision_latency = get_registry().histogram("flask_authnz_decision_seconds", "Time taken for authorization decisions by the layer that answered them", ["layer"])
+        self.audit_log = audit_log if audit_log is not None else get_default_audit_log()
+        self.cache_snapshot = None
+        snapshot_file = snapshot_file or cache_snapshot_file
+        if snapshot_file:
+            self.cache_snapshot = CacheSnapshot(snapshot_file, roles_dal, getattr(roles_dal, "usergroupsgetter", None))
+            self.cache_snapshot.load()
+            self.cache_snapshot.start()
+        if privileges_refresh_interval:
+            self.start_privileges_refresher(privileges_refresh_interval, use_change_stream)
 
 
     def authentication_required(self, wrapped_function):
@@ -65,20 +115,96 @@ class FlaskAuthnz(object):
         if len(params) < 1:
             raise Exception("Application privilege not specified when specifying the authorization")
         priv_name = params[0]
-        if priv_name not in self.priv2roles:
+        if priv_name not in self.priv2roles and self.privileges_refresher:
+            # The privilege may show up on a later reload; we check against the current mapping when the request comes in.
+            logger.warning("Privilege %s is not currently granted by any role in application %s", priv_name, self.application_name)
+        elif priv_name not in self.priv2roles:
             raise Exception("Please specify an appropriate application privilege for the authorization_required decorator " + ",".join(self.priv2roles.keys()))
         def wrapper(f):
             @wraps(f)
             def wrapped(*args, **kwargs):
                 experiment_name = kwargs.get('experiment_name', None)
                 instrument = g.get("instrument", None)
-                logger.info("Looking to authorize %s for app %s for privilege %s for experiment %s instrument %s" % (self.get_current_user_id(), self.application_name, priv_name, experiment_name, instrument))
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Looking to authorize %s for app %s for privilege %s for experiment %s instrument %s", self.get_current_user_id(), self.application_name, priv_name, experiment_name, instrument)
                 if not self.check_privilege_for_experiment(priv_name, experiment_name, instrument):
                     abort(403)
                 return f(*args, **kwargs)
             return wrapped
         return wrapper
 
+    def effective_privileges_required(self, f):
+        """
+        Decorator that computes all of the current user's privileges for this experiment/instrument and makes these available as flask.g.effective_privileges.
+        Use this after authentication_required; this is useful for UIs that need to decide what to show.
+        As with authorization_required, pass in the experiment_name as a flask variable and the instrument in flask.g.instrument.
+        """
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            g.effective_privileges = self.get_effective_privileges(kwargs.get('experiment_name', None), g.get("instrument", None))
+            return f(*args, **kwargs)
+        return wrapped
+
+    def reload_privileges(self):
+        """
+        Reload the privilege -> roles mapping from the database.
+        The new mapping is built off to the side and then swapped in; requests in flight continue to use the mapping they started with.
+        If the mapping has changed, the cached decisions are dropped.
+        :return: True if the mapping changed.
+        """
+        priv2roles = self.roles_dal.getPrivilegesForApplicationRoles(self.application_name)
+        if priv2roles == self.priv2roles:
+            return False
+        logger.info("Privileges for application %s have changed; reloading", self.application_name)
+        self.priv2roles = priv2roles
+        if self.decision_cache is not None:
+            self.decision_cache.invalidate_application(self.application_name)
+        return True
+
+    def start_privileges_refresher(self, interval, use_change_stream=False):
+        """
+        Start a background thread that keeps the privilege -> roles mapping current.
+        Note that threads do not survive a fork; with a preloading server like gunicorn, start this in each worker.
+        :param interval: Poll the database every so many seconds. With a change stream, this is how long we wait before retrying a broken stream.
+        :param use_change_stream: Reload whenever the roles change instead of polling; this needs a DAL with a watch_roles method.
+        """
+        if self.privileges_refresher and self.privileges_refresher.is_alive():
+            return
+        if use_change_stream and not hasattr(self.roles_dal, "watch_roles"):
+            raise Exception("The roles DAL does not support change streams")
+        self.privileges_refresher_stop.clear()
+        self.privileges_refresher = threading.Thread(target=self.__refresh_privileges,
+                                                     args=(interval, use_change_stream),
+                                                     name="flask_authnz_privileges_refresher",
+                                                     daemon=True)
+        self.privileges_refresher.start()
+
+    def stop_privileges_refresher(self):
+        """
+        Stop the background privileges refresher.
+        """
+        self.privileges_refresher_stop.set()
+        if self.privileges_refresher:
+            self.privileges_refresher.join()
+        self.privileges_refresher = None
+
+    def __refresh_privileges(self, interval, use_change_stream):
+        while not self.privileges_refresher_stop.is_set():
+            try:
+                if use_change_stream:
+                    with self.roles_dal.watch_roles(max_await_time_ms=int(interval*1000)) as stream:
+                        # Catch any changes made before the stream was opened.
+                        self.reload_privileges()
+                        while stream.alive and not self.privileges_refresher_stop.is_set():
+                            if stream.try_next() is not None:
+                                self.reload_privileges()
+                else:
+                    if not self.privileges_refresher_stop.wait(interval):
+                        self.reload_privileges()
+            except Exception:
+                logger.exception("Exception reloading privileges for application %s", self.application_name)
+                self.privileges_refresher_stop.wait(interval)
+
     def get_current_user_id(self):
         """
         Get the user id from the proxy.
@@ -104,66 +230,231 @@ class FlaskAuthnz(object):
         Check to see if this use has the necessary privilege for this experiment.
         The application caches all the privilege -> role mappings on startup.
         We check to see if this user has any of the roles necessary for the privilege.
+        If we have a decision cache, both grants and denials are remembered for a while.
         """
-        for role_name in self.priv2roles[priv_name]:
-            if self.__authorize_slac_user_for_experiment(role_name, experiment_name, instrument):
-                logger.debug("Role %s grants privilege %s for user %s for experiment %s" % (role_name, priv_name, self.get_current_user_id(), experiment_name))
-                return True
-        logger.warn("Did not find any role with privilege %s for user %s for experiment %s" % (priv_name, self.get_current_user_id(), experiment_name))
-        return False
+        start = time.perf_counter()
+        user_id = self.get_current_user_id()
+        if self.decision_cache is not None:
+            decision = self.decision_cache.get(user_id, priv_name, experiment_name, instrument, application_name=self.application_name)
+            if decision is not None:
+                logger.debug("Found cached decision %s for privilege %s for user %s for experiment %s instrument %s", decision, priv_name, user_id, experiment_name, instrument)
+                self.__record_decision(user_id, priv_name, experiment_name, instrument, "decision_cache", decision, start)
+                return decision
+        decision, layer = self.__check_privilege_for_experiment(user_id, priv_name, experiment_name, instrument)
+        if self.decision_cache is not None:
+            self.decision_cache.put(user_id, priv_name, experiment_name, instrument, decision, application_name=self.application_name)
+        self.__record_decision(user_id, priv_name, experiment_name, instrument, layer, decision, start)
+        return decision
+
+    def __record_decision(self, user_id, priv_name, experiment_name, instrument, layer, decision, start):
+        elapsed = time.perf_counter() - start
+        self.decisions_counter.inc(layer=layer, result="grant" if decision else "deny")
+        self.decision_latency.observe(elapsed, layer=layer)
+        trace_event("decision", priv_name, elapsed, experiment=experiment_name, instrument=instrument, layer=layer, result="grant" if decision else "deny")
+        if self.audit_log is not None:
+            self.audit_log.record(self.application_name, user_id, priv_name, experiment_name, instrument, decision, layer, elapsed)
+
+    def __check_privilege_for_experiment(self, user_id, priv_name, experiment_name, instrument=None):
+        """
+        :return: The decision and the layer that made it; session, dal or no_roles.
+        """
+        # The mapping may be swapped out by the privileges refresher; use the same mapping for the whole check.
+        role_names = sorted(self.priv2roles.get(priv_name, []))
+        if not role_names:
+            logger.warning("Privilege %s is not granted by any role in application %s", priv_name, self.application_name)
+            return False, "no_roles"
+        if hasattr(self.roles_dal, "has_any_slac_user_role"):
+            return self.__check_privilege_for_experiment_batched(user_id, priv_name, role_names, experiment_name, instrument)
+        if self.role_check_concurrency > 1 and len(role_names) > 1:
+            return self.__check_privilege_for_experiment_parallel(user_id, priv_name, role_names, experiment_name, instrument)
+        for role_name in role_names:
+            if self.__find_role_in_session(user_id, role_name, experiment_name, instrument):
+                logger.debug("Role %s grants privilege %s for user %s for experiment %s", role_name, priv_name, user_id, experiment_name)
+                return True, "session"
+            if self.__authorize_slac_user_for_experiment(user_id, role_name, experiment_name, instrument):
+                logger.debug("Role %s grants privilege %s for user %s for experiment %s", role_name, priv_name, user_id, experiment_name)
+                return True, "dal"
+        logger.warning("Did not find any role with privilege %s for user %s for experiment %s", priv_name, user_id, experiment_name)
+        return False, "dal"
+
+    def __check_privilege_for_experiment_batched(self, user_id, priv_name, role_names, experiment_name, instrument=None):
+        """
+        Check all the roles that grant this privilege in one go.
+        We first look in the session; if none of the roles are there, we ask the DAL to check all the roles in one batch.
+        """
+        for role_name in role_names:
+            if self.__find_role_in_session(user_id, role_name, experiment_name, instrument):
+                logger.debug("Role %s grants privilege %s for user %s for experiment %s", role_name, priv_name, user_id, experiment_name)
+                return True, "session"
+        with trace_span("dal", "has_any_slac_user_role", roles="|".join(role_names)):
+            role_name = self.roles_dal.has_any_slac_user_role(user_id, self.application_name, role_names, experiment_name, instrument)
+        if role_name:
+            logger.info("Found application role %s/%s for experiment %s in db for user %s", self.application_name, role_name, experiment_name, user_id)
+            self.__add_role_to_session(role_name, experiment_name, instrument)
+            logger.debug("Role %s grants privilege %s for user %s for experiment %s", role_name, priv_name, user_id, experiment_name)
+            return True, "dal"
+        logger.warning("Did not find any role with privilege %s for user %s for experiment %s", priv_name, user_id, experiment_name)
+        return False, "dal"
+
+    def __check_privilege_for_experiment_parallel(self, user_id, priv_name, role_names, experiment_name, instrument=None):
+        """
+        Check the roles that grant this privilege concurrently; this is only used for roles DALs without has_any_slac_user_role.
+        The results are used in role order; so the granting role (which is added to the session) is the same as in the sequential check.
+        This means that we do not return on the first grant to complete; a grant from a later role waits for the checks of all the roles before it.
+        We return as soon as a role grants the privilege and all the roles before it have not; we do not wait for the roles after it.
+        The worker threads only call the DAL; the session is read and updated in the request thread.
+        If no role grants the privilege and one of the checks failed, the exception from the first role (in role order) that failed is raised.
+        """
+        for role_name in role_names:
+            if self.__find_role_in_session(user_id, role_name, experiment_name, instrument):
+                logger.debug("Role %s grants privilege %s for user %s for experiment %s", role_name, priv_name, user_id, experiment_name)
+                return True, "session"
+        executor = get_role_check_executor(self.role_check_concurrency)
+        futures = [executor.submit(self.roles_dal.has_slac_user_role, user_id, self.application_name, role_name, experiment_name, instrument) for role_name in role_names]
+        granting_role, errors = None, []
+        try:
+            for role_name, future in zip(role_names, futures):
+                try:
+                    if future.result():
+                        granting_role = role_name
+                        break
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            # Checks that have not started yet are skipped; the ones in progress run to completion and their results are ignored.
+            for future in futures:
+                future.cancel()
+        if granting_role:
+            logger.info("Found application role %s/%s for experiment %s in db for user %s", self.application_name, granting_role, experiment_name, user_id)
+            self.__add_role_to_session(granting_role, experiment_name, instrument)
+            logger.debug("Role %s grants privilege %s for user %s for experiment %s", granting_role, priv_name, user_id, experiment_name)
+            return True, "dal"
+        if errors:
+            raise errors[0]
+        logger.warning("Did not find any role with privilege %s for user %s for experiment %s", priv_name, user_id, experiment_name)
+        return False, "dal"
+
+    def get_effective_privileges(self, experiment_name=None, instrument=None):
+        """
+        Get all the privileges that the current user has for this experiment/instrument.
+        We resolve all of the user's roles for this scope in one go; this is much cheaper than calling check_privilege_for_experiment for each privilege.
+        As a side effect, the roles are added to the session and the decisions for all privileges are added to the decision cache.
+        :param experiment_name: Optional; the experiment.
+        :param instrument: Optional; the instrument.
+        :return: The set of privilege names.
+        """
+        user_id = self.get_current_user_id()
+        priv2roles = self.priv2roles
+        role_names = sorted(set([role_name for role_names in priv2roles.values() for role_name in role_names]))
+        if hasattr(self.roles_dal, "get_slac_user_roles"):
+            user_roles = self.roles_dal.get_slac_user_roles(user_id, self.application_name, role_names, experiment_name, instrument)
+        else:
+            user_roles = set([role_name for role_name in role_names if self.roles_dal.has_slac_user_role(user_id, self.application_name, role_name, experiment_name, instrument)])
+        for role_name in sorted(user_roles):
+            if not self.__find_role_in_session(user_id, role_name, experiment_name, instrument):
+                self.__add_role_to_session(role_name, experiment_name, instrument)
+        privileges = set([priv_name for priv_name, priv_roles in priv2roles.items() if priv_roles & user_roles])
+        if self.decision_cache is not None:
+            for priv_name in priv2roles.keys():
+                self.decision_cache.put(user_id, priv_name, experiment_name, instrument, priv_name in privileges, application_name=self.application_name)
+        logger.info("User %s has privileges %s for experiment %s instrument %s", user_id, sorted(privileges), experiment_name, instrument)
+        return privileges
+
+    def filter_experiments(self, priv_name, experiment_names, instrument=None):
+        """
+        Filter a list of experiments down to those where the current user has this privilege; for example, for listing endpoints.
+        Cached decisions are used where we have them; the rest of the experiments are checked using one bulk DAL call.
+        The decisions are added to the decision cache but not to the session, which would otherwise grow quickly.
+        :param priv_name: Privilege name
+        :param experiment_names: Experiment names to check.
+        :param instrument: Optional; the instrument for all these experiments.
+        :return: The list of experiments where the user has this privilege, in the same order as experiment_names.
+        """
+        user_id = self.get_current_user_id()
+        role_names = sorted(self.priv2roles.get(priv_name, []))
+        if not role_names:
+            logger.warning("Privilege %s is not granted by any role in application %s", priv_name, self.application_name)
+            return []
+        if not hasattr(self.roles_dal, "get_experiments_with_any_slac_user_role"):
+            return [x for x in experiment_names if self.check_privilege_for_experiment(priv_name, x, instrument)]
+
+        decisions = {}
+        if self.decision_cache is not None:
+            for experiment_name in experiment_names:
+                decision = self.decision_cache.get(user_id, priv_name, experiment_name, instrument, application_name=self.application_name)
+                if decision is not None:
+                    decisions[experiment_name] = decision
+        to_check = [x for x in experiment_names if x not in decisions]
+        if to_check:
+            permitted = set(self.roles_dal.get_experiments_with_any_slac_user_role(user_id, self.application_name, role_names, to_check, instrument))
+            for experiment_name in to_check:
+                decisions[experiment_name] = experiment_name in permitted
+                if self.decision_cache is not None:
+                    self.decision_cache.put(user_id, priv_name, experiment_name, instrument, decisions[experiment_name], application_name=self.application_name)
+        logger.info("User %s has privilege %s for %s of %s experiments", user_id, priv_name, sum(decisions.values()), len(decisions))
+        return [x for x in experiment_names if decisions[x]]
+
+    def get_users_with_privilege(self, priv_name, experiment_name=None, instrument=None):
+        """
+        Get all the users who have this privilege for this experiment/instrument; for example, to send notifications or to review access.
+        This does not depend on the current user or the session.
+        The global and instrument roles are skipped for restricted experiments, as they are for authorization.
+        :param priv_name: Privilege name
+        :param experiment_name: Optional; the experiment.
+        :param instrument: Optional; the instrument.
+        :return: The set of user ids.
+        """
+        role_names = sorted(self.priv2roles.get(priv_name, []))
+        if not role_names:
+            logger.warning("Privilege %s is not granted by any role in application %s", priv_name, self.application_name)
+            return set()
+        return self.roles_dal.get_users_with_any_slac_user_role(self.application_name, role_names, experiment_name, instrument)
 
     def get_session_roles(self):
         """
-        Get the list of roles stored in the flask session
+        Get the roles stored in the flask session
+        :return: A dict of <app>/<role> -> list of experiments/instruments (or __ALL__) for which the role has been granted.
+        """
+        return SessionRoles.load(session.get(self.session_roles_name, None), self.application_name).as_dict()
+
+    def __find_role_in_session(self, user_id, application_role, experiment_name=None, instrument=None):
+        """
+        Check if we have already granted this application role to this user for this experiment/instrument in this session.
+        If the caller did not specify an experiment or instrument, we look for a grant for all experiments (__ALL__).
+        """
+        scope = scope_for(experiment_name, instrument)
+        found = SessionRoles.load(session.get(self.session_roles_name, None), self.application_name).has(application_role, scope)
+        trace_event("session", application_role, scope=scope, result="hit" if found else "miss")
+        if found:
+            logger.info("Found %s for application role %s/%s in session for user %s", scope, self.application_name, application_role, user_id)
+            return True
+        return False
+
+    def __add_role_to_session(self, application_role, experiment_name=None, instrument=None):
+        """
+        Remember that this user has this application role for this experiment/instrument in this session.
         """
-        session_app_roles = session.get(self.session_roles_name, {})
+        session_roles = SessionRoles.load(session.get(self.session_roles_name, None), self.application_name)
+        session_roles.add(application_role, scope_for(experiment_name, instrument))
+        session[self.session_roles_name] = session_roles.dump()
 
-    def __authorize_slac_user_for_experiment(self, application_role, experiment_name=None, instrument=None):
+    def __authorize_slac_user_for_experiment(self, user_id, application_role, experiment_name=None, instrument=None):
         """
         Check if SLAC user has the appropriate role in self.application.
         :param application_role: Application role in self.application needed to perform this task
         :param experiment_name: Optional; is this request within the context of an experiment.
         If so, this is the primary key in the regdb database to the experiment.
+        The caller has already checked the session.
         :return:
         """
-        user_id = self.get_current_user_id()
         role_fq_name = self.application_name + "/" + application_role
-        session_app_roles = session.get(self.session_roles_name, {})
-        if role_fq_name in session_app_roles:
-            logger.info("Found fq_name %s in session for user %s" % (role_fq_name, user_id))
-            if experiment_name:
-                if experiment_name in session_app_roles[role_fq_name]:
-                    logger.info("Found experiment %s for application role %s in session for user %s" % (experiment_name, role_fq_name, user_id))
-                    return True
-            elif instrument:
-                if instrument in session_app_roles[role_fq_name]:
-                    logger.info("Found instrument %s for application role %s in session for user %s" % (instrument, role_fq_name, user_id))
-                    return True
-            else:
-                # Caller did not specify experiment; so we make sure that there are is an __ALL__ experiment in the list of experiments
-                if "__ALL__" in session_app_roles[role_fq_name]:
-                    logger.info("Caller did not specify experiment but we found __ALL__ for fq_name %s in session for user %s" % (role_fq_name, user_id))
-                    return True
-
-        if self.roles_dal.has_slac_user_role(user_id,
-                                                 self.application_name,
-                                                 application_role,
-                                                 experiment_name,
-                                                 instrument):
+        with trace_span("dal", "has_slac_user_role", role=application_role):
+            has_role = self.roles_dal.has_slac_user_role(user_id, self.application_name, application_role, experiment_name, instrument)
+        if has_role:
             # Add an entry in the session.
-            logger.info("Found application role %s for experiment %s in db for user %s" % (role_fq_name, experiment_name, user_id))
-            if role_fq_name not in session_app_roles:
-                session_app_roles[role_fq_name] = []
-            if experiment_name and experiment_name not in session_app_roles[role_fq_name]:
-                session_app_roles[role_fq_name].append(experiment_name)
-            elif instrument and instrument not in session_app_roles[role_fq_name]:
-                session_app_roles[role_fq_name].append(instrument)
-            if not experiment_name and not instrument:
-                session_app_roles[role_fq_name].append("__ALL__")
-            session[self.session_roles_name] = session_app_roles
+            logger.info("Found application role %s for experiment %s in db for user %s", role_fq_name, experiment_name, user_id)
+            self.__add_role_to_session(application_role, experiment_name, instrument)
             return True
         else:
-            logger.info("Did not find application role %s for experiment %s instrument %s in db for user %s" % (role_fq_name, experiment_name, instrument, user_id))
+            logger.info("Did not find application role %s for experiment %s instrument %s in db for user %s", role_fq_name, experiment_name, instrument, user_id)
             return False
-
-        return False
@@ -0,0 +1,371 @@
+import re
+import io
+import os
+import queue
+import base64
+import logging
+import subprocess
+from itertools import islice
+from collections import OrderedDict
+from threading import Lock
+
+from .metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+ldapsearchCommand = os.environ.get("FLASK_AUTHNZ_LDAPSEARCH_COMMAND", "ldapsearch -x").split()
+ldap_pool_size = int(os.environ.get("FLASK_AUTHNZ_LDAP_POOL_SIZE", "4"))
+ldap_timeout = int(os.environ.get("FLASK_AUTHNZ_LDAP_TIMEOUT", "10"))
+# Searches without a limit are paged so that they are not cut off at the server's size limit (500 by default in OpenLDAP); 0 turns this off.
+ldap_page_size = int(os.environ.get("FLASK_AUTHNZ_LDAP_PAGE_SIZE", "500"))
+# ldapsearch exits with this when the results were cut off at the size limit.
+LDAP_SIZELIMIT_EXCEEDED = 4
+PAGED_RESULTS_CONTROL = "1.2.840.113556.1.4.319"
+
+
+class LDAPSizeLimitError(ValueError):
+    """
+    Raised when a search without a limit was cut off at the server's size limit; the results would otherwise be silently incomplete.
+    """
+    pass
+
+
+def read_ldap_conf(path=None):
+    """
+    Read the URI and BASE from the OpenLDAP client configuration; this is what ldapsearch uses.
+    :param path: Path to ldap.conf; defaults to $LDAPCONF or /etc/openldap/ldap.conf
+    :return: A dict with the (uppercased) option names and their values.
+    """
+    path = path or os.environ.get("LDAPCONF", "/etc/openldap/ldap.conf")
+    ret = {}
+    if not os.path.exists(path):
+        return ret
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.strip().split(None, 1)
+            if len(parts) == 2 and not parts[0].startswith("#"):
+                ret[parts[0].upper()] = parts[1].strip()
+    return ret
+
+
+ldif_attr_line_re = re.compile(r"^([A-Za-z][\w;.-]*)(::|:<|:)\s*(.*)$")
+
+
+def iter_ldif_entries(lines):
+    """
+    Parse LDIF (as output by ldapsearch) one line at a time and yield one dict per entry.
+    Lines starting with a single space continue the previous line; values for name:: value are base64 encoded.
+    Single valued attributes are strings; attributes with multiple values are lists.
+    :param lines: An iterable of lines; for example, a file like object.
+    """
+    current_obj = OrderedDict()
+    logical_line = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.startswith(" "):
+            if logical_line is not None:
+                logical_line += line[1:]
+            continue
+        if logical_line is not None:
+            _add_ldif_line(current_obj, logical_line)
+            logical_line = None
+        if line.startswith("#"):
+            # Comments can be continued as well; we skip these by leaving logical_line as None.
+            continue
+        if not line.strip():
+            if current_obj and 'dn' in current_obj:
+                yield current_obj
+            current_obj = OrderedDict()
+            continue
+        logical_line = line
+    if logical_line is not None:
+        _add_ldif_line(current_obj, logical_line)
+    if current_obj and 'dn' in current_obj:
+        yield current_obj
+
+
+def _add_ldif_line(current_obj, line):
+    nvm = ldif_attr_line_re.match(line)
+    if not nvm:
+        logger.error("Not matching a line in LDAP response %s", line)
+        return
+    name, separator, value = nvm.group(1), nvm.group(2), nvm.group(3).strip()
+    if separator == "::":
+        value = base64.b64decode(value)
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    if name in current_obj:
+        if isinstance(current_obj[name], list):
+            current_obj[name].append(value)
+        else:
+            current_obj[name] = [current_obj[name], value]
+    else:
+        current_obj[name] = value
+
+
+def parse_ldapsearch_response(response):
+    """
+    LDAPSearch responses are <name>: <value>, one per line with # as comment and blank lines to separate each object.
+    This method parses such a response and returns an array of dicts.
+    """
+    return list(iter_ldif_entries(response.split("\n")))
+
+
+class SubprocessLDAPBackend(object):
+    """
+    Search LDAP by running ldapsearch; one process per query.
+    The command defaults to FLASK_AUTHNZ_LDAPSEARCH_COMMAND (ldapsearch -x).
+    Searches without a limit use the simple paged results control (-E pr=...); if these are still cut off at the size limit, we raise a LDAPSizeLimitError.
+    """
+
+    def __init__(self, command=None, page_size=None):
+        """
+        :param command: The ldapsearch command as a list.
+        :param page_size: Page size for searches without a limit; defaults to FLASK_AUTHNZ_LDAP_PAGE_SIZE; 0 turns off paging.
+        """
+        self.command = command or ldapsearchCommand
+        self.page_size = page_size if page_size is not None else ldap_page_size
+        self.spawns = get_registry().counter("flask_authnz_ldap_subprocess_spawns_total", "Number of ldapsearch processes started")
+
+    def search(self, filterstr, attributes, limit=None):
+        """
+        Search LDAP.
+        :param filterstr: LDAP filter, for example (&(objectclass=posixGroup)(cn=ps-data))
+        :param attributes: List of attributes to return.
+        :param limit: Optional; stop after these many entries.
+        :return: List of dicts, one per entry. Single valued attributes are strings; multi valued attributes are lists.
+        """
+        entries = self.iter_search(filterstr, attributes, limit)
+        try:
+            return list(islice(entries, limit))
+        finally:
+            entries.close()
+
+    def iter_search(self, filterstr, attributes, limit=None):
+        """
+        Search LDAP and yield the entries as ldapsearch writes them out.
+        If the caller stops early, the ldapsearch process is terminated.
+        :param limit: Optional; ask the server to stop after these many entries.
+        If there is no limit and the server cuts off the results at its size limit, we raise a LDAPSizeLimitError once the entries we did get have been yielded.
+        """
+        if limit:
+            options = ["-z", str(limit)]
+        else:
+            options = ["-E", "pr={0}/noprompt".format(self.page_size)] if self.page_size else []
+        query = self.command + options + [filterstr] + list(attributes)
+        logger.debug("Running LDAP query %s", query)
+        self.spawns.inc()
+        try:
+            proc = subprocess.Popen(query, stdout=subprocess.PIPE)
+        except Exception as e:
+            raise ValueError("Error while trying to run LDAP query: '%s'\n%s" % (query, e))
+        # Closing the wrapper closes proc.stdout as well.
+        stdout = io.TextIOWrapper(proc.stdout, encoding="utf-8")
+        completed = False
+        try:
+            for entry in iter_ldif_entries(stdout):
+                yield entry
+            completed = True
+        except Exception as e:
+            raise ValueError("Error while trying to run LDAP query: '%s'\n%s" % (query, e))
+        finally:
+            # If the caller stopped early, ldapsearch may still be writing out entries.
+            if not completed and proc.poll() is None:
+                proc.kill()
+            stdout.close()
+            proc.wait()
+        if not limit and proc.returncode == LDAP_SIZELIMIT_EXCEEDED:
+            raise LDAPSizeLimitError("LDAP query '%s' was cut off at the server's size limit" % (query,))
+
+    def search_LDAP(self, query):
+        try:
+            logger.debug("Running LDAP query %s", query)
+            self.spawns.inc()
+            response =  subprocess.run(query, check=False, stdout=subprocess.PIPE).stdout.decode("utf-8")
+            return parse_ldapsearch_response(response)
+        except Exception as e:
+            raise ValueError("Error while trying to run LDAP query: '%s'\n%s" % (query, e))
+
+
+class PooledLDAPBackend(object):
+    """
+    Search LDAP using a small pool of persistent, already bound, ldap3 connections.
+    This avoids a fork/exec, a TCP connect and a bind for each query.
+    The server and search base default to FLASK_AUTHNZ_LDAP_URI/FLASK_AUTHNZ_LDAP_BASE and then to the URI/BASE in ldap.conf.
+    If the directory cannot be reached, queries are passed on to the fallback backend, if any.
+    Searches without a limit use the simple paged results control; if these are still cut off at the size limit, we raise a LDAPSizeLimitError.
+    """
+
+    def __init__(self, uri=None, base=None, bind_dn=None, bind_password=None, pool_size=None, timeout=None, connection_factory=None, fallback=None, page_size=None):
+        """
+        :param uri: LDAP server URI(s), space separated.
+        :param base: Search base.
+        :param bind_dn: Optional; bind DN. We do an anonymous bind if this is not specified.
+        :param bind_password: Optional; password for the bind DN.
+        :param pool_size: Maximum number of connections to keep open; defaults to FLASK_AUTHNZ_LDAP_POOL_SIZE.
+        :param timeout: Connect/receive timeout in seconds; defaults to FLASK_AUTHNZ_LDAP_TIMEOUT.
+        :param connection_factory: Optional; a callable that returns a bound ldap3 Connection. Mostly for testing.
+        :param fallback: Optional; backend to use if we cannot talk to LDAP, typically a SubprocessLDAPBackend.
+        :param page_size: Page size for searches without a limit; defaults to FLASK_AUTHNZ_LDAP_PAGE_SIZE; 0 turns off paging.
+        """
+        ldap_conf = read_ldap_conf()
+        self.uri = uri or os.environ.get("FLASK_AUTHNZ_LDAP_URI", ldap_conf.get("URI", None))
+        self.base = base or os.environ.get("FLASK_AUTHNZ_LDAP_BASE", ldap_conf.get("BASE", ""))
+        self.bind_dn = bind_dn or os.environ.get("FLASK_AUTHNZ_LDAP_BIND_DN", None)
+        self.bind_password = bind_password or os.environ.get("FLASK_AUTHNZ_LDAP_BIND_PASSWORD", None)
+        self.pool_size = pool_size or ldap_pool_size
+        self.timeout = timeout or ldap_timeout
+        self.connection_factory = connection_factory or self._connect
+        self.fallback = fallback
+        self.page_size = page_size if page_size is not None else ldap_page_size
+        if not self.uri and not connection_factory:
+            raise ValueError("Please specify a LDAP URI using FLASK_AUTHNZ_LDAP_URI")
+        self.pool = queue.LifoQueue()
+        self.connections_created = 0
+        self.pool_lock = Lock()
+        self.connections_opened = get_registry().counter("flask_authnz_ldap_connections_opened_total", "Number of pooled LDAP connections opened")
+        self.fallbacks = get_registry().counter("flask_authnz_ldap_fallbacks_total", "Number of LDAP queries passed on to the fallback backend")
+
+    def _connect(self):
+        import ldap3
+        servers = [ldap3.Server(x, connect_timeout=self.timeout, get_info=ldap3.NONE) for x in self.uri.split()]
+        server = servers[0] if len(servers) == 1 else ldap3.ServerPool(servers, ldap3.FIRST, active=1)
+        return ldap3.Connection(server,
+                                user=self.bind_dn,
+                                password=self.bind_password,
+                                auto_bind=True,
+                                read_only=True,
+                                receive_timeout=self.timeout,
+                                raise_exceptions=True)
+
+    def _acquire(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.pool_lock:
+            if self.connections_created < self.pool_size:
+                self.connections_created += 1
+                create = True
+            else:
+                create = False
+        if not create:
+            try:
+                return self.pool.get(timeout=self.timeout)
+            except queue.Empty:
+                raise ValueError("Timed out waiting for a LDAP connection from the pool")
+        try:
+            logger.debug("Opening a new LDAP connection to %s", self.uri)
+            self.connections_opened.inc()
+            return self.connection_factory()
+        except Exception:
+            with self.pool_lock:
+                self.connections_created -= 1
+            raise
+
+    def _release(self, conn):
+        self.pool.put(conn)
+
+    def _discard(self, conn):
+        with self.pool_lock:
+            self.connections_created -= 1
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def search(self, filterstr, attributes, limit=None):
+        """
+        Search LDAP.
+        :param filterstr: LDAP filter, for example (&(objectclass=posixGroup)(cn=ps-data))
+        :param attributes: List of attributes to return.
+        :param limit: Optional; ask the server to stop after these many entries.
+        :return: List of dicts, one per entry. Single valued attributes are strings; multi valued attributes are lists.
+        """
+        try:
+            return self._search(filterstr, attributes, limit)
+        except LDAPSizeLimitError:
+            # The fallback is subject to the same size limit; falling back would only hide this.
+            raise
+        except Exception as e:
+            if self.fallback:
+                logger.warning("Error searching LDAP using pooled connections; falling back. %s", e)
+                self.fallbacks.inc()
+                return self.fallback.search(filterstr, attributes, limit)
+            raise ValueError("Error while trying to run LDAP query: '%s'\n%s" % (filterstr, e))
+
+    def iter_search(self, filterstr, attributes, limit=None):
+        """
+        Search LDAP and yield the entries one at a time.
+        """
+        for entry in self.search(filterstr, attributes, limit):
+            yield entry
+
+    def _search(self, filterstr, attributes, limit=None):
+        logger.debug("Running pooled LDAP query %s %s", filterstr, attributes)
+        from ldap3.core.exceptions import LDAPSizeLimitExceededResult
+        conn = self._acquire()
+        try:
+            entries = []
+            cookie = None
+            while True:
+                try:
+                    if limit or not self.page_size:
+                        conn.search(self.base, filterstr, attributes=list(attributes), size_limit=limit or 0)
+                    else:
+                        conn.search(self.base, filterstr, attributes=list(attributes), paged_size=self.page_size, paged_cookie=cookie)
+                except LDAPSizeLimitExceededResult:
+                    if not limit:
+                        raise LDAPSizeLimitError("LDAP query '%s' was cut off at the server's size limit" % filterstr)
+                    # We asked for at most limit entries; the entries we did get are in the response.
+                entries.extend([self._to_dict(x) for x in conn.response if x.get("type", None) == "searchResEntry"])
+                if limit or not self.page_size:
+                    break
+                cookie = conn.result.get("controls", {}).get(PAGED_RESULTS_CONTROL, {}).get("value", {}).get("cookie", None)
+                if not cookie:
+                    break
+        except Exception:
+            self._discard(conn)
+            raise
+        self._release(conn)
+        return entries
+
+    @staticmethod
+    def _to_dict(entry):
+        ret = OrderedDict()
+        ret["dn"] = entry["dn"]
+        for name, values in entry.get("raw_attributes", {}).items():
+            values = [x.decode("utf-8") if isinstance(x, bytes) else str(x) for x in values]
+            if not values:
+                continue
+            ret[name] = values[0] if len(values) == 1 else values
+        return ret
+
+    def close(self):
+        """
+        Close all the pooled connections.
+        """
+        while True:
+            try:
+                self._discard(self.pool.get_nowait())
+            except queue.Empty:
+                break
+
+
+def make_ldap_backend():
+    """
+    Make the LDAP backend configured using FLASK_AUTHNZ_LDAP_BACKEND; one of subprocess (the default) or pooled.
+    The pooled backend needs the ldap3 package; we fall back to the subprocess backend if ldap3 is not available.
+    """
+    backend_name = os.environ.get("FLASK_AUTHNZ_LDAP_BACKEND", "subprocess")
+    if backend_name == "pooled":
+        try:
+            import ldap3
+            return PooledLDAPBackend(fallback=SubprocessLDAPBackend())
+        except ImportError:
+            logger.warning("The pooled LDAP backend needs the ldap3 package; using ldapsearch instead")
+    elif backend_name != "subprocess":
+        raise ValueError("Unknown LDAP backend %s" % backend_name)
+    return SubprocessLDAPBackend()
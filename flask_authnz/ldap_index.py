@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+
+from .metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPSnapshotIndex(object):
+    """
+    Base class for the in-memory indexes that are loaded from LDAP using bulk searches; see GroupMembershipIndex and DirectoryIndex.
+    Subclasses implement refresh() (which builds a new snapshot off to the side and then swaps it in) and size().
+    Snapshots are namedtuples with a loaded_at; snapshots older than max_age are not used and callers then fall back to LDAP.
+    If a refresh fails (for example, if the bulk search is cut off at the server's size limit), we keep the previous snapshot.
+    """
+
+    # Used for the name of the refresher thread and in the log messages.
+    index_name = "ldap_index"
+    description = "LDAP"
+
+    def __init__(self, backend, refresh_interval, max_age=None):
+        """
+        :param backend: The LDAP backend to use for the bulk searches.
+        :param refresh_interval: Refresh the snapshot every so many seconds.
+        :param max_age: Do not use snapshots older than this; defaults to three times the refresh interval.
+        """
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age or 3*self.refresh_interval
+        self.snapshot = None
+        self.refresher = None
+        self.refresher_stop = threading.Event()
+        self.ldap_latency = get_registry().histogram("flask_authnz_ldap_query_seconds", "Time taken for LDAP queries by query type", ["query"])
+
+    def refresh(self):
+        raise NotImplementedError()
+
+    def size(self):
+        raise NotImplementedError()
+
+    def current_snapshot(self):
+        """
+        :return: The current snapshot; None if we do not have one or if it is too old.
+        """
+        snapshot = self.snapshot
+        if snapshot is None or time.time() - snapshot.loaded_at > self.max_age:
+            return None
+        return snapshot
+
+    def age(self):
+        """
+        :return: Age of the current snapshot in seconds; None if we have not loaded one yet.
+        """
+        snapshot = self.snapshot
+        return time.time() - snapshot.loaded_at if snapshot else None
+
+    def start_refresher(self):
+        """
+        Start a background thread that refreshes the snapshot every refresh_interval seconds.
+        """
+        if self.refresher and self.refresher.is_alive():
+            return
+        self.refresher_stop.clear()
+        self.refresher = threading.Thread(target=self.__refresh_periodically, name="flask_authnz_%s_refresher" % self.index_name, daemon=True)
+        self.refresher.start()
+
+    def stop_refresher(self):
+        self.refresher_stop.set()
+        if self.refresher:
+            self.refresher.join()
+        self.refresher = None
+
+    def __refresh_periodically(self):
+        while not self.refresher_stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Exception refreshing the %s snapshot; continuing to use the previous snapshot", self.description)
@@ -0,0 +1,294 @@
+import os
+import time
+import bisect
+import logging
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Set FLASK_AUTHNZ_METRICS to 0 to turn off all the instrumentation.
+metrics_enabled = os.environ.get("FLASK_AUTHNZ_METRICS", "1") not in ("0", "false", "False")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric(object):
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        # Tuple of label values -> value
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError("Metric %s has labels %s; got %s" % (self.name, self.labelnames, sorted(labels.keys())))
+        return tuple([str(labels[x]) for x in self.labelnames])
+
+    def samples(self):
+        """
+        :return: A list of (suffix, labels dict, value).
+        """
+        with self.lock:
+            return [("", dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up; for example, the number of decisions answered from the session.
+    """
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down; for example, the number of entries in a cache.
+    Use set_function to compute the value when the metrics are collected.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, fn, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.functions[key] = fn
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                logger.exception("Exception computing the value of %s", self.name)
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    """
+    Counts observations (for example, query latencies in seconds) in buckets; we also keep the sum and the count.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key, None)
+            if entry is None:
+                # Counts per bucket (the last one is +Inf), sum, count
+                entry = [[0]*(len(self.buckets)+1), 0.0, 0]
+                self.values[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the time taken by the body of the with statement.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels):
+        with self.lock:
+            entry = self.values.get(self._key(labels), None)
+            return entry[2] if entry else 0
+
+    def samples(self):
+        ret = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    ret.append(("_bucket", dict(labels, le="+Inf" if bound == float("inf") else repr(bound)), cumulative))
+                ret.append(("_sum", labels, total))
+                ret.append(("_count", labels, count))
+        return ret
+
+
+class MetricsRegistry(object):
+    """
+    Holds all the metrics; metrics are created on first use and shared after that.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError("Metric %s is already registered as a %s with labels %s" % (name, metric.type_name, metric.labelnames))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        with self.lock:
+            return self.metrics.get(name, None)
+
+    def collect(self):
+        """
+        :return: All the metrics, sorted by name.
+        """
+        with self.lock:
+            return [self.metrics[x] for x in sorted(self.metrics.keys())]
+
+
+class _NullMetric(object):
+    def inc(self, amount=1, **labels):
+        pass
+
+    def set(self, value, **labels):
+        pass
+
+    def set_function(self, fn, **labels):
+        pass
+
+    def observe(self, value, **labels):
+        pass
+
+    def time(self, **labels):
+        return nullcontext()
+
+
+class NullRegistry(object):
+    """
+    A registry that records nothing; used when FLASK_AUTHNZ_METRICS is 0.
+    """
+    null_metric = _NullMetric()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.null_metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.null_metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.null_metric
+
+    def get(self, name):
+        return None
+
+    def collect(self):
+        return []
+
+
+registry = MetricsRegistry() if metrics_enabled else NullRegistry()
+
+
+def get_registry():
+    """
+    :return: The registry used by FlaskAuthnz, MongoDBRoles, UserGroups and the caches.
+    """
+    return registry
+
+
+def set_registry(new_registry):
+    """
+    Plug in a different registry; this should be done before any of the FlaskAuthnz/MongoDBRoles/UserGroups objects are created.
+    Any object with the counter, gauge and histogram methods of MetricsRegistry can be used; for example, an adapter to prometheus_client.
+    """
+    global registry
+    registry = new_registry
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def to_prometheus_text(metrics_registry=None):
+    """
+    Render all the metrics in the Prometheus text exposition format.
+    :param metrics_registry: Optional; defaults to the current registry.
+    """
+    lines = []
+    for metric in (metrics_registry or registry).collect():
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE %s %s" % (metric.name, metric.type_name))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                label_str = "{" + ",".join(['%s="%s"' % (k, _escape_label_value(v)) for k, v in labels.items()]) + "}"
+            else:
+                label_str = ""
+            lines.append("%s%s%s %s" % (metric.name, suffix, label_str, _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(metrics_registry=None):
+    """
+    Make a Flask view function that serves the metrics in the Prometheus text format; for example,
+    app.add_url_rule("/metrics", view_func=metrics_view())
+    """
+    from flask import Response
+
+    def flask_authnz_metrics():
+        return Response(to_prometheus_text(metrics_registry), mimetype="text/plain; version=0.0.4")
+    return flask_authnz_metrics
+
+
+def register_cache_metrics(cache_name, stats_fn):
+    """
+    Report the size and evictions of a cache; stats_fn returns a dict with the size and evictions, like the stats() of the cache backends.
+    """
+    get_registry().gauge("flask_authnz_cache_entries", "Number of entries in the cache", ["cache"]).set_function(lambda: stats_fn()["size"], cache=cache_name)
+    get_registry().gauge("flask_authnz_cache_evictions", "Number of entries evicted from the cache to make space", ["cache"]).set_function(lambda: stats_fn()["evictions"], cache=cache_name)
+
+
+def cache_requests():
+    """
+    :return: The counter of cache lookups by cache and result (hit, miss or stale).
+    """
+    return get_registry().counter("flask_authnz_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"])
@@ -0,0 +1,119 @@
+"""
+Create and check the indexes that the role queries depend on.
+The role queries look up roles by {"app": ..., "name": {"$in": [...]}} in the roles collection of the site database and of each experiment database.
+Without a compound {app, name} index, each of these is a collection scan.
+To run this against a deployment, use
+python -m flask_authnz.mongo_indexes mongodb://... --app LogBook --role Reader --role Editor [--rolesdb site] [--verify-only]
+The role queries are explained using the application name and role names given here; use the ones that your application checks.
+"""
+import sys
+import logging
+import argparse
+
+from .authz_index import SYSTEM_DATABASES
+
+logger = logging.getLogger(__name__)
+
+ROLES_INDEX_KEYS = [("app", 1), ("name", 1)]
+ROLES_INDEX_NAME = "app_1_name_1"
+
+
+def roles_databases(mongoclient, rolesdbname="site"):
+    """
+    :return: The names of all the databases that have a roles collection; the roles database comes first.
+    """
+    dbnames = [rolesdbname]
+    for dbname in sorted(mongoclient.list_database_names()):
+        if dbname == rolesdbname or dbname in SYSTEM_DATABASES:
+            continue
+        if "roles" in mongoclient[dbname].list_collection_names():
+            dbnames.append(dbname)
+    return dbnames
+
+
+def has_roles_index(collection):
+    """
+    :return: True if the collection has an index that starts with the {app, name} keys.
+    """
+    for index in collection.index_information().values():
+        if [(k, int(v)) for k, v in index["key"]][:len(ROLES_INDEX_KEYS)] == ROLES_INDEX_KEYS:
+            return True
+    return False
+
+
+def ensure_indexes(mongoclient, rolesdbname="site"):
+    """
+    Create the compound {app, name} index on every roles collection that does not have one.
+    :return: The names of the databases where we created the index.
+    """
+    created = []
+    for dbname in roles_databases(mongoclient, rolesdbname):
+        collection = mongoclient[dbname]["roles"]
+        if has_roles_index(collection):
+            continue
+        logger.info("Creating the %s index on %s.roles", ROLES_INDEX_NAME, dbname)
+        collection.create_index(ROLES_INDEX_KEYS, name=ROLES_INDEX_NAME)
+        created.append(dbname)
+    return created
+
+
+def plan_stages(plan):
+    """
+    :return: All the stages in an explain plan; this walks the inputStage(s), the SBE queryPlan and the shards.
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def verify_indexes(mongoclient, rolesdbname, application_name, role_names):
+    """
+    Check that every roles collection has the {app, name} index and that the server uses it for the role queries.
+    :param rolesdbname: The database with the site roles.
+    :param application_name: The application name used in the role queries; for example, LogBook.
+    :param role_names: The role names used in the role queries; for example, ["Reader", "Editor"].
+    :return: A dict of database name -> {"has_index": bool, "stages": [stages in the winning plan], "collection_scan": bool}
+    """
+    role_query = {"app": application_name, "name": {"$in": list(role_names)}}
+    report = {}
+    for dbname in roles_databases(mongoclient, rolesdbname):
+        explain = mongoclient[dbname].command({"explain": {"find": "roles", "filter": role_query, "projection": {"_id": 0, "name": 1, "players": 1}}, "verbosity": "queryPlanner"})
+        stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        report[dbname] = {"has_index": has_roles_index(mongoclient[dbname]["roles"]), "stages": stages, "collection_scan": "COLLSCAN" in stages}
+        if report[dbname]["collection_scan"]:
+            logger.warning("Role queries on %s.roles are collection scans", dbname)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and check the {app, name} indexes on all the roles collections")
+    parser.add_argument("url", help="The MongoDB connection URL")
+    parser.add_argument("--app", required=True, help="The application name to use when checking the role queries; for example, LogBook")
+    parser.add_argument("--role", action="append", required=True, help="A role name to use when checking the role queries; for example, Reader. Repeat for more roles")
+    parser.add_argument("--rolesdb", default="site", help="The database with the site roles")
+    parser.add_argument("--verify-only", action="store_true", help="Do not create missing indexes; only report on them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from pymongo import MongoClient
+    mongoclient = MongoClient(args.url)
+    if not args.verify_only:
+        created = ensure_indexes(mongoclient, args.rolesdb)
+        print("Created the {0} index in {1} databases".format(ROLES_INDEX_NAME, len(created)))
+    report = verify_indexes(mongoclient, args.rolesdb, args.app, args.role)
+    problems = {k: v for k, v in report.items() if v["collection_scan"] or not v["has_index"]}
+    for dbname, result in sorted(problems.items()):
+        print("{0}.roles: index {1}, plan {2}".format(dbname, "present" if result["has_index"] else "missing", " <- ".join(result["stages"])))
+    print("Checked {0} roles collections; {1} with problems".format(len(report), len(problems)))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
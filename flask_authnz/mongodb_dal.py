@@ -1,9 +1,24 @@
+import os
 import logging
+from threading import RLock, Thread
+from concurrent.futures import ThreadPoolExecutor
 from cachetools import TTLCache
 import json
 
+from .authz_index import AuthorizationIndex
+from .mongo_indexes import ensure_indexes, verify_indexes
+from .metrics import get_registry, cache_requests
+from .tracing import trace_span
+
 logger = logging.getLogger(__name__)
 
+scope_cache_time_in_seconds = int(os.environ.get("FLASK_AUTHNZ_SCOPE_CACHE_TIME", "300"))
+scope_cache_size = int(os.environ.get("FLASK_AUTHNZ_SCOPE_CACHE_SIZE", "4096"))
+# Maximum number of concurrent queries when checking many experiments at once.
+bulk_query_concurrency = int(os.environ.get("FLASK_AUTHNZ_BULK_QUERY_CONCURRENCY", "8"))
+# If set, authorize using an in-memory index over all the roles collections; this is rebuilt every so many seconds.
+authorization_index_refresh_interval = int(os.environ.get("FLASK_AUTHNZ_AUTHZ_INDEX_REFRESH", "0"))
+
 
 class MongoDBRoles(object):
     """
@@ -16,14 +31,47 @@ class MongoDBRoles(object):
     """
 
 
-    def __init__(self, mongoclient, usergroupsgetter, rolesdbname="site"):
+    def __init__(self, mongoclient, usergroupsgetter, rolesdbname="site", scope_cache_time=None, authorization_index_refresh=None):
         """
         :param mongoclient: The PyMongo client to use.
+        :param scope_cache_time: How long (in seconds) to cache the experiment restricted flags and instrument roles; defaults to FLASK_AUTHNZ_SCOPE_CACHE_TIME.
+        :param authorization_index_refresh: If set, build an in-memory authorization index and rebuild it every so many seconds; defaults to FLASK_AUTHNZ_AUTHZ_INDEX_REFRESH.
         :return:
         """
         self.mongoclient = mongoclient
         self.usergroupsgetter = usergroupsgetter
         self.rolesdbname = rolesdbname
+        scope_cache_time = scope_cache_time if scope_cache_time is not None else scope_cache_time_in_seconds
+        # Experiment name -> is_restricted
+        self.restricted_cache = TTLCache(scope_cache_size, scope_cache_time)
+        # Instrument name -> { application name -> { role name -> frozenset of players } }
+        self.instrument_roles_cache = TTLCache(scope_cache_size, scope_cache_time)
+        self.scope_cache_lock = RLock()
+        self.bulk_query_executor = None
+        self.authorization_index = None
+        self.query_latency = get_registry().histogram("flask_authnz_mongo_query_seconds", "Time taken for MongoDB queries by query type", ["query"])
+        self.cache_requests = cache_requests()
+        cache_entries = get_registry().gauge("flask_authnz_cache_entries", "Number of entries in the cache", ["cache"])
+        cache_entries.set_function(lambda: len(self.restricted_cache), cache="experiment_restricted")
+        cache_entries.set_function(lambda: len(self.instrument_roles_cache), cache="instrument_roles")
+        authorization_index_refresh = authorization_index_refresh if authorization_index_refresh is not None else authorization_index_refresh_interval
+        if authorization_index_refresh:
+            self.enable_authorization_index(authorization_index_refresh)
+
+    def enable_authorization_index(self, refresh_interval=None, use_change_stream=False):
+        """
+        Build an in-memory index over all the roles collections and use it for authorization from now on.
+        Once this is built, role checks do not query the database.
+        :param refresh_interval: Optional; rebuild the index every so many seconds.
+        :param use_change_stream: Also refresh the index as the roles change; this needs a replica set.
+        :return: The AuthorizationIndex; use this to refresh the index or to get its stats.
+        """
+        authorization_index = AuthorizationIndex(self.mongoclient, self.rolesdbname)
+        authorization_index.build()
+        self.authorization_index = authorization_index
+        if refresh_interval:
+            authorization_index.start_refresher(refresh_interval, use_change_stream)
+        return authorization_index
 
     def getPrivilegesForApplicationRoles(self, application_name):
         """
@@ -34,7 +82,7 @@ class MongoDBRoles(object):
         """
         # Privileges are stored in the roles database
         priv2roles = {}
-        for role in self.mongoclient[self.rolesdbname]["roles"].find({"app": application_name}):
+        for role in self._find("privileges", self.rolesdbname, "roles", {"app": application_name}, {"_id": 0, "name": 1, "privileges": 1}):
             role_name = role["name"]
             privileges = role.get("privileges", [])
             for privilege in privileges:
@@ -43,6 +91,29 @@ class MongoDBRoles(object):
                 priv2roles[privilege].add(role_name)
         return priv2roles
 
+    def ensure_indexes(self):
+        """
+        Create the compound {app, name} index on the roles collection in the roles database and in every experiment database that does not have one.
+        :return: The names of the databases where we created the index.
+        """
+        return ensure_indexes(self.mongoclient, self.rolesdbname)
+
+    def verify_indexes(self, application_name, role_names):
+        """
+        Explain the role query for these roles in every roles collection and report on the plans.
+        :return: A dict of database name -> {"has_index": bool, "stages": [stages in the winning plan], "collection_scan": bool}
+        """
+        return verify_indexes(self.mongoclient, self.rolesdbname, application_name, role_names)
+
+    def watch_roles(self, max_await_time_ms=None):
+        """
+        Open a change stream on the roles collection in the roles database.
+        This needs a replica set; use this as a context manager.
+        :param max_await_time_ms: How long the server waits for changes on each try_next.
+        :return: A pymongo change stream.
+        """
+        return self.mongoclient[self.rolesdbname]["roles"].watch(max_await_time_ms=max_await_time_ms)
+
     def has_slac_user_role(self, user_id, application_name, role_name, experiment_name=None, instrument=None):
         """
         Check if SLAC user has the appropriate role in the application.
@@ -53,70 +124,296 @@ class MongoDBRoles(object):
         :param instrument: The instrument for this experiment; can be used for instrument level roles.
         :return:
         """
-        is_restricted = False
-        if experiment_name:
-            exp_info = self.mongoclient[experiment_name]["info"].find_one({})
-            if exp_info:
-                is_restricted = json.loads(exp_info.get("params", {}).get("is_restricted", "False").lower())
+        return self.has_any_slac_user_role(user_id, application_name, [role_name], experiment_name, instrument) is not None
+
+    def has_any_slac_user_role(self, user_id, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Check if SLAC user has any of these roles in the application.
+        The players for all the roles are fetched in one query per collection and the user's groups are looked up at most once.
+        :param user_id: User id to verify.
+        :param application_name: Application name.
+        :param role_names: Role names to check; these are checked in this order.
+        :param experiment_name: This is optional; in which case only the global roles apply.
+        :param instrument: The instrument for this experiment; can be used for instrument level roles.
+        :return: The name of the first role that the user has; None if the user has none of these roles.
+        """
+        role_names = list(role_names)
+        role_players = self.get_role_players(application_name, role_names, experiment_name, instrument)
+
+        # Check if the user is directly mentioned in the database.
+        for role_name in role_names:
+            if "uid:"+user_id in role_players[role_name]:
+                logger.info("User_id='%s' directly has role '%s' in application '%s' for experiment '%s'.", user_id, role_name, application_name, experiment_name)
+                return role_name
+
+        authorized_groups = set([x for players in role_players.values() for x in players if not x.startswith("uid:")])
+
+        # There are no role groups for this application.
+        if not authorized_groups:
+            logger.debug("User_id='%s' is not authorized for roles '%s' on application '%s'. "
+                          "No authorized groups for these roles either.", user_id, role_names, application_name)
+            return None
+
+        logger.debug("These groups '%s' are authorized for roles '%s' in application '%s' for experiment '%s'.", authorized_groups, role_names, application_name, experiment_name)
+
+        user_groups = self._get_user_groups(user_id)
+
+        # Check if the user is in any posix group specified on the application.
+        for role_name in role_names:
+            if user_groups & role_players[role_name]:
+                return role_name
+        return None
+
+    def get_slac_user_roles(self, user_id, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Get all the roles (out of these roles) that the SLAC user has in the application.
+        Like has_any_slac_user_role, the players are fetched in one query per collection and the user's groups are looked up at most once.
+        :param user_id: User id to verify.
+        :param application_name: Application name.
+        :param role_names: Role names to check.
+        :param experiment_name: This is optional; in which case only the global roles apply.
+        :param instrument: The instrument for this experiment; can be used for instrument level roles.
+        :return: The set of role names that the user has.
+        """
+        if self.authorization_index is not None:
+            user_players = set(["uid:"+user_id]) | self._get_user_groups(user_id)
+            return self.authorization_index.get_roles_for_players(user_players, application_name, role_names, experiment_name, instrument)
+        role_players = self.get_role_players(application_name, role_names, experiment_name, instrument)
+        user_roles = set([role_name for role_name, players in role_players.items() if "uid:"+user_id in players])
+        if any([not x.startswith("uid:") for role_name, players in role_players.items() if role_name not in user_roles for x in players]):
+            user_groups = self._get_user_groups(user_id)
+            user_roles.update([role_name for role_name, players in role_players.items() if user_groups & players])
+        logger.debug("User '%s' has roles '%s' in application '%s' for experiment '%s' instrument '%s'", user_id, user_roles, application_name, experiment_name, instrument)
+        return user_roles
+
+    def _get_user_groups(self, user_id):
+        """
+        :return: The set of posix groups for the user; an empty set if we cannot determine these.
+        """
+        try:
+            user_groups = self.usergroupsgetter.get_user_posix_groups(user_id)
+        except ValueError as e:
+            logger.exception("Exception when trying to determine groups for user %s", user_id)
+            return set()
+
+        logger.debug("User '%s' belongs to these groups '%s'", user_id, user_groups)
+        return set(user_groups)
+
+    def get_experiments_with_any_slac_user_role(self, user_id, application_name, role_names, experiment_names, instrument=None):
+        """
+        Filter a list of experiments down to those where the SLAC user has any of these roles in the application.
+        The global and instrument players and the user's groups are fetched once.
+        The experiment specific roles are fetched concurrently using at most FLASK_AUTHNZ_BULK_QUERY_CONCURRENCY threads.
+        :param user_id: User id to verify.
+        :param application_name: Application name.
+        :param role_names: Role names to check.
+        :param experiment_names: Experiment names to check.
+        :param instrument: Optional; the instrument for all these experiments; can be used for instrument level roles.
+        :return: The list of experiments where the user has any of these roles, in the same order as experiment_names.
+        """
+        role_names = list(role_names)
+        if self.authorization_index is not None:
+            user_players = set(["uid:"+user_id]) | self._get_user_groups(user_id)
+            return [experiment_name for experiment_name in experiment_names
+                    if self.authorization_index.get_roles_for_players(user_players, application_name, role_names, experiment_name, instrument)]
+        role_query = {"app": application_name, "name": {"$in": role_names}}
+        role_projection = {"_id": 0, "name": 1, "players": 1}
+        unrestricted_players = set()
+        for role in self._find("site_roles", self.rolesdbname, "roles", role_query, role_projection):
+            unrestricted_players.update(role.get("players", []))
+        if instrument:
+            instrument_role_players = self.get_instrument_roles(instrument).get(application_name, {})
+            for role_name in role_names:
+                unrestricted_players.update(instrument_role_players.get(role_name, frozenset()))
+        user_players = set(["uid:"+user_id]) | self._get_user_groups(user_id)
+        has_unrestricted_role = bool(user_players & unrestricted_players)
+
+        def check_experiment(experiment_name):
+            if has_unrestricted_role and not self.is_experiment_restricted(experiment_name):
+                return True
+            for role in self._find("experiment_roles", experiment_name, "roles", role_query, role_projection):
+                if user_players & set(role.get("players", [])):
+                    return True
+            return False
+
+        if self.bulk_query_executor is None:
+            with self.scope_cache_lock:
+                if self.bulk_query_executor is None:
+                    self.bulk_query_executor = ThreadPoolExecutor(max_workers=bulk_query_concurrency, thread_name_prefix="flask_authnz_bulk_query")
+        experiment_names = list(experiment_names)
+        permitted = list(self.bulk_query_executor.map(check_experiment, experiment_names))
+        return [experiment_name for experiment_name, is_permitted in zip(experiment_names, permitted) if is_permitted]
+
+    def get_users_with_any_slac_user_role(self, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Get all the users that have any of these roles in the application; the reverse of has_any_slac_user_role.
+        Group players are expanded to their members; all the groups are looked up in one batch if the user groups getter supports this.
+        :return: The set of user ids.
+        """
+        role_players = self.get_role_players(application_name, role_names, experiment_name, instrument)
+        players = set([x for players in role_players.values() for x in players])
+        user_ids = set([x[len("uid:"):] for x in players if x.startswith("uid:")])
+        group_names = sorted([x for x in players if not x.startswith("uid:")])
+        if group_names:
+            if hasattr(self.usergroupsgetter, "get_group_members_bulk"):
+                group_members = self.usergroupsgetter.get_group_members_bulk(group_names)
+            else:
+                group_members = {x: self.usergroupsgetter.get_group_members(x) for x in group_names}
+            for members in group_members.values():
+                user_ids.update(members)
+        logger.debug("Users %s have roles '%s' in application '%s' for experiment '%s' instrument '%s'", user_ids, role_names, application_name, experiment_name, instrument)
+        return user_ids
+
+    def get_role_players(self, application_name, role_names, experiment_name=None, instrument=None):
+        """
+        Get the players for these roles in the application.
+        Global roles and instrument roles do not apply to restricted experiments.
+        :param application_name: Application name.
+        :param role_names: Role names to get the players for.
+        :param experiment_name: This is optional; in which case only the global roles apply.
+        :param instrument: The instrument for this experiment; can be used for instrument level roles.
+        :return: A dict mapping each role name to the set of players (uid:<user_id> or group names) that have the role.
+        """
+        if self.authorization_index is not None:
+            return self.authorization_index.get_role_players(application_name, role_names, experiment_name, instrument)
+        role_players = {role_name: set() for role_name in role_names}
+        role_query = {"app": application_name, "name": {"$in": list(role_players.keys())}}
+        role_projection = {"_id": 0, "name": 1, "players": 1}
+
+        is_restricted = self.is_experiment_restricted(experiment_name) if experiment_name else False
 
-        role_players = set()
         if is_restricted:
             logger.info("%s is restricted; skipping adding global roles", experiment_name)
         else:
-            for role in self.mongoclient[self.rolesdbname]["roles"].find({"app": application_name, "name": role_name}):
-                for player in role.get("players", []):
-                    role_players.add(player)
+            for role in self._find("site_roles", self.rolesdbname, "roles", role_query, role_projection):
+                role_players[role["name"]].update(role.get("players", []))
         if experiment_name:
-            for role in self.mongoclient[experiment_name]["roles"].find({"app": application_name, "name": role_name}):
-                for player in role.get("players", []):
-                    role_players.add(player)
+            for role in self._find("experiment_roles", experiment_name, "roles", role_query, role_projection):
+                role_players[role["name"]].update(role.get("players", []))
         if is_restricted:
             logger.info("%s is restricted; skipping adding instrument roles", experiment_name)
         else:
             if instrument:
-                instr_obj = self.mongoclient[self.rolesdbname]["instruments"].find_one({"_id": instrument})
-                if instr_obj:
-                    for in_role in instr_obj.get("roles", []):
-                        if in_role.get("app", None) == application_name and in_role.get("name", None) == role_name:
-                            for player in in_role.get("players", []):
-                                role_players.add(player)
+                instrument_role_players = self.get_instrument_roles(instrument).get(application_name, {})
+                for role_name in role_players.keys():
+                    role_players[role_name].update(instrument_role_players.get(role_name, frozenset()))
+        return role_players
 
+    def is_experiment_restricted(self, experiment_name):
+        """
+        Check if the experiment is restricted; global and instrument roles do not apply to restricted experiments.
+        This is cached for FLASK_AUTHNZ_SCOPE_CACHE_TIME.
+        :param experiment_name: Experiment name
+        :return: True if the experiment is restricted.
+        """
+        if self.authorization_index is not None:
+            return self.authorization_index.is_experiment_restricted(experiment_name)
+        with self.scope_cache_lock:
+            is_restricted = self.restricted_cache.get(experiment_name, None)
+        self.cache_requests.inc(cache="experiment_restricted", result="miss" if is_restricted is None else "hit")
+        if is_restricted is not None:
+            return is_restricted
+        return self.__load_experiment_restricted(experiment_name)
 
-        # Check if the user is directly mentioned in the database.
-        if "uid:"+user_id in role_players:
-            logger.info("User_id='%s' directly has role '%s' in application '%s' for experiment '%s'."
-                          % (user_id,
-                             role_name,
-                             application_name,
-                             experiment_name))
-            return True
-
+    def __load_experiment_restricted(self, experiment_name):
+        is_restricted = False
+        exp_info = self._find_one("experiment_restricted", experiment_name, "info", {}, {"params.is_restricted": 1})
+        if exp_info:
+            is_restricted = json.loads(exp_info.get("params", {}).get("is_restricted", "False").lower())
+        with self.scope_cache_lock:
+            self.restricted_cache[experiment_name] = is_restricted
+        return is_restricted
 
-        authorized_groups = [x for x in role_players if not x.startswith("uid:")]
+    def get_instrument_roles(self, instrument):
+        """
+        Get the instrument level roles for this instrument.
+        This is cached for FLASK_AUTHNZ_SCOPE_CACHE_TIME.
+        :param instrument: Instrument name
+        :return: A dict mapping application name -> role name -> frozenset of players.
+        """
+        with self.scope_cache_lock:
+            instrument_roles = self.instrument_roles_cache.get(instrument, None)
+        self.cache_requests.inc(cache="instrument_roles", result="miss" if instrument_roles is None else "hit")
+        if instrument_roles is not None:
+            return instrument_roles
+        return self.__load_instrument_roles(instrument)
 
+    def __load_instrument_roles(self, instrument):
+        instrument_roles = {}
+        instr_obj = self._find_one("instrument_roles", self.rolesdbname, "instruments", {"_id": instrument}, {"roles": 1})
+        if instr_obj:
+            for in_role in instr_obj.get("roles", []):
+                app_roles = instrument_roles.setdefault(in_role.get("app", None), {})
+                app_roles[in_role.get("name", None)] = app_roles.get(in_role.get("name", None), frozenset()) | frozenset(in_role.get("players", []))
+        with self.scope_cache_lock:
+            self.instrument_roles_cache[instrument] = instrument_roles
+        return instrument_roles
 
-        # There are no role groups for this application.
-        if not authorized_groups:
-            logger.debug("User_id='%s' is not authorized for role '%s' on application '%s'. "
-                          "No authorized groups for this role either." % (user_id, role_name,
-                                                                          application_name))
-            return False
+    def get_cache_snapshot(self):
+        """
+        Get the cached experiment restricted flags and instrument roles to save in a snapshot; see snapshot.CacheSnapshot.
+        :return: A dict with experiment_restricted (experiment name -> is_restricted) and instrument_roles (instrument -> application -> role -> list of players).
+        """
+        with self.scope_cache_lock:
+            return {
+                "experiment_restricted": dict(self.restricted_cache.items()),
+                "instrument_roles": {instrument: {app: {role_name: sorted(players) for role_name, players in app_roles.items()} for app, app_roles in instrument_roles.items()}
+                                     for instrument, instrument_roles in self.instrument_roles_cache.items()}
+            }
 
-        logger.debug("These groups '%s' are authorized for role '%s' in application '%s' for experiment '%s'."
-                      % (authorized_groups,
-                         role_name,
-                         application_name,
-                         experiment_name))
+    def load_cache_snapshot(self, snapshot):
+        """
+        Add the experiment restricted flags and instrument roles from a snapshot to the caches; scopes that are already in the cache are skipped.
+        The loaded scopes are used right away and are read again from the database in a background thread.
+        :param snapshot: As returned by get_cache_snapshot.
+        """
+        with self.scope_cache_lock:
+            experiments = [x for x in snapshot.get("experiment_restricted", {}).keys() if x not in self.restricted_cache]
+            for experiment_name in experiments:
+                self.restricted_cache[experiment_name] = snapshot["experiment_restricted"][experiment_name]
+            instruments = [x for x in snapshot.get("instrument_roles", {}).keys() if x not in self.instrument_roles_cache]
+            for instrument in instruments:
+                self.instrument_roles_cache[instrument] = {app: {role_name: frozenset(players) for role_name, players in app_roles.items()}
+                                                           for app, app_roles in snapshot["instrument_roles"][instrument].items()}
+        logger.info("Loaded %s experiments and %s instruments from the snapshot", len(experiments), len(instruments))
+        if experiments or instruments:
+            Thread(target=self.__revalidate_scope_metadata, args=(experiments, instruments), name="flask_authnz_scope_revalidation", daemon=True).start()
 
+    def __revalidate_scope_metadata(self, experiments, instruments):
         try:
-            user_groups = self.usergroupsgetter.get_user_posix_groups(user_id)
-        except ValueError as e:
-            logger.exception("Exception when trying to determine groups for user %s" % (user_id))
-            return False
+            for experiment_name in experiments:
+                self.__load_experiment_restricted(experiment_name)
+            for instrument in instruments:
+                self.__load_instrument_roles(instrument)
+        except Exception:
+            logger.exception("Exception revalidating the scope metadata from the snapshot; we'll continue to use the snapshot until these expire")
 
-        logger.debug("User '%s' belongs to these groups '%s'"
-                      % (user_id,
-                         user_groups))
+    def _find(self, query_type, dbname, collname, query, projection=None):
+        """
+        Run a query and time it; the results are read in full so that the time includes fetching them.
+        :param query_type: The query type for the latency histogram.
+        :return: A list of the matching documents.
+        """
+        with self.query_latency.time(query=query_type), trace_span("mongo", query_type, db=dbname):
+            return list(self.mongoclient[dbname][collname].find(query, projection))
 
-        # Check if the user is in any posix group specified on the application.
-        return bool(set(user_groups) & set(authorized_groups))
+    def _find_one(self, query_type, dbname, collname, query, projection=None):
+        with self.query_latency.time(query=query_type), trace_span("mongo", query_type, db=dbname):
+            return self.mongoclient[dbname][collname].find_one(query, projection)
+
+    def refresh_scope_metadata(self, experiment_name=None, instrument=None):
+        """
+        Drop the cached experiment restricted flags and instrument roles so that they are read from the database on the next use.
+        :param experiment_name: Refresh only this experiment.
+        :param instrument: Refresh only this instrument.
+        If neither is specified, all scope metadata is refreshed.
+        """
+        with self.scope_cache_lock:
+            if not experiment_name and not instrument:
+                self.restricted_cache.clear()
+                self.instrument_roles_cache.clear()
+                return
+            if experiment_name:
+                self.restricted_cache.pop(experiment_name, None)
+            if instrument:
+                self.instrument_roles_cache.pop(instrument, None)
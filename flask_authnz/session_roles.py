@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+session_max_scopes_per_role = int(os.environ.get("FLASK_AUTHNZ_SESSION_MAX_SCOPES", "32"))
+session_grant_ttl = int(os.environ.get("FLASK_AUTHNZ_SESSION_GRANT_TTL", "3600"))
+
+ALL_SCOPES = "__ALL__"
+
+
+def scope_for(experiment_name=None, instrument=None):
+    """
+    The scope for a grant; the experiment if there is one, else the instrument, else all experiments.
+    """
+    return experiment_name or instrument or ALL_SCOPES
+
+
+class SessionRoles(object):
+    """
+    The application roles granted to the user in this session, in a compact form suitable for a cookie.
+    In the session, this is stored as {"v": 3, "r": [role names], "g": [[[scope, expiry], ...], ...]}.
+    The role names are stored once; "g" has the grants for the role at the same position in "r", oldest grant first.
+    The grants are lists rather than dicts as Flask's session serializer sorts the keys of dicts; this would lose the order of the grants.
+    For each role, we keep at most FLASK_AUTHNZ_SESSION_MAX_SCOPES scopes; the least recently granted scopes are dropped first.
+    Each grant expires after FLASK_AUTHNZ_SESSION_GRANT_TTL seconds so that revoked roles age out of the session.
+    Sessions in the older formats ({"<app>/<role>": [scopes]} and version 2 with {scope: expiry} dicts) are converted when they are loaded.
+    """
+    VERSION = 3
+
+    def __init__(self, application_name, max_scopes=None, ttl=None):
+        """
+        :param application_name: The application; used only to convert sessions in the older format.
+        :param max_scopes: Maximum number of scopes to keep per role; defaults to FLASK_AUTHNZ_SESSION_MAX_SCOPES.
+        :param ttl: Time in seconds after which a grant expires; defaults to FLASK_AUTHNZ_SESSION_GRANT_TTL.
+        """
+        self.application_name = application_name
+        self.max_scopes = max_scopes if max_scopes is not None else session_max_scopes_per_role
+        self.ttl = ttl if ttl is not None else session_grant_ttl
+        # role name -> OrderedDict of scope -> expiry, oldest grant first.
+        self.grants = OrderedDict()
+
+    @classmethod
+    def load(cls, data, application_name, max_scopes=None, ttl=None):
+        """
+        Load the roles from the session.
+        :param data: What we have in the session; either format.
+        """
+        ret = cls(application_name, max_scopes, ttl)
+        if not data:
+            return ret
+        if data.get("v", None) == cls.VERSION:
+            for role_name, scopes in zip(data.get("r", []), data.get("g", [])):
+                ret.grants[role_name] = OrderedDict([(scope, expiry) for scope, expiry in scopes])
+        elif data.get("v", None) == 2:
+            # The order of the scopes was lost in the cookie; as all grants have the same TTL, the expiry gives us the order in which they were granted.
+            for role_name, scopes in zip(data.get("r", []), data.get("g", [])):
+                ret.grants[role_name] = OrderedDict(sorted(scopes.items(), key=lambda x: x[1]))
+        else:
+            logger.debug("Converting session roles from the older format for application %s", application_name)
+            expiry = int(time.time()) + ret.ttl
+            prefix = application_name + "/"
+            for role_fq_name, scopes in data.items():
+                role_name = role_fq_name[len(prefix):] if role_fq_name.startswith(prefix) else role_fq_name
+                for scope in scopes[-ret.max_scopes:]:
+                    ret.grants.setdefault(role_name, OrderedDict())[scope] = expiry
+        return ret
+
+    def dump(self):
+        """
+        :return: The compact form to store in the session; expired grants are left out.
+        """
+        now = time.time()
+        role_names, grants = [], []
+        for role_name, scopes in self.grants.items():
+            scopes = [[scope, expiry] for scope, expiry in scopes.items() if expiry > now]
+            if scopes:
+                role_names.append(role_name)
+                grants.append(scopes)
+        return {"v": self.VERSION, "r": role_names, "g": grants}
+
+    def has(self, role_name, scope):
+        """
+        :return: True if the role was granted for this scope in this session and the grant has not expired.
+        """
+        expiry = self.grants.get(role_name, {}).get(scope, None)
+        return expiry is not None and expiry > time.time()
+
+    def add(self, role_name, scope):
+        """
+        Add a grant for the role for this scope; this becomes the most recently granted scope for the role.
+        """
+        scopes = self.grants.setdefault(role_name, OrderedDict())
+        scopes.pop(scope, None)
+        scopes[scope] = int(time.time()) + self.ttl
+        while len(scopes) > self.max_scopes:
+            scopes.popitem(last=False)
+
+    def as_dict(self):
+        """
+        :return: The unexpired grants as {"<app>/<role>": [scopes]}; this is what older versions stored in the session.
+        """
+        now = time.time()
+        ret = {}
+        for role_name, scopes in self.grants.items():
+            scopes = [scope for scope, expiry in scopes.items() if expiry > now]
+            if scopes:
+                ret[self.application_name + "/" + role_name] = scopes
+        return ret
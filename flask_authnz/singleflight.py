@@ -0,0 +1,67 @@
+import logging
+from threading import Lock, Event
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key into one call.
+    The first caller for a key makes the call; callers that come in while that call is in flight wait for it and get the same result.
+    If the call raises an exception, all the waiters get the exception; nothing is remembered once the call completes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) unless there is already a call in flight for this key.
+        :param key: Hashable key identifying the call.
+        :return: The result of the call.
+        """
+        with self.lock:
+            call = self.calls.get(key, None)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                leader = True
+
+        if not leader:
+            logger.debug("Waiting for call in flight for %s", key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        """
+        :return: The number of calls currently in flight.
+        """
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,128 @@
+import os
+import gzip
+import json
+import time
+import atexit
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+snapshot_file = os.environ.get("FLASK_AUTHNZ_SNAPSHOT_FILE", None)
+snapshot_interval_in_seconds = int(os.environ.get("FLASK_AUTHNZ_SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path, snapshot):
+    """
+    Write the snapshot as gzipped JSON.
+    We write to a temporary file in the same folder and rename it; so readers never see a partially written snapshot.
+    """
+    fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1) as gz:
+                gz.write(json.dumps(snapshot, separators=(",", ":")).encode("utf-8"))
+        os.replace(tmppath, path)
+    except Exception:
+        os.unlink(tmppath)
+        raise
+
+
+def read_snapshot(path):
+    """
+    :return: The snapshot; None if there is no snapshot or if it cannot be read.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rb") as f:
+            snapshot = json.loads(f.read().decode("utf-8"))
+    except Exception:
+        logger.exception("Exception reading the cache snapshot %s; starting with empty caches", path)
+        return None
+    if snapshot.get("version", None) != SNAPSHOT_VERSION:
+        logger.warning("Ignoring the cache snapshot %s with version %s", path, snapshot.get("version", None))
+        return None
+    return snapshot
+
+
+class CacheSnapshot(object):
+    """
+    Save the cached group memberships (UserGroups) and scope metadata (MongoDBRoles) to a local file and load them when a worker starts.
+    This avoids a burst of LDAP searches and MongoDB queries after a deploy or a worker restart.
+    Loaded entries are used as is but are treated as stale; they are revalidated in the background.
+    """
+
+    def __init__(self, path, roles_dal=None, usergroups=None):
+        """
+        :param path: Path to the snapshot file; the folder must be writable.
+        :param roles_dal: Optional; the MongoDBRoles whose scope metadata is saved.
+        :param usergroups: Optional; the UserGroups whose group memberships are saved.
+        """
+        self.path = path
+        self.roles_dal = roles_dal if hasattr(roles_dal, "get_cache_snapshot") else None
+        self.usergroups = usergroups if hasattr(usergroups, "get_cache_snapshot") else None
+        self.saver = None
+        self.saver_stop = threading.Event()
+
+    def save(self):
+        """
+        Write the current state of the caches to the snapshot file.
+        """
+        snapshot = {"version": SNAPSHOT_VERSION, "written_at": time.time()}
+        if self.usergroups is not None:
+            snapshot["user_groups"] = self.usergroups.get_cache_snapshot()
+        if self.roles_dal is not None:
+            snapshot["scopes"] = self.roles_dal.get_cache_snapshot()
+        write_snapshot(self.path, snapshot)
+        logger.debug("Wrote the cache snapshot %s", self.path)
+
+    def load(self):
+        """
+        Load the caches from the snapshot file, if there is one.
+        :return: True if we loaded a snapshot.
+        """
+        snapshot = read_snapshot(self.path)
+        if snapshot is None:
+            return False
+        if self.usergroups is not None and "user_groups" in snapshot:
+            self.usergroups.load_cache_snapshot(snapshot["user_groups"])
+        if self.roles_dal is not None and "scopes" in snapshot:
+            self.roles_dal.load_cache_snapshot(snapshot["scopes"])
+        logger.info("Loaded the cache snapshot %s written %.0f seconds ago", self.path, time.time() - snapshot["written_at"])
+        return True
+
+    def start(self, interval=None):
+        """
+        Save the snapshot every so many seconds in a background thread and when the process exits.
+        As with the privileges refresher, threads do not survive a fork; with gunicorn --preload, call this in a post_fork hook.
+        :param interval: Optional; defaults to FLASK_AUTHNZ_SNAPSHOT_INTERVAL.
+        """
+        if self.saver is not None and self.saver.is_alive():
+            return
+        self.saver_stop.clear()
+        self.saver = threading.Thread(target=self.__save_periodically, args=(interval or snapshot_interval_in_seconds,), name="flask_authnz_snapshot", daemon=True)
+        self.saver.start()
+        atexit.register(self.__save_at_exit)
+
+    def stop(self):
+        self.saver_stop.set()
+        if self.saver is not None:
+            self.saver.join()
+            self.saver = None
+        atexit.unregister(self.__save_at_exit)
+
+    def __save_periodically(self, interval):
+        while not self.saver_stop.wait(interval):
+            try:
+                self.save()
+            except Exception:
+                logger.exception("Exception writing the cache snapshot %s", self.path)
+
+    def __save_at_exit(self):
+        try:
+            self.save()
+        except Exception:
+            logger.exception("Exception writing the cache snapshot %s", self.path)
@@ -0,0 +1,136 @@
+import os
+import re
+import hmac
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+logger = logging.getLogger(__name__)
+# The structured trace log goes to its own logger so that it can be turned on without turning on DEBUG logging globally.
+trace_logger = logging.getLogger("flask_authnz.trace")
+
+TRACE_ATTRIBUTE = "flask_authnz_trace"
+# We stop adding events to the Server-Timing header after these many to keep the header small.
+max_server_timing_events = 50
+# If set, requests with this value in the X-Authz-Trace header are traced and get the Server-Timing header.
+trace_secret = os.environ.get("FLASK_AUTHNZ_TRACE_SECRET", None)
+TRACE_HEADER = "X-Authz-Trace"
+SERVER_TIMING_ATTRIBUTE = "flask_authnz_server_timing"
+
+
+class AuthorizationTrace(object):
+    """
+    The authorization events for one request.
+    Each event has a kind (decision, session, dal, mongo, ldap, ldap_cache), a name, an optional duration and some details.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, kind, name, duration=None, **details):
+        """
+        :param duration: Optional; in seconds.
+        """
+        self.events.append({"kind": kind, "name": name, "duration": duration, "details": details})
+
+    def total(self):
+        """
+        :return: The time in seconds spent in authorization decisions in this request.
+        """
+        return sum([x["duration"] for x in self.events if x["kind"] == "decision" and x["duration"] is not None])
+
+    def server_timing(self):
+        """
+        :return: The value for the Server-Timing header; durations are in milliseconds.
+        """
+        entries = ['authz;dur=%.3f;desc="%s decisions"' % (self.total()*1000, len([x for x in self.events if x["kind"] == "decision"]))]
+        for event in self.events[:max_server_timing_events]:
+            desc = " ".join([str(event["name"])] + ["%s=%s" % (k, v) for k, v in event["details"].items()])
+            entry = "authz-" + event["kind"]
+            if event["duration"] is not None:
+                entry += ";dur=%.3f" % (event["duration"]*1000)
+            # The experiment and instrument names come from the request URL; control characters (CR/LF) would break the header.
+            desc = re.sub(r"[\x00-\x1f\x7f]", " ", desc)
+            entries.append(entry + ';desc="%s"' % desc.replace("\\", "\\\\").replace('"', '\\"'))
+        return ", ".join(entries)
+
+
+def current_trace():
+    """
+    :return: The trace for the current request; None if we are not tracing this request or are outside a request.
+    """
+    if not has_request_context():
+        return None
+    return g.get(TRACE_ATTRIBUTE, None)
+
+
+def trace_event(kind, name, duration=None, **details):
+    """
+    Add an event to the trace for the current request, if any.
+    """
+    trace = current_trace()
+    if trace is not None:
+        trace.add(kind, name, duration, **details)
+
+
+@contextmanager
+def trace_span(kind, name, **details):
+    """
+    Time the body of the with statement and add it to the trace for the current request, if any.
+    """
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(kind, name, time.perf_counter() - start, **details)
+
+
+def trace_header_matches(secret):
+    """
+    :return: A should_trace predicate for init_tracing that accepts requests with this secret in the X-Authz-Trace header.
+    """
+    def should_trace(request):
+        value = request.headers.get(TRACE_HEADER, None)
+        return value is not None and hmac.compare_digest(value.encode("utf-8"), secret.encode("utf-8"))
+    return should_trace
+
+
+def init_tracing(app, server_timing=False, log=False, should_trace=None):
+    """
+    Trace the authorization checks in the requests of this app.
+    The trace is collected in flask.g; only the checks made in the request thread are traced.
+    The Server-Timing header is visible to the client and has the role names and the LDAP/Mongo query types; so it is only sent for requests that opt in.
+    :param server_timing: Add the trace as a Server-Timing response header to the requests accepted by should_trace.
+    :param log: Log the trace of every request as JSON at DEBUG level on the flask_authnz.trace logger.
+    :param should_trace: Optional; a callable that is passed the request and returns True to trace it and send back the Server-Timing header.
+    Defaults to requests with FLASK_AUTHNZ_TRACE_SECRET in the X-Authz-Trace header; if there is no secret, no request opts in.
+    """
+    if should_trace is None and trace_secret:
+        should_trace = trace_header_matches(trace_secret)
+    if server_timing and should_trace is None:
+        logger.warning("Not sending the Server-Timing header; set FLASK_AUTHNZ_TRACE_SECRET or pass in should_trace to choose the requests that get it")
+
+    @app.before_request
+    def start_authorization_trace():
+        opted_in = should_trace is not None and bool(should_trace(request))
+        setattr(g, SERVER_TIMING_ATTRIBUTE, server_timing and opted_in)
+        if opted_in or log:
+            setattr(g, TRACE_ATTRIBUTE, AuthorizationTrace())
+
+    @app.after_request
+    def emit_authorization_trace(response):
+        trace = current_trace()
+        if trace is None or not trace.events:
+            return response
+        if g.get(SERVER_TIMING_ATTRIBUTE, False):
+            response.headers.add("Server-Timing", trace.server_timing())
+        if log and trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug("Authorization trace %s", json.dumps({"path": request.path, "total": trace.total(), "events": trace.events}, default=str))
+        return response
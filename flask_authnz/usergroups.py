@@ -1,110 +1,437 @@
-import re
 import os
 import json
-from collections import OrderedDict
-import subprocess
+import time
 import logging
-from threading import RLock
-from cachetools import TTLCache, cached
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+
+from .ldap_backends import make_ldap_backend, parse_ldapsearch_response, SubprocessLDAPBackend
+from .singleflight import SingleFlight
+from .ldap_index import LDAPSnapshotIndex
+from .directory_index import DirectoryIndex, directory_index_refresh_interval_in_seconds
+from .cache_backends import make_cache
+from .metrics import get_registry, register_cache_metrics, cache_requests
+from .tracing import trace_event, trace_span
 
 logger = logging.getLogger(__name__)
 
-ldapsearchCommand = os.environ.get("FLASK_AUTHNZ_LDAPSEARCH_COMMAND", "ldapsearch -x").split()
 user_groups_cache_time_in_seconds = int(os.environ.get("FLASK_AUTHNZ_CACHE_TIME", "3600"))
 user_groups_cache_size = int(os.environ.get("FLASK_AUTHNZ_CACHE_SIZE", "2048"))
-user_groups_cache = TTLCache(user_groups_cache_size, user_groups_cache_time_in_seconds)
-user_groups_cache_lock = RLock()
+# Entries older than this fraction of the cache time are refreshed in the background while we continue to serve them.
+user_groups_cache_refresh_ahead = float(os.environ.get("FLASK_AUTHNZ_CACHE_REFRESH_AHEAD", "0.9"))
+# Entries older than this are not served at all; we then block on LDAP.
+user_groups_cache_max_staleness_in_seconds = int(os.environ.get("FLASK_AUTHNZ_CACHE_MAX_STALENESS", str(2*user_groups_cache_time_in_seconds)))
+# user_id -> (list of groups, time when we got these from LDAP)
+# The cache may keep entries for longer than the maximum staleness (if that is less than the cache time); we check the age of the entries when we read them.
+user_groups_cache = make_cache("user_groups", user_groups_cache_size, max(user_groups_cache_max_staleness_in_seconds, user_groups_cache_time_in_seconds))
+# group name -> list of members; only used by get_group_members_bulk.
+group_members_cache = make_cache("group_members", user_groups_cache_size, user_groups_cache_time_in_seconds)
+group_index_refresh_interval_in_seconds = int(os.environ.get("FLASK_AUTHNZ_GROUP_INDEX_REFRESH", "0"))
+# Maximum number of users in one (|(memberUid=...)...) search; this keeps the filter under the server's size limits.
+bulk_lookup_chunk_size = int(os.environ.get("FLASK_AUTHNZ_LDAP_BULK_CHUNK_SIZE", "50"))
+
+MembershipSnapshot = namedtuple("MembershipSnapshot", ["loaded_at", "user2groups", "group2members"])
+
+
+def _group_name(entry):
+    """
+    :return: The cn of a posixGroup entry; the backends return multi valued attributes as lists, in which case we use the first value.
+    """
+    cn = entry["cn"]
+    return cn[0] if isinstance(cn, list) else cn
+
+
+class GroupMembershipIndex(LDAPSnapshotIndex):
+    """
+    An in-memory snapshot of all the posixGroups and their members, loaded using one bulk LDAP search.
+    We keep an inverted user -> groups index and a group -> members index.
+    Refreshing builds a new snapshot off to the side and then swaps it in; see LDAPSnapshotIndex.
+    """
+    index_name = "group_index"
+    description = "group membership"
+
+    def __init__(self, backend, refresh_interval=None, max_age=None):
+        """
+        :param backend: The LDAP backend to use for the bulk search.
+        :param refresh_interval: Refresh the snapshot every so many seconds; defaults to FLASK_AUTHNZ_GROUP_INDEX_REFRESH.
+        :param max_age: Do not use snapshots older than this; defaults to three times the refresh interval.
+        """
+        super(GroupMembershipIndex, self).__init__(backend, refresh_interval or group_index_refresh_interval_in_seconds or 600, max_age)
+
+    def refresh(self):
+        """
+        Load all the posixGroups and their members from LDAP and swap in the new snapshot.
+        """
+        start = time.time()
+        user2groups = {}
+        group2members = {}
+        with self.ldap_latency.time(query="group_index"):
+            for entry in self.backend.iter_search("(objectclass=posixGroup)", ["cn", "memberUid"]):
+                group_name = _group_name(entry)
+                members = entry.get("memberUid", [])
+                members = tuple([members] if isinstance(members, str) else members)
+                group2members[group_name] = members
+                for member in members:
+                    user2groups.setdefault(member, []).append(group_name)
+        self.snapshot = MembershipSnapshot(time.time(), user2groups, group2members)
+        logger.info("Loaded group membership snapshot with %s groups and %s users in %.3fs", len(group2members), len(user2groups), time.time() - start)
+
+    def get_user_posix_groups(self, user_id):
+        """
+        :return: List of posix groups for the user; None if there is no usable snapshot.
+        """
+        snapshot = self.current_snapshot()
+        if snapshot is None:
+            return None
+        return list(snapshot.user2groups.get(user_id, []))
+
+    def get_group_members(self, group_name):
+        """
+        :return: List of members of the group; None if there is no usable snapshot.
+        """
+        snapshot = self.current_snapshot()
+        if snapshot is None:
+            return None
+        return list(snapshot.group2members.get(group_name, []))
+
+    def size(self):
+        """
+        :return: A dict with the number of groups, users and memberships in the current snapshot.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {"groups": 0, "users": 0, "memberships": 0}
+        return {"groups": len(snapshot.group2members), "users": len(snapshot.user2groups), "memberships": sum([len(x) for x in snapshot.group2members.values()])}
+
 
 class UserGroups(object):
+    """
+    Users, groups and group memberships from LDAP.
+    By default, we use ldapsearch; set FLASK_AUTHNZ_LDAP_BACKEND to pooled to use persistent ldap3 connections instead.
+    Optionally, group memberships can be answered from a periodically refreshed in-memory snapshot of all the posixGroups.
+    Concurrent identical LDAP queries are coalesced into one query.
+    Cached group memberships that are close to or past FLASK_AUTHNZ_CACHE_TIME are served while they are refreshed in the background,
+    up to FLASK_AUTHNZ_CACHE_MAX_STALENESS.
+    """
+
+    def __init__(self, backend=None, group_index_refresh_interval=None, cache=None, directory_index_refresh_interval=None):
+        """
+        :param backend: Optional; the LDAP backend to use. See ldap_backends.
+        :param cache: Optional; the cache backend for the group memberships. See cache_backends.
+        By default, this is shared by all the UserGroups in this process; set FLASK_AUTHNZ_SHARED_CACHE to share it with all the processes on this host.
+        :param group_index_refresh_interval: Optional; if specified, load all the group memberships into memory and refresh them every so many seconds.
+        Defaults to FLASK_AUTHNZ_GROUP_INDEX_REFRESH; 0 turns this off.
+        :param directory_index_refresh_interval: Optional; if specified, load all the users and groups into memory for pattern searches and refresh them every so many seconds.
+        Defaults to FLASK_AUTHNZ_DIRECTORY_INDEX_REFRESH; 0 turns this off.
+        """
+        self.backend = backend or make_ldap_backend()
+        self.cache = cache or user_groups_cache
+        self.inflight = SingleFlight()
+        self.refresh_after = user_groups_cache_refresh_ahead*user_groups_cache_time_in_seconds
+        self.max_staleness = user_groups_cache_max_staleness_in_seconds
+        self.background_refreshes = ThreadPoolExecutor(max_workers=2, thread_name_prefix="flask_authnz_groups_refresh")
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
+        self.membership_index = None
+        self.ldap_latency = get_registry().histogram("flask_authnz_ldap_query_seconds", "Time taken for LDAP queries by query type", ["query"])
+        self.cache_requests = cache_requests()
+        register_cache_metrics("user_groups", self.cache.stats)
+        self.group_members_cache = group_members_cache
+        register_cache_metrics("group_members", self.group_members_cache.stats)
+        group_index_refresh_interval = group_index_refresh_interval if group_index_refresh_interval is not None else group_index_refresh_interval_in_seconds
+        if group_index_refresh_interval:
+            self.membership_index = GroupMembershipIndex(self.backend, group_index_refresh_interval)
+            try:
+                self.membership_index.refresh()
+            except Exception:
+                logger.exception("Exception loading the group membership snapshot; we'll use LDAP until the next refresh")
+            self.membership_index.start_refresher()
+        self.directory_index = None
+        directory_index_refresh_interval = directory_index_refresh_interval if directory_index_refresh_interval is not None else directory_index_refresh_interval_in_seconds
+        if directory_index_refresh_interval:
+            self.directory_index = DirectoryIndex(self.backend, directory_index_refresh_interval)
+            try:
+                self.directory_index.refresh()
+            except Exception:
+                logger.exception("Exception loading the directory snapshot; we'll use LDAP until the next refresh")
+            self.directory_index.start_refresher()
 
-    @cached(user_groups_cache, lock=user_groups_cache_lock)
     def get_user_posix_groups(self, user_id):
         """
         Get the complete list of posix groups for the user.
         :param user_id: User id to get the posix groups for.
         :return: List of posix groups.
         """
-        user_groups = [x["cn"] for x in self.search_LDAP(ldapsearchCommand + ["(&(objectclass=posixGroup)(memberUid={0}))".format(user_id), "cn"])]
-        logger.debug("User_id='%s' is member of groups %s." % (user_id, user_groups))
+        if self.membership_index:
+            user_groups = self.membership_index.get_user_posix_groups(user_id)
+            self.cache_requests.inc(cache="group_index", result="miss" if user_groups is None else "hit")
+            if user_groups is not None:
+                trace_event("ldap_cache", user_id, result="group_index")
+                return user_groups
+        return self._lookup_user_posix_groups(user_id)
+
+    def _lookup_user_posix_groups(self, user_id):
+        """
+        Get the posix groups for the user from the cache; if not there, from LDAP.
+        If the cached entry is getting old, we return it anyway and refresh it in the background.
+        Entries past the maximum staleness are not served; we wait for LDAP instead.
+        """
+        cached_entry = self.cache.get((user_id,))
+        if cached_entry is not None and time.time() - cached_entry[1] >= self.max_staleness:
+            cached_entry = None
+        if cached_entry is not None:
+            user_groups, fetched_at = cached_entry
+            if time.time() - fetched_at > self.refresh_after:
+                self.cache_requests.inc(cache="user_groups", result="stale")
+                trace_event("ldap_cache", user_id, result="stale")
+                self.__refresh_in_background(user_id)
+            else:
+                self.cache_requests.inc(cache="user_groups", result="hit")
+                trace_event("ldap_cache", user_id, result="hit")
+            return user_groups
+        self.cache_requests.inc(cache="user_groups", result="miss")
+        trace_event("ldap_cache", user_id, result="miss")
+        return self.inflight.do(("user_posix_groups", user_id), self.__search_user_posix_groups, user_id)
+
+    def __search_user_posix_groups(self, user_id):
+        # Another thread may have completed the same search just before we got here.
+        cached_entry = self.cache.get((user_id,))
+        if cached_entry is not None and time.time() - cached_entry[1] <= min(self.refresh_after, self.max_staleness):
+            return cached_entry[0]
+        user_groups = [_group_name(x) for x in self._search("user_groups", "(&(objectclass=posixGroup)(memberUid={0}))".format(user_id), ["cn"])]
+        logger.debug("User_id='%s' is member of groups %s.", user_id, user_groups)
+        self.cache.set((user_id,), (user_groups, time.time()))
+        return user_groups
+
+    def __refresh_in_background(self, user_id):
+        with self.refreshing_lock:
+            if user_id in self.refreshing:
+                return
+            self.refreshing.add(user_id)
+        logger.debug("Refreshing the groups for user %s in the background", user_id)
+        try:
+            self.background_refreshes.submit(self.__background_refresh, user_id)
+        except RuntimeError:
+            # The executor has been shut down; the entry will be refreshed once it is past the maximum staleness.
+            with self.refreshing_lock:
+                self.refreshing.discard(user_id)
+
+    def __background_refresh(self, user_id):
+        try:
+            self.inflight.do(("user_posix_groups", user_id), self.__search_user_posix_groups, user_id)
+        except Exception:
+            logger.exception("Exception refreshing the groups for user %s in the background; continuing to use the cached groups", user_id)
+        finally:
+            with self.refreshing_lock:
+                self.refreshing.discard(user_id)
+
+    def get_user_posix_groups_bulk(self, user_ids):
+        """
+        Get the posix groups for many users; for example, for reports that check access for many users.
+        Users in the group index or the cache are answered from there; cached entries that are getting old are refreshed in the background.
+        The rest are looked up using one LDAP search per FLASK_AUTHNZ_LDAP_BULK_CHUNK_SIZE users and added to the cache.
+        :param user_ids: User ids to get the posix groups for.
+        :return: A dict of user_id -> list of posix groups.
+        """
+        user_groups, to_search, to_refresh = {}, [], []
+        for user_id in dict.fromkeys(user_ids):
+            if self.membership_index:
+                groups = self.membership_index.get_user_posix_groups(user_id)
+                self.cache_requests.inc(cache="group_index", result="miss" if groups is None else "hit")
+                if groups is not None:
+                    user_groups[user_id] = groups
+                    continue
+            cached_entry = self.cache.get((user_id,))
+            if cached_entry is None or time.time() - cached_entry[1] >= self.max_staleness:
+                self.cache_requests.inc(cache="user_groups", result="miss")
+                to_search.append(user_id)
+                continue
+            user_groups[user_id] = cached_entry[0]
+            if time.time() - cached_entry[1] > self.refresh_after:
+                self.cache_requests.inc(cache="user_groups", result="stale")
+                to_refresh.append(user_id)
+            else:
+                self.cache_requests.inc(cache="user_groups", result="hit")
+        if to_refresh:
+            try:
+                self.background_refreshes.submit(self.__background_refresh_bulk, to_refresh)
+            except RuntimeError:
+                # The executor has been shut down; the entries will be looked up again once they expire.
+                logger.debug("Not refreshing the groups for %s users in the background", len(to_refresh))
+        for start in range(0, len(to_search), bulk_lookup_chunk_size):
+            user_groups.update(self.__search_user_posix_groups_bulk(to_search[start:start+bulk_lookup_chunk_size]))
         return user_groups
 
+    def __search_user_posix_groups_bulk(self, user_ids):
+        user_groups = {user_id: [] for user_id in user_ids}
+        filterstr = "(&(objectclass=posixGroup)(|" + "".join(["(memberUid={0})".format(x) for x in user_ids]) + "))"
+        for entry in self._search("user_groups_bulk", filterstr, ["cn", "memberUid"]):
+            members = entry.get("memberUid", [])
+            for member in ([members] if isinstance(members, str) else members):
+                if member in user_groups:
+                    user_groups[member].append(_group_name(entry))
+        fetched_at = time.time()
+        for user_id, groups in user_groups.items():
+            self.cache.set((user_id,), (groups, fetched_at))
+        logger.debug("Looked up the groups for %s users in one search", len(user_ids))
+        return user_groups
+
+    def __background_refresh_bulk(self, user_ids):
+        try:
+            for start in range(0, len(user_ids), bulk_lookup_chunk_size):
+                self.__search_user_posix_groups_bulk(user_ids[start:start+bulk_lookup_chunk_size])
+        except Exception:
+            logger.exception("Exception refreshing the groups for %s users in the background; continuing to use the cached groups", len(user_ids))
+
+    def get_cache_snapshot(self):
+        """
+        Get the cached group memberships to save in a snapshot; see snapshot.CacheSnapshot.
+        :return: A dict of user_id -> [list of groups, time when we got these from LDAP].
+        """
+        entries = {}
+        for key in self.cache.keys():
+            cached_entry = self.cache.get(key)
+            if cached_entry is not None:
+                entries[key[0]] = [cached_entry[0], cached_entry[1]]
+        return entries
+
+    def load_cache_snapshot(self, entries):
+        """
+        Add group memberships from a snapshot to the cache; users that are already in the cache are skipped.
+        The entries are marked as due for a refresh; they are served and refreshed in the background on first use.
+        Entries older than FLASK_AUTHNZ_CACHE_MAX_STALENESS are skipped.
+        :param entries: As returned by get_cache_snapshot.
+        :return: The number of entries added to the cache.
+        """
+        now, loaded = time.time(), 0
+        for user_id, (user_groups, fetched_at) in entries.items():
+            age = now - fetched_at
+            if age >= self.max_staleness or self.cache.get((user_id,)) is not None:
+                continue
+            self.cache.set((user_id,), (user_groups, min(fetched_at, now - self.refresh_after - 1)), ttl=self.max_staleness - age)
+            loaded += 1
+        logger.info("Loaded the groups for %s users from the snapshot", loaded)
+        return loaded
+
     def get_group_members(self, group_name):
         """
         Get the members in a group
         :param group_name: Group name to get the members for.
         :return: List of member user id's
         """
-        grpobj = self.search_LDAP(ldapsearchCommand + ["(&(objectclass=posixGroup)(cn={0}))".format(group_name), "memberUid"])
-        logger.debug("Group '%s' has members %s." % (group_name, grpobj))
+        if self.membership_index:
+            members = self.membership_index.get_group_members(group_name)
+            self.cache_requests.inc(cache="group_index", result="miss" if members is None else "hit")
+            if members is not None:
+                return members
+        return self.inflight.do(("group_members", group_name), self.__search_group_members, group_name)
+
+    def __search_group_members(self, group_name):
+        grpobj = self._search("group_members", "(&(objectclass=posixGroup)(cn={0}))".format(group_name), ["memberUid"])
+        logger.debug("Group '%s' has members %s.", group_name, grpobj)
         if grpobj:
             if 'memberUid' in grpobj[0] and isinstance(grpobj[0]['memberUid'], str):
                 return [grpobj[0]['memberUid']]
             return grpobj[0].get('memberUid', [])
         return []
 
-    def get_groups_matching_pattern(self, group_pattern):
+    def get_group_members_bulk(self, group_names):
+        """
+        Get the members of many groups; for example, to find all the users that have a role.
+        Groups in the group index or the cache are answered from there; the members are cached for FLASK_AUTHNZ_CACHE_TIME.
+        The rest are looked up using one LDAP search per FLASK_AUTHNZ_LDAP_BULK_CHUNK_SIZE groups.
+        :param group_names: Group names to get the members for.
+        :return: A dict of group name -> list of member user id's.
+        """
+        group_members, to_search = {}, []
+        for group_name in dict.fromkeys(group_names):
+            if self.membership_index:
+                members = self.membership_index.get_group_members(group_name)
+                self.cache_requests.inc(cache="group_index", result="miss" if members is None else "hit")
+                if members is not None:
+                    group_members[group_name] = members
+                    continue
+            members = self.group_members_cache.get((group_name,))
+            self.cache_requests.inc(cache="group_members", result="miss" if members is None else "hit")
+            if members is None:
+                to_search.append(group_name)
+            else:
+                group_members[group_name] = members
+        for start in range(0, len(to_search), bulk_lookup_chunk_size):
+            group_members.update(self.__search_group_members_bulk(to_search[start:start+bulk_lookup_chunk_size]))
+        return group_members
+
+    def __search_group_members_bulk(self, group_names):
+        group_members = {group_name: [] for group_name in group_names}
+        filterstr = "(&(objectclass=posixGroup)(|" + "".join(["(cn={0})".format(x) for x in group_names]) + "))"
+        for entry in self._search("group_members_bulk", filterstr, ["cn", "memberUid"]):
+            members = entry.get("memberUid", [])
+            # A group with a multi valued cn may have been asked for by any of its names.
+            for group_name in ([entry["cn"]] if isinstance(entry["cn"], str) else entry["cn"]):
+                if group_name in group_members:
+                    group_members[group_name] = [members] if isinstance(members, str) else list(members)
+        for group_name, members in group_members.items():
+            self.group_members_cache.set((group_name,), members)
+        logger.debug("Looked up the members of %s groups in one search", len(group_names))
+        return group_members
+
+    def get_groups_matching_pattern(self, group_pattern, limit=None, offset=0):
         """
         Get all the groups in the system matching a pattern.
+        If we have a directory index, the groups are looked up there; if nothing matches, we search LDAP in case the group is new.
         :param group_pattern: Pattern to match against
+        :param limit: Optional; return at most these many groups.
+        :param offset: Optional; skip these many matching groups; use this with limit for pagination.
         :return: List of group names
         """
-        groupnames = [x["cn"] for x in self.search_LDAP(ldapsearchCommand + ["(&(objectclass=posixGroup)(cn={0}))".format(group_pattern), "cn", "gidNumber"])]
-        logger.debug("Group pattern '%s' has groups %s." % (group_pattern, groupnames))
+        if self.directory_index:
+            groups = self.directory_index.search_groups(group_pattern, limit, offset)
+            self.cache_requests.inc(cache="directory_index", result="hit" if groups else "miss")
+            if groups or (groups is not None and offset):
+                return [_group_name(x) for x in groups]
+        groupnames = [_group_name(x) for x in self.inflight.do(("groups_matching_pattern", group_pattern, limit, offset), self._search, "groups_matching_pattern", "(&(objectclass=posixGroup)(cn={0}))".format(group_pattern), ["cn", "gidNumber"], limit + offset if limit else None)][offset:]
+        logger.debug("Group pattern '%s' has groups %s.", group_pattern, groupnames)
         return groupnames
 
-    def get_userids_matching_pattern(self, userid_pattern):
+    def get_userids_matching_pattern(self, userid_pattern, limit=None, offset=0):
         """
         Get all the userids in the system matching a pattern.
+        If we have a directory index, the users are looked up there (matching the uid, cn or gecos); if nothing matches, we search LDAP in case the user is new.
         :param userid_pattern: Pattern to match against
+        :param limit: Optional; return at most these many users.
+        :param offset: Optional; skip these many matching users; use this with limit for pagination.
         :return: List of dicts with the uid, cn and gecos
         """
-        userobjs = self.search_LDAP(ldapsearchCommand + ["(&(objectClass=posixAccount)(|(uid={0})(cn={0})))".format(userid_pattern), "uid", "cn", "gecos", "uidNumber"])
-        logger.debug("Users matching pattern '%s' has entries %s." % (userid_pattern, userobjs))
+        if self.directory_index:
+            userobjs = self.directory_index.search_users(userid_pattern, limit, offset)
+            self.cache_requests.inc(cache="directory_index", result="hit" if userobjs else "miss")
+            if userobjs or (userobjs is not None and offset):
+                return userobjs
+        userobjs = self.inflight.do(("userids_matching_pattern", userid_pattern, limit, offset), self._search, "userids_matching_pattern", "(&(objectClass=posixAccount)(|(uid={0})(cn={0})))".format(userid_pattern), ["uid", "cn", "gecos", "uidNumber"], limit + offset if limit else None)[offset:]
+        logger.debug("Users matching pattern '%s' has entries %s.", userid_pattern, userobjs)
         return userobjs
 
-    def search_LDAP(self, query):
-        try:
-            logger.debug("Running LDAP query %s", query)
-            response =  subprocess.run(query, check=False, stdout=subprocess.PIPE).stdout.decode("utf-8")
-            return self.parseLDAPSearchResponse(response)
-        except Exception as e:
-            raise ValueError("Error while trying to run LDAP query: '%s'\n%s" % (query, e))
+    def _search(self, query_type, filterstr, attributes, limit=None):
+        """
+        Search LDAP using the backend and time the search.
+        :param query_type: The query type for the latency histogram.
+        """
+        with self.ldap_latency.time(query=query_type), trace_span("ldap", query_type):
+            return self.backend.search(filterstr, attributes, limit)
 
+    def search_LDAP(self, query):
+        """
+        Run a complete ldapsearch command line and parse the response.
+        """
+        return SubprocessLDAPBackend().search_LDAP(query)
 
     def parseLDAPSearchResponse(self, response):
         """
         LDAPSearch responses are <name>: <value>, one per line with # as comment and blank lines to separate each object.
         This method parses such a response and returns an array of dicts.
         """
-        retval = []
-        current_obj = OrderedDict()
-        comment_re = re.compile(r"^#.*$")
-        blank_line_re = re.compile(r"^\s*$")
-        n_v_line = re.compile(r"^(\w*):(.*)$")
-        for line in response.split("\n"):
-            if comment_re.match(line):
-                continue
-            elif blank_line_re.match(line):
-                if current_obj and 'dn' in current_obj:
-                    retval.append(current_obj)
-                current_obj = OrderedDict()
-            else:
-                nvm = n_v_line.match(line)
-                if nvm:
-                    name = nvm.group(1)
-                    value = nvm.group(2).strip()
-                    if name in current_obj:
-                        if isinstance(current_obj[name], list):
-                            current_obj[name].append(value)
-                        else:
-                            current_obj[name] = [current_obj[name], value]
-                    else:
-                        current_obj[name] = value
-                else:
-                    logger.error("Not matching a line in LDAP response %s", line)
-        if current_obj and 'dn' in current_obj:
-            retval.append(current_obj)
-        return retval
+        return parse_ldapsearch_response(response)
 
 if __name__ == '__main__':
     ug = UserGroups()
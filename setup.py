@@ -8,4 +8,6 @@ setup(name='flask_authnz',
       author_email='mshankar@slac.stanford.edu',
       license='MIT',
       packages=['flask_authnz'],
+      install_requires=['flask', 'cachetools>=5.0'],
+      extras_require={'ldap3': ['ldap3'], 'mongodb': ['pymongo'], 'async': ['motor']},
       zip_safe=False)
@@ -0,0 +1,257 @@
+import os
+import time
+import asyncio
+import unittest
+import threading
+from unittest import mock
+import logging
+import flask
+
+from flask_authnz.async_authnz import AsyncFlaskAuthnz
+from flask_authnz.async_mongodb_dal import AsyncMongoDBRoles
+from flask_authnz.async_usergroups import AsyncUserGroups, AsyncLDAPBackend
+from flask_authnz.decision_cache import DecisionCache
+from flask_authnz.usergroups import user_groups_cache
+from flask_authnz.ldap_backends import LDAPSizeLimitError
+from flask_authnz.metrics import get_registry
+from flask_authnz.tracing import AuthorizationTrace, TRACE_ATTRIBUTE
+
+from werkzeug.exceptions import HTTPException
+
+from .TestFlaskAuthz import mock_mongo_client, mock_user_groups
+from .TestUserGroups import FAKE_LDAPSEARCH
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMockCursor(object):
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+    async def to_list(self, length):
+        await self.collection.query()
+        return self.docs
+
+
+class AsyncMockCollection(object):
+    """
+    In-memory stand-in for a motor collection; each query takes a little while and we keep track of how many are in flight at once.
+    """
+    def __init__(self, client, collection):
+        self.client = client
+        self.collection = collection
+    async def query(self):
+        self.client.in_flight += 1
+        self.client.max_in_flight = max(self.client.max_in_flight, self.client.in_flight)
+        try:
+            await asyncio.sleep(self.client.delay)
+        finally:
+            self.client.in_flight -= 1
+    def find(self, params_dict, projection=None):
+        return AsyncMockCursor(self, self.collection.find(params_dict, projection))
+    async def find_one(self, params_dict, projection=None):
+        await self.query()
+        return self.collection.find_one(params_dict, projection)
+
+
+class AsyncMockClient(object):
+    def __init__(self, mgClient, delay=0.0):
+        self.mgClient = mgClient
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+    def __getitem__(self, dbname):
+        return {collname: AsyncMockCollection(self, collection) for collname, collection in self.mgClient[dbname].items()}
+
+
+class AsyncMockUserGroups(object):
+    def __init__(self, user_groups):
+        self.user_groups = user_groups
+    async def get_user_posix_groups(self, user_id):
+        return self.user_groups.get_user_posix_groups(user_id)
+
+
+class ThreadRecordingUserGroups(object):
+    """
+    A synchronous user groups getter that remembers the threads it was called on.
+    """
+    def __init__(self, user_groups):
+        self.user_groups = user_groups
+        self.threads = []
+    def get_user_posix_groups(self, user_id):
+        self.threads.append(threading.current_thread())
+        return self.user_groups.get_user_posix_groups(user_id)
+
+
+class SlowAsyncRoles(object):
+    """
+    An async roles DAL that checks one role at a time (no has_any_slac_user_role); some roles take a while.
+    """
+    def __init__(self, dal, delays):
+        self.dal = dal
+        self.delays = delays
+    async def getPrivilegesForApplicationRoles(self, application_name):
+        return await self.dal.getPrivilegesForApplicationRoles(application_name)
+    async def has_slac_user_role(self, user_id, application_name, role_name, experiment_name=None, instrument=None):
+        await asyncio.sleep(self.delays.get(role_name, 0))
+        return await self.dal.has_slac_user_role(user_id, application_name, role_name, experiment_name, instrument)
+
+
+class CountingAsyncLDAPBackend(object):
+    def __init__(self, entries, delay=0.05):
+        self.entries = entries
+        self.delay = delay
+        self.queries = []
+    async def search(self, filterstr, attributes, limit=None):
+        self.queries.append(filterstr)
+        await asyncio.sleep(self.delay)
+        return self.entries[:limit]
+
+
+def async_view(msg):
+    async def view(**kwargs):
+        return msg
+    return view
+
+
+class TestAsyncAuthnz(unittest.TestCase):
+    def setUp(self):
+        user_groups_cache.clear()
+        self.app = flask.Flask(__name__)
+        self.app.secret_key = "This is a secret key that is somewhat temporary."
+
+    def make_security(self, delay=0.0, decision_cache=None, audit_log=None):
+        self.mgClient = AsyncMockClient(mock_mongo_client(), delay)
+        dal = AsyncMongoDBRoles(self.mgClient, AsyncMockUserGroups(mock_user_groups()))
+        return AsyncFlaskAuthnz(dal, "LogBook", decision_cache=decision_cache, audit_log=audit_log)
+
+    def test_async_decorators(self):
+        security = self.make_security()
+        view = security.authentication_required(security.authorization_required("read")(async_view("Authorized")))
+        with self.app.test_request_context('/'):
+            with self.assertRaises(HTTPException) as http_error:
+                asyncio.run(view(experiment_name="xpp123456"))
+            self.assertEqual(http_error.exception.code, 403)
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertEqual(asyncio.run(view(experiment_name="xpp123456")), "Authorized")
+            self.assertEqual(security.get_session_roles(), {"LogBook/Reader": ["xpp123456"]})
+            with self.assertRaises(HTTPException) as http_error:
+                asyncio.run(security.authorization_required("edit")(async_view("Authorized"))(experiment_name="xpp123456"))
+            self.assertEqual(http_error.exception.code, 403)
+            with self.assertRaises(HTTPException):
+                asyncio.run(view(experiment_name="restricted_experiment"))
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp_instrment_operator"
+            flask.g.instrument = "XPP"
+            self.assertEqual(asyncio.run(security.authorization_required("experiment_switch")(async_view("Switched"))(experiment_name="xpp123456")), "Switched")
+
+    def test_async_effective_privileges_and_filter(self):
+        security = self.make_security(decision_cache=DecisionCache())
+        with self.app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp123456_PI"
+            self.assertEqual(asyncio.run(security.get_effective_privileges("xpp123456")), set(["read", "post", "manage_shifts", "edit", "delete"]))
+            self.assertEqual(asyncio.run(security.get_effective_privileges("mec987654")), set())
+            self.assertEqual(asyncio.run(security.filter_experiments("edit", ["xpp123456", "mec987654", "restricted_experiment"])), ["xpp123456"])
+            flask.request.environ["HTTP_REMOTE_USER"] = "specific_restricted_reader"
+            self.assertEqual(asyncio.run(security.filter_experiments("read", ["xpp123456", "mec987654", "restricted_experiment"])), ["restricted_experiment"])
+
+    def test_async_bulk_filter(self):
+        mgClient = mock_mongo_client()
+        usergroups = ThreadRecordingUserGroups(mock_user_groups())
+        security = AsyncFlaskAuthnz(AsyncMongoDBRoles(AsyncMockClient(mgClient), usergroups), "LogBook")
+        with self.app.test_request_context('/'):
+            asyncio.run(security.load_privileges())
+            queries = len(mgClient["site"]["roles"].queries)
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertEqual(asyncio.run(security.filter_experiments("read", ["xpp123456", "mec987654", "restricted_experiment"])), ["xpp123456", "mec987654"])
+        # The global roles and the user's groups are looked up once for all the experiments.
+        self.assertEqual(len(mgClient["site"]["roles"].queries) - queries, 1)
+        self.assertEqual(len(usergroups.threads), 1)
+        # The synchronous user groups getter is not called on the event loop thread.
+        self.assertNotEqual(usergroups.threads[0], threading.main_thread())
+
+    def test_async_role_order(self):
+        dal = SlowAsyncRoles(AsyncMongoDBRoles(AsyncMockClient(mock_mongo_client()), AsyncMockUserGroups(mock_user_groups())), {"Editor": 0.1})
+        security = AsyncFlaskAuthnz(dal, "LogBook")
+        with self.app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "PowerUser"
+            # Both Editor and Operator grant edit; Editor comes first in role order even though its check is slower.
+            self.assertTrue(asyncio.run(security.check_privilege_for_experiment("edit", "xpp123456")))
+            self.assertEqual(security.get_session_roles(), {"LogBook/Editor": ["xpp123456"]})
+
+    def test_async_audit_metrics_and_tracing(self):
+        audit_log = mock.Mock()
+        security = self.make_security(audit_log=audit_log)
+        decisions = get_registry().get("flask_authnz_decisions_total")
+        session_grants = decisions.get(layer="session", result="grant")
+        with self.app.test_request_context('/'):
+            setattr(flask.g, TRACE_ATTRIBUTE, AuthorizationTrace())
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertTrue(asyncio.run(security.check_privilege_for_experiment("read", "xpp123456")))
+            self.assertTrue(asyncio.run(security.check_privilege_for_experiment("read", "xpp123456")))
+            self.assertFalse(asyncio.run(security.check_privilege_for_experiment("edit", "xpp123456")))
+            trace = getattr(flask.g, TRACE_ATTRIBUTE)
+        # As with FlaskAuthnz, each decision is audited, counted and traced along with the layer that made it.
+        self.assertEqual([(x[0][1], x[0][2], x[0][5], x[0][6]) for x in audit_log.record.call_args_list], [
+            ("ReadOnlyUser", "read", True, "dal"),
+            ("ReadOnlyUser", "read", True, "session"),
+            ("ReadOnlyUser", "edit", False, "dal")])
+        self.assertEqual(decisions.get(layer="session", result="grant") - session_grants, 1)
+        self.assertEqual([x["details"]["layer"] for x in trace.events if x["kind"] == "decision"], ["dal", "session", "dal"])
+        self.assertTrue(any([x["kind"] == "mongo" for x in trace.events]))
+        self.assertTrue(any([x["kind"] == "dal" and x["name"] == "has_any_slac_user_role" for x in trace.events]))
+
+    def test_concurrent_queries(self):
+        security = self.make_security(delay=0.1)
+        with self.app.test_request_context('/'):
+            asyncio.run(security.load_privileges())
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp_instrment_operator"
+            start = time.time()
+            self.assertTrue(asyncio.run(security.check_privilege_for_experiment("experiment_switch", "xpp123456", "XPP")))
+            # The global, experiment and instrument roles and the restricted flag are all queried at once.
+            self.assertEqual(self.mgClient.max_in_flight, 4)
+            self.assertTrue(time.time() - start < 0.3)
+
+    def test_async_usergroups(self):
+        backend = CountingAsyncLDAPBackend([{"cn": "ps-data"}, {"cn": "ps-users"}])
+        usergroups = AsyncUserGroups(backend=backend)
+        async def lookup():
+            return await asyncio.gather(*[usergroups.get_user_posix_groups("alice") for _ in range(5)])
+        self.assertEqual(asyncio.run(lookup()), [["ps-data", "ps-users"]]*5)
+        # The concurrent lookups are coalesced and the result is cached.
+        self.assertEqual(len(backend.queries), 1)
+        self.assertEqual(asyncio.run(usergroups.get_user_posix_groups("alice")), ["ps-data", "ps-users"])
+        self.assertEqual(len(backend.queries), 1)
+
+    def test_async_usergroups_refresh_ahead(self):
+        backend = CountingAsyncLDAPBackend([{"cn": ["ps-data", "ps-data-alias"]}])
+        usergroups = AsyncUserGroups(backend=backend)
+        async def lookup():
+            # Entries that are getting old are served while they are refreshed in the background.
+            user_groups_cache.set(("alice",), (["xs"], time.time() - usergroups.refresh_after - 1))
+            self.assertEqual(await usergroups.get_user_posix_groups("alice"), ["xs"])
+            self.assertEqual(await usergroups.get_user_posix_groups("alice"), ["xs"])
+            await asyncio.gather(*usergroups.background_refreshes)
+            self.assertEqual(await usergroups.get_user_posix_groups("alice"), ["ps-data"])
+            self.assertEqual(len(backend.queries), 1)
+            # Entries past the maximum staleness are not served; we wait for LDAP.
+            user_groups_cache.set(("alice",), (["xs"], time.time() - usergroups.max_staleness - 1))
+            self.assertEqual(await usergroups.get_user_posix_groups("alice"), ["ps-data"])
+            self.assertEqual(len(backend.queries), 2)
+        asyncio.run(lookup())
+
+    @mock.patch.dict(os.environ, {"FAKE_LDAP_USERS": "30", "FAKE_LDAP_GROUPS": "10", "FAKE_LDAP_GROUPS_PER_USER": "3"})
+    def test_async_ldap_backend(self):
+        usergroups = AsyncUserGroups(backend=AsyncLDAPBackend(FAKE_LDAPSEARCH))
+        async def lookup():
+            return await asyncio.gather(usergroups.get_user_posix_groups("user0002"), usergroups.get_groups_matching_pattern("group*", limit=3))
+        self.assertEqual(asyncio.run(lookup()), [["group0002", "group0003", "group0004"], ["group0000", "group0001", "group0002"]])
+        with self.assertRaises(ValueError):
+            asyncio.run(AsyncLDAPBackend(["/no/such/ldapsearch"]).search("(uid=alice)", ["uid"]))
+
+    def test_async_ldap_backend_size_limit(self):
+        with mock.patch.dict(os.environ, {"FAKE_LDAP_SIZE_LIMIT": "5"}):
+            # Paged searches get all the entries; unpaged searches that are cut off raise instead of returning partial results.
+            self.assertEqual(len(asyncio.run(AsyncLDAPBackend(FAKE_LDAPSEARCH).search("(objectclass=posixGroup)", ["cn"]))), 200)
+            self.assertEqual(len(asyncio.run(AsyncLDAPBackend(FAKE_LDAPSEARCH).search("(objectclass=posixGroup)", ["cn"], limit=3))), 3)
+            with self.assertRaises(LDAPSizeLimitError):
+                asyncio.run(AsyncLDAPBackend(FAKE_LDAPSEARCH, page_size=0).search("(objectclass=posixGroup)", ["cn"]))
@@ -0,0 +1,72 @@
+import os
+import json
+import shutil
+import unittest
+import logging
+import tempfile
+import flask
+
+from flask_authnz.audit import AuditLog, RotatingFileAuditSink, MongoAuditSink
+from flask_authnz.mongodb_dal import MongoDBRoles
+from flask_authnz.flask_authnz import FlaskAuthnz
+
+from .TestFlaskAuthz import mock_mongo_client, mock_user_groups
+
+logger = logging.getLogger(__name__)
+
+
+class MockAuditCollection(object):
+    def __init__(self):
+        self.batches = []
+
+    def insert_many(self, records, ordered=True):
+        self.batches.append(list(records))
+
+
+class TestAudit(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_audit_log(self):
+        audit_path = os.path.join(self.tmpdir, "audit.log")
+        audit_log = AuditLog(RotatingFileAuditSink(audit_path))
+        security = FlaskAuthnz(MongoDBRoles(mock_mongo_client(), mock_user_groups()), "LogBook", audit_log=audit_log)
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertFalse(security.check_privilege_for_experiment("edit", "xpp123456"))
+        self.assertTrue(audit_log.flush(5))
+        with open(audit_path) as f:
+            records = [json.loads(x) for x in f]
+        self.assertEqual([(x["user"], x["privilege"], x["experiment"], x["result"], x["layer"]) for x in records], [
+            ("ReadOnlyUser", "read", "xpp123456", "grant", "dal"),
+            ("ReadOnlyUser", "read", "xpp123456", "grant", "session"),
+            ("ReadOnlyUser", "edit", "xpp123456", "deny", "dal")])
+        self.assertTrue(all([x["app"] == "LogBook" and x["latency"] >= 0 for x in records]))
+        audit_log.close(5)
+
+    def test_batching_and_sampling(self):
+        collection = MockAuditCollection()
+        audit_log = AuditLog(MongoAuditSink(collection), batch_size=10, flush_interval=60, grant_sample_rate=0.0)
+        for i in range(25):
+            audit_log.record("LogBook", "user%s" % i, "read", "xpp123456", None, i % 5 == 0, "dal", 0.001)
+        audit_log.close(5)
+        # Grants are sampled out; all the denials are written, at most batch_size at a time.
+        self.assertEqual([len(x) for x in collection.batches], [10, 10])
+        self.assertEqual(set([x["result"] for batch in collection.batches for x in batch]), set(["deny"]))
+
+    def test_max_pending(self):
+        collection = MockAuditCollection()
+        audit_log = AuditLog(MongoAuditSink(collection), max_pending=5)
+        # Without a writer in this process, nothing is taken off the queue.
+        audit_log.writer_pid = os.getpid()
+        for i in range(10):
+            audit_log.record("LogBook", "user%s" % i, "read", "xpp123456", None, False, "dal", 0.001)
+        self.assertEqual(audit_log.pending.qsize(), 5)
+
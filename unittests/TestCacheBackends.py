@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import flask
+
+from flask_authnz.cache_backends import InProcessCache, SQLiteCache
+from flask_authnz.decision_cache import DecisionCache
+from flask_authnz.usergroups import UserGroups
+from flask_authnz.mongodb_dal import MongoDBRoles
+from flask_authnz.flask_authnz import FlaskAuthnz
+
+from unittests.TestUserGroups import RecordingLDAPBackend
+from unittests.TestFlaskAuthz import mock_mongo_client, mock_user_groups
+
+
+def set_in_another_process(path, key, value):
+    SQLiteCache(path, "user_groups", 16, 60).set(key, value)
+
+
+class TestCacheBackends(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "flask_authnz_cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_cache(self, cache):
+        self.assertIsNone(cache.get(("alice",)))
+        cache.set(("alice",), ["xs", "ps-data"])
+        cache.set(("bob",), ["xs"], ttl=0)
+        self.assertEqual(list(cache.get(("alice",))), ["xs", "ps-data"])
+        # Entries with a zero TTL expire immediately.
+        self.assertIsNone(cache.get(("bob",)))
+        self.assertEqual(cache.keys(), [("alice",)])
+        cache.delete(("alice",))
+        self.assertIsNone(cache.get(("alice",)))
+        for i in range(10):
+            cache.set(("user%s" % i, None), True)
+        stats = cache.stats()
+        self.assertEqual(stats["size"], 4)
+        self.assertEqual(stats["evictions"], 6)
+        self.assertIsNone(cache.get(("user0", None)))
+        self.assertTrue(cache.get(("user9", None)))
+        cache.clear()
+        self.assertEqual(cache.keys(), [])
+
+    def test_in_process_cache(self):
+        self.check_cache(InProcessCache(4, 60))
+
+    def test_sqlite_cache(self):
+        self.check_cache(SQLiteCache(self.path, "user_groups", 4, 60))
+
+    def test_sqlite_cache_is_shared(self):
+        worker1 = SQLiteCache(self.path, "user_groups", 16, 60)
+        worker2 = SQLiteCache(self.path, "user_groups", 16, 60)
+        decisions = SQLiteCache(self.path, "decisions", 16, 60)
+        worker1.set(("alice",), [["xs"], 1.0])
+        self.assertEqual(worker2.get(("alice",)), [["xs"], 1.0])
+        self.assertIsNone(decisions.get(("alice",)))
+        process = multiprocessing.get_context("spawn").Process(target=set_in_another_process, args=(self.path, ("bob",), [["ps-data"], 2.0]))
+        process.start()
+        process.join()
+        self.assertEqual(worker1.get(("bob",)), [["ps-data"], 2.0])
+
+    def test_shared_decision_cache(self):
+        worker1 = DecisionCache(backend=SQLiteCache(self.path, "decisions", 16, 60), deny_ttl=60)
+        worker2 = DecisionCache(backend=SQLiteCache(self.path, "decisions", 16, 60), deny_ttl=60)
+        worker1.put("alice", "read", "xpp123456", None, True)
+        worker1.put("alice", "edit", "xpp123456", None, False)
+        worker1.put("bob", "read", "mec987654", "MEC", True)
+        self.assertTrue(worker2.get("alice", "read", "xpp123456"))
+        self.assertFalse(worker2.get("alice", "edit", "xpp123456"))
+        worker2.invalidate_experiment("xpp123456")
+        self.assertIsNone(worker1.get("alice", "read", "xpp123456"))
+        self.assertTrue(worker1.get("bob", "read", "mec987654", "MEC"))
+        worker2.invalidate_instrument("MEC")
+        self.assertIsNone(worker1.get("bob", "read", "mec987654", "MEC"))
+
+    def test_shared_decision_cache_across_applications(self):
+        mgClient = mock_mongo_client()
+        mgClient["site"]["roles"].roledata.append({"app": "Other", "name": "Reader", "privileges": ["read"], "players": ["uid:someone_else"]})
+        logbook = FlaskAuthnz(MongoDBRoles(mgClient, mock_user_groups()), "LogBook", decision_cache=DecisionCache(backend=SQLiteCache(self.path, "decisions", 16, 60)))
+        other = FlaskAuthnz(MongoDBRoles(mgClient, mock_user_groups()), "Other", decision_cache=DecisionCache(backend=SQLiteCache(self.path, "decisions", 16, 60)))
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertTrue(logbook.check_privilege_for_experiment("read", "xpp123456"))
+        # A grant in one application is not used for another application.
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertFalse(other.check_privilege_for_experiment("read", "xpp123456"))
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertTrue(logbook.check_privilege_for_experiment("read", "xpp123456"))
+        self.assertEqual(logbook.decision_cache.stats()["hits"], 1)
+        # Reloading the privileges for one application leaves the decisions for the other alone.
+        other.decision_cache.invalidate_application("Other")
+        self.assertEqual(len(list(logbook.decision_cache.cache.keys())), 1)
+
+    def test_shared_user_groups_cache(self):
+        backend = RecordingLDAPBackend([{"dn": "cn=xs,ou=Group,dc=example,dc=com", "cn": "xs"}])
+        worker1 = UserGroups(backend=backend, cache=SQLiteCache(self.path, "user_groups", 16, 60))
+        worker2 = UserGroups(backend=backend, cache=SQLiteCache(self.path, "user_groups", 16, 60))
+        self.assertEqual(worker1.get_user_posix_groups("alice"), ["xs"])
+        self.assertEqual(worker2.get_user_posix_groups("alice"), ["xs"])
+        self.assertEqual(len(backend.queries), 1)
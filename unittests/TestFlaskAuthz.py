@@ -1,10 +1,15 @@
 import unittest
 import logging
 import sys
+import time
+import queue
 import flask
 
 from flask_authnz.mongodb_dal import MongoDBRoles
 from flask_authnz.flask_authnz import FlaskAuthnz
+from flask_authnz.decision_cache import DecisionCache
+from flask_authnz.session_roles import SessionRoles
+from flask_authnz.tracing import init_tracing, trace_header_matches, AuthorizationTrace
 
 from werkzeug.exceptions import HTTPException
 
@@ -25,20 +30,203 @@ class MockUserGroups(object):
         self.user2groupsdict = user2groupsdict
     def get_user_posix_groups(self, user_id):
         return self.user2groupsdict.get(user_id, [])
+    def get_group_members(self, group_name):
+        return sorted([user_id for user_id, groups in self.user2groupsdict.items() if group_name in groups])
 
 class MockDatabase(object):
     def __init__(self, roledata):
         self.roledata = roledata
-    def find(self, params_dict):
+        self.queries = []
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+    def find(self, params_dict, projection=None):
+        self.queries.append(params_dict)
         ret = []
         logger.debug("Looking for dict params %s", params_dict)
         for role in self.roledata:
-            if all(role[key] == params_dict[key] for key in params_dict.keys()):
-                ret.append(role)
+            if all(self.matches(role.get(key, None), params_dict[key]) for key in params_dict.keys()):
+                ret.append(self.project(role, projection))
         logger.debug("Returning %s for dict params %s", ret, params_dict)
         return ret
-    def find_one(self, params_dict):
-        return self.find(params_dict)[0]
+    def find_one(self, params_dict, projection=None):
+        ret = self.find(params_dict, projection)
+        return ret[0] if ret else None
+    def index_information(self):
+        return self.indexes
+    def create_index(self, keys, name=None):
+        self.indexes[name] = {"key": list(keys)}
+        return name
+    @staticmethod
+    def matches(value, criterion):
+        if isinstance(criterion, dict) and "$in" in criterion:
+            return value in criterion["$in"]
+        return value == criterion
+    @staticmethod
+    def project(doc, projection):
+        if not projection:
+            return doc
+        fields = set([k.split(".")[0] for k, v in projection.items() if v])
+        return { k: v for k, v in doc.items() if k in fields }
+
+
+class MockDB(dict):
+    def list_collection_names(self):
+        return list(self.keys())
+    def __missing__(self, collname):
+        # Like pymongo, collections that do not exist are empty.
+        return MockDatabase([])
+    def command(self, command):
+        # Explain a find; this uses an index if any index starts with the fields in the filter.
+        fields = list(command["explain"]["filter"].keys())
+        indexes = [name for name, index in self[command["explain"]["find"]].index_information().items() if [k for k, v in index["key"]][:len(fields)] == fields]
+        plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": indexes[0]}} if indexes else {"stage": "COLLSCAN"}
+        return {"queryPlanner": {"winningPlan": {"stage": "PROJECTION_SIMPLE", "inputStage": plan}}}
+
+class MockClient(dict):
+    def list_database_names(self):
+        return list(self.keys())
+    def __missing__(self, dbname):
+        # Like pymongo, databases that do not exist are empty.
+        return MockDB()
+
+def mock_mongo_client():
+    return MockClient({ k: MockDB(v) for k, v in {
+        "site": {
+            "roles": MockDatabase( [
+                {
+                    "app" : "LogBook",
+                    "name" : "Editor",
+                    "privileges" : [ "read", "post", "manage_shifts", "edit", "delete" ],
+                    "players" : [ "uid:specific_global_editor", "ps_global_editors" ] },
+                {
+                    "app" : "LogBook",
+                    "name" : "Reader",
+                    "privileges" : [ "read"],
+                    "players" : [ "uid:specific_global_reader", "ps_global_readers" ]
+                },
+                {
+                    "app" : "LogBook",
+                    "name" : "Operator",
+                    "privileges" : [ "read", "post", "manage_shifts", "edit", "delete", "experiment_switch" ],
+                    "players" : [ "uid:PowerUser" ]
+                }
+                ] ),
+            "instruments": MockDatabase( [
+                {
+                    "_id" : "XPP",
+                    "name" : "XPP",
+                    "roles": [
+                        {
+                            "app" : "LogBook",
+                            "name" : "Operator",
+                            "players" : [ "ps_xpp" ]
+                        } ],
+                },
+                {
+                    "_id" : "MEC",
+                    "name" : "MEC",
+                    "roles": [
+                        {
+                            "app" : "LogBook",
+                            "name" : "Operator",
+                            "players" : [ "ps_mec" ]
+                        } ],
+                }
+                ] )
+            },
+         "xpp123456": {
+            "info": MockDatabase([{}]),
+            "roles": MockDatabase( [
+                {
+                    "app" : "LogBook",
+                    "name" : "Editor",
+                    "players" : [ "uid:specific_xpp123456_editor", "ps_xpp123456_editors" ] },
+                {
+                    "app" : "LogBook",
+                    "name" : "Reader",
+                    "players" : [ "uid:specific_xpp123456_reader", "ps_xpp123456_readers" ]
+                }
+                ] )
+            },
+         "mec987654": {
+            "info": MockDatabase([{}]),
+            "roles": MockDatabase( [
+                {
+                    "app" : "LogBook",
+                    "name" : "Editor",
+                    "players" : [ "uid:specific_mec987654_editor", "ps_mec987654_editors" ] },
+                {
+                    "app" : "LogBook",
+                    "name" : "Reader",
+                    "players" : [ "uid:specific_mec987654_reader", "ps_mec987654_readers" ]
+                }
+                ] )
+            },
+         "restricted_experiment": {
+            "info": MockDatabase([{"params": {"is_restricted": "true"}}]),
+            "roles": MockDatabase( [
+                {
+                    "app" : "LogBook",
+                    "name" : "Editor",
+                    "players" : [ "uid:specific_restricted_editor", "ps_restricted_editors" ] },
+                {
+                    "app" : "LogBook",
+                    "name" : "Reader",
+                    "players" : [ "uid:specific_restricted_reader", "ps_restricted_readers" ]
+                }
+                ] )
+            }
+        }.items() })
+
+def mock_user_groups():
+    return MockUserGroups( {
+        "PowerUser" : ['ps_global_editors', 'ps_global_readers'],
+        "ReadOnlyUser" : ['ps_global_readers'],
+        "xpp123456_PI" : ["ps_xpp123456_editors"],
+        "xpp123456_readonly" : ["ps_xpp123456_readers"],
+        "xpp_instrment_operator": ["ps_xpp"],
+        "mec_instrment_operator": ["ps_mec"]
+        } )
+
+
+class MockChangeStream(object):
+    """
+    Stand-in for a pymongo change stream; changes are pushed onto a queue by the test.
+    """
+    def __init__(self, changes):
+        self.changes = changes
+        self.alive = True
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.alive = False
+    def try_next(self):
+        try:
+            return self.changes.get(timeout=0.01)
+        except queue.Empty:
+            return None
+
+
+class SlowRoles(object):
+    """
+    A roles DAL that checks one role at a time (no has_any_slac_user_role); some roles take a while or fail.
+    """
+    def __init__(self, dal, delays, errors=()):
+        self.dal = dal
+        self.delays = delays
+        self.errors = errors
+        self.checked = []
+    def getPrivilegesForApplicationRoles(self, application_name):
+        return self.dal.getPrivilegesForApplicationRoles(application_name)
+    def has_slac_user_role(self, user_id, application_name, role_name, experiment_name=None, instrument=None):
+        time.sleep(self.delays.get(role_name, 0))
+        self.checked.append(role_name)
+        if role_name in self.errors:
+            raise ValueError("Cannot check role " + role_name)
+        return self.dal.has_slac_user_role(user_id, application_name, role_name, experiment_name, instrument)
+
+
+def query_count(mgClient):
+    return sum([len(coll.queries) for db in mgClient.values() for coll in db.values()])
 
 
 class TestFlaskAuthz(unittest.TestCase):
@@ -47,101 +235,8 @@ class TestFlaskAuthz(unittest.TestCase):
     We have these users - PowerUser, PI and ReadOnlyUser and various experiment specific and global users
     """
     def test_group_has_editor(self):
-        mgClient = {
-            "site": {
-                "roles": MockDatabase( [
-                    {
-                        "app" : "LogBook",
-                        "name" : "Editor",
-                        "privileges" : [ "read", "post", "manage_shifts", "edit", "delete" ],
-                        "players" : [ "uid:specific_global_editor", "ps_global_editors" ] },
-                    {
-                        "app" : "LogBook",
-                        "name" : "Reader",
-                        "privileges" : [ "read"],
-                        "players" : [ "uid:specific_global_reader", "ps_global_readers" ]
-                    },
-                    {
-                        "app" : "LogBook",
-                        "name" : "Operator",
-                        "privileges" : [ "read", "post", "manage_shifts", "edit", "delete", "experiment_switch" ],
-                        "players" : [ "uid:PowerUser" ]
-                    }
-                    ] ),
-                "instruments": MockDatabase( [
-                    {
-                        "_id" : "XPP",
-                        "name" : "XPP",
-                        "roles": [
-                            {
-                                "app" : "LogBook",
-                                "name" : "Operator",
-                                "players" : [ "ps_xpp" ]
-                            } ],
-                    },
-                    {
-                        "_id" : "MEC",
-                        "name" : "MEC",
-                        "roles": [
-                            {
-                                "app" : "LogBook",
-                                "name" : "Operator",
-                                "players" : [ "ps_mec" ]
-                            } ],
-                    }
-                    ] )
-                },
-             "xpp123456": {
-                "info": MockDatabase([{}]),
-                "roles": MockDatabase( [
-                    {
-                        "app" : "LogBook",
-                        "name" : "Editor",
-                        "players" : [ "uid:specific_xpp123456_editor", "ps_xpp123456_editors" ] },
-                    {
-                        "app" : "LogBook",
-                        "name" : "Reader",
-                        "players" : [ "uid:specific_xpp123456_reader", "ps_xpp123456_readers" ]
-                    }
-                    ] )
-                },
-             "mec987654": {
-                "info": MockDatabase([{}]),
-                "roles": MockDatabase( [
-                    {
-                        "app" : "LogBook",
-                        "name" : "Editor",
-                        "players" : [ "uid:specific_mec987654_editor", "ps_mec987654_editors" ] },
-                    {
-                        "app" : "LogBook",
-                        "name" : "Reader",
-                        "players" : [ "uid:specific_mec987654_reader", "ps_mec987654_readers" ]
-                    }
-                    ] )
-                },
-             "restricted_experiment": {
-                "info": MockDatabase([{"params": {"is_restricted": "true"}}]),
-                "roles": MockDatabase( [
-                    {
-                        "app" : "LogBook",
-                        "name" : "Editor",
-                        "players" : [ "uid:specific_restricted_editor", "ps_restricted_editors" ] },
-                    {
-                        "app" : "LogBook",
-                        "name" : "Reader",
-                        "players" : [ "uid:specific_restricted_reader", "ps_restricted_readers" ]
-                    }
-                    ] )
-                }
-            }
-        mkgp = MockUserGroups( {
-            "PowerUser" : ['ps_global_editors', 'ps_global_readers'],
-            "ReadOnlyUser" : ['ps_global_readers'],
-            "xpp123456_PI" : ["ps_xpp123456_editors"],
-            "xpp123456_readonly" : ["ps_xpp123456_readers"],
-            "xpp_instrment_operator": ["ps_xpp"],
-            "mec_instrment_operator": ["ps_mec"]
-            } )
+        mgClient = mock_mongo_client()
+        mkgp = mock_user_groups()
         dal = MongoDBRoles(mgClient, mkgp)
         security = FlaskAuthnz(dal, "LogBook")
 
@@ -263,3 +358,422 @@ class TestFlaskAuthz(unittest.TestCase):
             with self.assertRaises(HTTPException) as http_error:
                 self.assertFalse(security.authorization_required("edit")(part)("Authorized", **{'experiment_name':'restricted_experiment'}))
                 self.assertEqual(http_error.exception.code, 403)
+
+    def test_decision_cache(self):
+        dal = MongoDBRoles(mock_mongo_client(), mock_user_groups())
+        dal_calls = []
+        has_any_slac_user_role = dal.has_any_slac_user_role
+        def counting_has_any_slac_user_role(*args):
+            dal_calls.append(args)
+            return has_any_slac_user_role(*args)
+        dal.has_any_slac_user_role = counting_has_any_slac_user_role
+        decision_cache = DecisionCache(maxsize=16, grant_ttl=300, deny_ttl=60)
+        security = FlaskAuthnz(dal, "LogBook", decision_cache=decision_cache)
+
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp123456_readonly"
+            self.assertFalse(security.check_privilege_for_experiment("edit", "xpp123456"))
+            denial_calls = len(dal_calls)
+            self.assertTrue(denial_calls > 0)
+            # Denials are cached; we should not go to the database again.
+            self.assertFalse(security.check_privilege_for_experiment("edit", "xpp123456"))
+            self.assertEqual(len(dal_calls), denial_calls)
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertEqual(decision_cache.stats()["hits"], 2)
+            self.assertEqual(decision_cache.stats()["size"], 2)
+
+            decision_cache.invalidate_experiment("mec987654")
+            self.assertEqual(decision_cache.stats()["size"], 2)
+            decision_cache.invalidate_user("xpp123456_readonly")
+            self.assertEqual(decision_cache.stats()["size"], 0)
+            calls_before = len(dal_calls)
+            self.assertFalse(security.check_privilege_for_experiment("edit", "xpp123456"))
+            self.assertTrue(len(dal_calls) > calls_before)
+            decision_cache.invalidate_all()
+            self.assertEqual(decision_cache.stats()["size"], 0)
+
+    def test_decision_cache_ttl(self):
+        decision_cache = DecisionCache(maxsize=2, grant_ttl=300, deny_ttl=0)
+        decision_cache.put("a_user", "read", "xpp123456", None, True)
+        decision_cache.put("a_user", "edit", "xpp123456", None, False)
+        self.assertTrue(decision_cache.get("a_user", "read", "xpp123456"))
+        # Denials with a zero TTL expire immediately.
+        self.assertIsNone(decision_cache.get("a_user", "edit", "xpp123456"))
+        # Least recently used decisions are evicted when the cache is full.
+        decision_cache.put("b_user", "read", None, None, True)
+        decision_cache.put("c_user", "read", None, None, True)
+        self.assertIsNone(decision_cache.get("a_user", "read", "xpp123456"))
+        self.assertTrue(decision_cache.get("c_user", "read"))
+
+    def test_batched_role_lookup(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        self.assertEqual(dal.has_any_slac_user_role("xpp123456_PI", "LogBook", ["Reader", "Editor", "Operator"], "xpp123456", "XPP"), "Editor")
+        # One query each for the experiment info, the site roles, the experiment roles and the instrument.
+        self.assertEqual(query_count(mgClient), 4)
+        self.assertEqual(dal.has_any_slac_user_role("specific_xpp123456_reader", "LogBook", ["Reader", "Editor"], "xpp123456"), "Reader")
+        self.assertEqual(dal.has_any_slac_user_role("PowerUser", "LogBook", ["Operator", "Editor"], "xpp123456"), "Operator")
+        self.assertIsNone(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Reader", "Editor", "Operator"], "restricted_experiment", "XPP"))
+        self.assertEqual(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Reader", "Editor", "Operator"], None, "XPP"), "Operator")
+        self.assertIsNone(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Reader", "Editor", "Operator"], None, "MEC"))
+        self.assertTrue(dal.has_slac_user_role("ReadOnlyUser", "LogBook", "Reader", "mec987654"))
+        self.assertFalse(dal.has_slac_user_role("ReadOnlyUser", "LogBook", "Editor", "mec987654"))
+
+    def test_scope_metadata_cache(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        self.assertEqual(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Operator"], "xpp123456", "XPP"), "Operator")
+        self.assertEqual(query_count(mgClient), 4)
+        # The restricted flag and the instrument roles are now cached; only the roles collections are queried.
+        self.assertEqual(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Operator"], "xpp123456", "XPP"), "Operator")
+        self.assertEqual(query_count(mgClient), 6)
+
+        mgClient["xpp123456"]["info"].roledata[0]["params"] = {"is_restricted": "True"}
+        self.assertEqual(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Operator"], "xpp123456", "XPP"), "Operator")
+        dal.refresh_scope_metadata(experiment_name="xpp123456")
+        self.assertTrue(dal.is_experiment_restricted("xpp123456"))
+        self.assertIsNone(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Operator"], "xpp123456", "XPP"))
+
+        mgClient["site"]["instruments"].roledata[0]["roles"][0]["players"] = []
+        dal.refresh_scope_metadata()
+        self.assertIsNone(dal.has_any_slac_user_role("xpp_instrment_operator", "LogBook", ["Operator"], None, "XPP"))
+
+    def test_reload_privileges(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        decision_cache = DecisionCache()
+        security = FlaskAuthnz(dal, "LogBook", decision_cache=decision_cache)
+        with self.assertRaises(Exception):
+            security.authorization_required("comment")
+        self.assertFalse(security.reload_privileges())
+
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertFalse(security.check_privilege_for_experiment("comment", "xpp123456"))
+            mgClient["site"]["roles"].roledata[1]["privileges"] = [ "read", "comment" ]
+            self.assertTrue(security.reload_privileges())
+            # Cached decisions are dropped when the privileges change.
+            self.assertEqual(decision_cache.stats()["size"], 0)
+            self.assertTrue(security.check_privilege_for_experiment("comment", "xpp123456"))
+
+    def test_privileges_refresher(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        security = FlaskAuthnz(dal, "LogBook", privileges_refresh_interval=0.01)
+        try:
+            # With a refresher, unknown privileges are resolved when the request comes in.
+            authorized = security.authorization_required("comment")(part)
+            app = flask.Flask(__name__)
+            app.secret_key = "This is a secret key that is somewhat temporary."
+            with app.test_request_context('/'):
+                flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+                with self.assertRaises(HTTPException) as http_error:
+                    authorized("Authorized", **{'experiment_name':'xpp123456'})
+                self.assertEqual(http_error.exception.code, 403)
+                mgClient["site"]["roles"].roledata[1]["privileges"] = [ "read", "comment" ]
+                for _ in range(500):
+                    if "comment" in security.priv2roles:
+                        break
+                    time.sleep(0.01)
+                self.assertTrue(authorized("Authorized", **{'experiment_name':'xpp123456'}))
+        finally:
+            security.stop_privileges_refresher()
+        self.assertIsNone(security.privileges_refresher)
+
+    def test_privileges_change_stream(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        changes = queue.Queue()
+        dal.watch_roles = lambda max_await_time_ms=None: MockChangeStream(changes)
+        security = FlaskAuthnz(dal, "LogBook", privileges_refresh_interval=60, use_change_stream=True)
+        try:
+            self.assertNotIn("comment", security.priv2roles)
+            mgClient["site"]["roles"].roledata[1]["privileges"] = [ "read", "comment" ]
+            changes.put({"operationType": "update"})
+            for _ in range(500):
+                if "comment" in security.priv2roles:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(security.priv2roles["comment"], set(["Reader"]))
+        finally:
+            security.stop_privileges_refresher()
+
+    def test_effective_privileges(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        decision_cache = DecisionCache()
+        security = FlaskAuthnz(dal, "LogBook", decision_cache=decision_cache)
+        startup_queries = query_count(mgClient)
+
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp123456_PI"
+            self.assertEqual(security.get_effective_privileges("xpp123456", "XPP"), set(["read", "post", "manage_shifts", "edit", "delete"]))
+            # One query each for the experiment info, the site roles, the experiment roles and the instrument.
+            self.assertEqual(query_count(mgClient) - startup_queries, 4)
+            self.assertEqual(security.get_session_roles(), {"LogBook/Editor": ["xpp123456"]})
+            # The decisions for all the privileges are now cached.
+            self.assertTrue(security.check_privilege_for_experiment("edit", "xpp123456", "XPP"))
+            self.assertFalse(security.check_privilege_for_experiment("experiment_switch", "xpp123456", "XPP"))
+            self.assertEqual(query_count(mgClient) - startup_queries, 4)
+
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertEqual(security.get_effective_privileges("mec987654"), set(["read"]))
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp_instrment_operator"
+            self.assertEqual(security.get_effective_privileges(None, "XPP"), set(["read", "post", "manage_shifts", "edit", "delete", "experiment_switch"]))
+            self.assertEqual(security.get_effective_privileges("restricted_experiment", "XPP"), set())
+
+        with app.test_request_context('/'):
+            flask.g.instrument = "XPP"
+            flask.request.environ["HTTP_REMOTE_USER"] = "specific_restricted_reader"
+            @security.effective_privileges_required
+            def show_buttons(experiment_name):
+                return flask.g.effective_privileges
+            self.assertEqual(show_buttons(experiment_name="restricted_experiment"), set(["read"]))
+
+    def test_filter_experiments(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        decision_cache = DecisionCache()
+        security = FlaskAuthnz(dal, "LogBook", decision_cache=decision_cache)
+        experiments = ["xpp123456", "mec987654", "restricted_experiment"]
+
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertEqual(security.filter_experiments("read", experiments), ["xpp123456", "mec987654"])
+            self.assertEqual(security.filter_experiments("edit", experiments), [])
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp123456_PI"
+            self.assertEqual(security.filter_experiments("edit", experiments), ["xpp123456"])
+            flask.request.environ["HTTP_REMOTE_USER"] = "specific_restricted_reader"
+            self.assertEqual(security.filter_experiments("read", experiments), ["restricted_experiment"])
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp_instrment_operator"
+            self.assertEqual(security.filter_experiments("experiment_switch", experiments, "XPP"), ["xpp123456", "mec987654"])
+            self.assertEqual(security.filter_experiments("experiment_switch", experiments, "MEC"), [])
+            self.assertEqual(security.filter_experiments("no_such_privilege", experiments), [])
+            # These decisions are now cached.
+            queries = query_count(mgClient)
+            self.assertEqual(security.filter_experiments("experiment_switch", experiments, "XPP"), ["xpp123456", "mec987654"])
+            self.assertEqual(query_count(mgClient), queries)
+            self.assertTrue(security.check_privilege_for_experiment("experiment_switch", "mec987654", "XPP"))
+            self.assertEqual(query_count(mgClient), queries)
+
+    def test_users_with_privilege(self):
+        security = FlaskAuthnz(MongoDBRoles(mock_mongo_client(), mock_user_groups()), "LogBook")
+        self.assertEqual(security.get_users_with_privilege("read", "xpp123456"), set([
+            "specific_global_editor", "specific_global_reader", "PowerUser", "ReadOnlyUser",
+            "specific_xpp123456_editor", "specific_xpp123456_reader", "xpp123456_PI", "xpp123456_readonly"]))
+        # Global roles do not apply to restricted experiments.
+        self.assertEqual(security.get_users_with_privilege("read", "restricted_experiment"), set(["specific_restricted_editor", "specific_restricted_reader"]))
+        self.assertEqual(security.get_users_with_privilege("experiment_switch", "xpp123456", "XPP"), set(["PowerUser", "xpp_instrment_operator"]))
+        self.assertEqual(security.get_users_with_privilege("experiment_switch", "mec987654", "MEC"), set(["PowerUser", "mec_instrment_operator"]))
+        self.assertEqual(security.get_users_with_privilege("no_such_privilege", "xpp123456"), set())
+
+    def test_session_roles(self):
+        mgClient = mock_mongo_client()
+        security = FlaskAuthnz(MongoDBRoles(mgClient, mock_user_groups()), "LogBook")
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            # Sessions in the older format are still honored.
+            flask.session[security.session_roles_name] = {"LogBook/Editor": ["mec987654", "__ALL__"]}
+            queries = query_count(mgClient)
+            self.assertTrue(security.check_privilege_for_experiment("edit", "mec987654"))
+            self.assertTrue(security.check_privilege_for_experiment("edit", None))
+            self.assertEqual(query_count(mgClient), queries)
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertEqual(flask.session[security.session_roles_name]["v"], 3)
+            self.assertEqual(security.get_session_roles(), {"LogBook/Editor": ["mec987654", "__ALL__"], "LogBook/Reader": ["xpp123456"]})
+
+    def test_bounded_session_roles(self):
+        session_roles = SessionRoles("LogBook", max_scopes=2, ttl=3600)
+        for experiment_name in ["xpp123456", "mec987654", "xpp654321"]:
+            session_roles.add("Reader", experiment_name)
+        session_roles.add("Editor", "xpp123456")
+        # The least recently granted scope is dropped.
+        self.assertFalse(session_roles.has("Reader", "xpp123456"))
+        self.assertTrue(session_roles.has("Reader", "xpp654321"))
+        self.assertEqual(session_roles.dump()["r"], ["Reader", "Editor"])
+        session_roles.add("Reader", "mec987654")
+        self.assertEqual(SessionRoles.load(session_roles.dump(), "LogBook").as_dict(), {"LogBook/Reader": ["xpp654321", "mec987654"], "LogBook/Editor": ["xpp123456"]})
+
+        expired_roles = SessionRoles("LogBook", ttl=-1)
+        expired_roles.add("Reader", "xpp123456")
+        self.assertFalse(expired_roles.has("Reader", "xpp123456"))
+        self.assertEqual(expired_roles.dump(), {"v": 3, "r": [], "g": []})
+
+    def test_session_roles_cookie_round_trip(self):
+        # Flask's session serializer sorts the keys of dicts; the order of the grants must survive this.
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        serializer = app.session_interface.get_signing_serializer(app)
+        session_roles = SessionRoles("LogBook", max_scopes=3, ttl=3600)
+        for scope in ["zeta", "alpha", "mid"]:
+            session_roles.add("Reader", scope)
+        session_roles = SessionRoles.load(serializer.loads(serializer.dumps({"roles": session_roles.dump()}))["roles"], "LogBook", max_scopes=3)
+        session_roles.add("Reader", "newest")
+        self.assertFalse(session_roles.has("Reader", "zeta"))
+        self.assertEqual(session_roles.as_dict(), {"LogBook/Reader": ["alpha", "mid", "newest"]})
+        # Sessions written in version 2 are ordered by their expiry.
+        now = int(time.time())
+        session_roles = SessionRoles.load({"v": 2, "r": ["Reader"], "g": [{"alpha": now + 20, "mid": now + 30, "zeta": now + 10}]}, "LogBook", max_scopes=3)
+        session_roles.add("Reader", "newest")
+        self.assertEqual(session_roles.as_dict(), {"LogBook/Reader": ["alpha", "mid", "newest"]})
+
+    def test_authorization_index(self):
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, mock_user_groups())
+        authorization_index = dal.enable_authorization_index()
+        security = FlaskAuthnz(dal, "LogBook")
+        stats = authorization_index.stats()
+        self.assertEqual(stats["scopes"], 6)
+        self.assertEqual(stats["restricted_experiments"], 1)
+        self.assertTrue(stats["memory_bytes"] > 0)
+        self.assertTrue(stats["build_time"] >= 0)
+
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        queries = query_count(mgClient)
+        with app.test_request_context('/'):
+            for user_id, priv_name, experiment_name, instrument, expected in [
+                    ("ReadOnlyUser", "read", "xpp123456", None, True),
+                    ("ReadOnlyUser", "edit", "xpp123456", None, False),
+                    ("ReadOnlyUser", "read", "restricted_experiment", None, False),
+                    ("specific_restricted_reader", "read", "restricted_experiment", None, True),
+                    ("xpp123456_PI", "edit", "xpp123456", None, True),
+                    ("xpp123456_PI", "edit", "mec987654", None, False),
+                    ("xpp_instrment_operator", "experiment_switch", "xpp123456", "XPP", True),
+                    ("xpp_instrment_operator", "experiment_switch", "mec987654", "MEC", False),
+                    ("PowerUser", "experiment_switch", None, None, True)]:
+                flask.session.clear()
+                flask.request.environ["HTTP_REMOTE_USER"] = user_id
+                self.assertEqual(security.check_privilege_for_experiment(priv_name, experiment_name, instrument), expected, (user_id, priv_name, experiment_name))
+            self.assertEqual(dal.get_slac_user_roles("PowerUser", "LogBook", ["Editor", "Reader", "Operator"], "xpp123456"), set(["Editor", "Reader", "Operator"]))
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertEqual(security.filter_experiments("read", ["xpp123456", "mec987654", "restricted_experiment"]), ["xpp123456", "mec987654"])
+        # All of these were answered from the index.
+        self.assertEqual(query_count(mgClient), queries)
+
+        # Refresh one experiment after its roles change.
+        mgClient["mec987654"]["roles"].roledata[1]["players"].append("uid:new_mec_reader")
+        self.assertFalse(dal.has_slac_user_role("new_mec_reader", "LogBook", "Reader", "mec987654"))
+        authorization_index.apply_change({"ns": {"db": "mec987654", "coll": "roles"}})
+        self.assertTrue(dal.has_slac_user_role("new_mec_reader", "LogBook", "Reader", "mec987654"))
+        self.assertFalse(dal.has_slac_user_role("new_mec_reader", "LogBook", "Reader", "xpp123456"))
+
+        # Experiment names that do not have an info or roles collection are not added to the index.
+        for experiment_name in ["no_such_experiment", "xpp654321", "admin", "site"]:
+            self.assertFalse(authorization_index.is_experiment_restricted(experiment_name))
+        self.assertEqual(authorization_index.stats()["scopes"], 6)
+        self.assertEqual(len(authorization_index.unknown_experiments), 4)
+        authorization_index.unknown_experiments.clear()
+
+        # Experiments created after the index was built are indexed on first use.
+        mgClient["xpp654321"] = MockDB({"info": MockDatabase([{}]), "roles": MockDatabase([{"app": "LogBook", "name": "Reader", "players": ["uid:new_xpp_reader"]}])})
+        self.assertTrue(dal.has_slac_user_role("new_xpp_reader", "LogBook", "Reader", "xpp654321"))
+        self.assertEqual(authorization_index.stats()["scopes"], 7)
+
+        # Restricted experiments without a roles collection are still restricted; global roles do not apply to them.
+        mgClient["restricted_no_roles"] = MockDB({"info": MockDatabase([{"params": {"is_restricted": "true"}}])})
+        self.assertFalse(MongoDBRoles(mgClient, mock_user_groups()).has_slac_user_role("specific_global_editor", "LogBook", "Editor", "restricted_no_roles"))
+        self.assertFalse(dal.has_slac_user_role("specific_global_editor", "LogBook", "Editor", "restricted_no_roles"))
+        self.assertTrue(authorization_index.is_experiment_restricted("restricted_no_roles"))
+        authorization_index.build()
+        self.assertEqual(authorization_index.stats()["restricted_experiments"], 2)
+        self.assertFalse(dal.has_slac_user_role("specific_global_editor", "LogBook", "Editor", "restricted_no_roles"))
+        self.assertTrue(dal.has_slac_user_role("specific_global_editor", "LogBook", "Editor", "xpp654321"))
+
+    def test_parallel_role_checks(self):
+        dal = SlowRoles(MongoDBRoles(mock_mongo_client(), mock_user_groups()), {"Operator": 0.5})
+        security = FlaskAuthnz(dal, "LogBook", role_check_concurrency=4)
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp123456_PI"
+            start = time.time()
+            self.assertTrue(security.check_privilege_for_experiment("edit", "xpp123456"))
+            # We did not wait for the slow Operator check.
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEqual(security.get_session_roles(), {"LogBook/Editor": ["xpp123456"]})
+            self.assertFalse(security.check_privilege_for_experiment("edit", "mec987654"))
+            self.assertEqual(dal.checked.count("Editor"), 2)
+
+        # When several roles grant the privilege, the first role in role order wins even if its check is slower.
+        dal = SlowRoles(MongoDBRoles(mock_mongo_client(), mock_user_groups()), {"Editor": 0.2})
+        security = FlaskAuthnz(dal, "LogBook", role_check_concurrency=4)
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "PowerUser"
+            self.assertTrue(security.check_privilege_for_experiment("edit", "xpp123456"))
+            self.assertEqual(security.get_session_roles(), {"LogBook/Editor": ["xpp123456"]})
+
+        failing_dal = SlowRoles(MongoDBRoles(mock_mongo_client(), mock_user_groups()), {}, errors=["Operator"])
+        security = FlaskAuthnz(failing_dal, "LogBook", role_check_concurrency=4)
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "xpp123456_PI"
+            # A failed check does not matter if another role grants the privilege.
+            self.assertTrue(security.check_privilege_for_experiment("edit", "xpp123456"))
+            with self.assertRaises(ValueError):
+                security.check_privilege_for_experiment("edit", "mec987654")
+
+    def test_server_timing_trace(self):
+        security = FlaskAuthnz(MongoDBRoles(mock_mongo_client(), mock_user_groups()), "LogBook")
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        init_tracing(app, server_timing=True, log=True, should_trace=trace_header_matches("a trace secret"))
+
+        @app.route("/<experiment_name>/edit")
+        @security.authentication_required
+        @security.authorization_required("edit")
+        def edit(experiment_name):
+            return "Edited"
+
+        client = app.test_client()
+        response = client.get("/xpp123456/edit", headers={"REMOTE_USER": "xpp123456_PI", "X-Authz-Trace": "a trace secret"})
+        self.assertEqual(response.status_code, 200)
+        server_timing = response.headers["Server-Timing"]
+        self.assertTrue(server_timing.startswith('authz;dur='))
+        self.assertTrue('authz-session;desc="Editor scope=xpp123456 result=miss"' in server_timing)
+        self.assertTrue('authz-mongo;dur=' in server_timing)
+        self.assertTrue('desc="edit experiment=xpp123456 instrument=None layer=dal result=grant"' in server_timing)
+        # The second request is answered from the session.
+        response = client.get("/xpp123456/edit", headers={"REMOTE_USER": "xpp123456_PI", "X-Authz-Trace": "a trace secret"})
+        self.assertTrue('authz-session;desc="Editor scope=xpp123456 result=hit"' in response.headers["Server-Timing"])
+        self.assertFalse('authz-mongo' in response.headers["Server-Timing"])
+        response = client.get("/mec987654/edit", headers={"REMOTE_USER": "xpp123456_PI", "X-Authz-Trace": "a trace secret"})
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue("layer=dal result=deny" in response.headers["Server-Timing"])
+        # Requests that do not opt in do not get the header.
+        response = client.get("/xpp123456/edit", headers={"REMOTE_USER": "xpp123456_PI"})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response.headers)
+        response = client.get("/xpp123456/edit", headers={"REMOTE_USER": "xpp123456_PI", "X-Authz-Trace": "a guess"})
+        self.assertNotIn("Server-Timing", response.headers)
+        # Names from the URL cannot break out of the header value.
+        trace = AuthorizationTrace()
+        trace.add("decision", "edit", 0.001, experiment='xpp"\r\nSet-Cookie: x=1')
+        self.assertTrue(trace.server_timing().endswith('desc="edit experiment=xpp\\"  Set-Cookie: x=1"'))
+
+    def test_tracing_defaults(self):
+        security = FlaskAuthnz(MongoDBRoles(mock_mongo_client(), mock_user_groups()), "LogBook")
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        # Without a secret or a predicate, no request gets the header even if server_timing is set.
+        init_tracing(app, server_timing=True)
+
+        @app.route("/<experiment_name>/edit")
+        @security.authentication_required
+        @security.authorization_required("edit")
+        def edit(experiment_name):
+            return "Edited"
+
+        response = app.test_client().get("/xpp123456/edit", headers={"REMOTE_USER": "xpp123456_PI", "X-Authz-Trace": ""})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response.headers)
@@ -0,0 +1,78 @@
+import unittest
+import logging
+import flask
+
+from flask_authnz.metrics import MetricsRegistry, get_registry, to_prometheus_text, metrics_view
+from flask_authnz.mongodb_dal import MongoDBRoles
+from flask_authnz.flask_authnz import FlaskAuthnz
+from flask_authnz.decision_cache import DecisionCache
+from flask_authnz.usergroups import UserGroups, user_groups_cache
+
+from .TestFlaskAuthz import mock_mongo_client, mock_user_groups
+from .TestUserGroups import RecordingLDAPBackend
+
+logger = logging.getLogger(__name__)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_prometheus_text(self):
+        registry = MetricsRegistry()
+        registry.counter("requests_total", "Requests", ["result"]).inc(result="grant")
+        registry.counter("requests_total", "Requests", ["result"]).inc(2, result='d"eny')
+        registry.gauge("entries", "Entries").set_function(lambda: 42)
+        histogram = registry.histogram("latency_seconds", "Latency", ["query"], buckets=(0.1, 1.0))
+        histogram.observe(0.05, query="roles")
+        histogram.observe(0.5, query="roles")
+        with self.assertRaises(ValueError):
+            registry.counter("entries", "Entries")
+        with self.assertRaises(ValueError):
+            histogram.observe(0.5)
+        self.assertEqual(to_prometheus_text(registry).split("\n"), [
+            '# HELP entries Entries',
+            '# TYPE entries gauge',
+            'entries 42',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{query="roles",le="0.1"} 1',
+            'latency_seconds_bucket{query="roles",le="1.0"} 2',
+            'latency_seconds_bucket{query="roles",le="+Inf"} 2',
+            'latency_seconds_sum{query="roles"} 0.55',
+            'latency_seconds_count{query="roles"} 2',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{result="grant"} 1',
+            'requests_total{result="d\\"eny"} 2',
+            ''])
+
+    def test_decision_metrics(self):
+        security = FlaskAuthnz(MongoDBRoles(mock_mongo_client(), mock_user_groups()), "LogBook", decision_cache=DecisionCache())
+        decisions = get_registry().get("flask_authnz_decisions_total")
+        mongo_latency = get_registry().get("flask_authnz_mongo_query_seconds")
+        before = {layer: decisions.get(layer=layer, result="grant") for layer in ["dal", "session", "decision_cache"]}
+        site_queries = mongo_latency.get_count(query="site_roles")
+        app = flask.Flask(__name__)
+        app.secret_key = "This is a secret key that is somewhat temporary."
+        with app.test_request_context('/'):
+            flask.request.environ["HTTP_REMOTE_USER"] = "ReadOnlyUser"
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            security.decision_cache.invalidate_all()
+            self.assertTrue(security.check_privilege_for_experiment("read", "xpp123456"))
+            self.assertEqual(decisions.get(layer="dal", result="grant"), before["dal"] + 1)
+            self.assertEqual(decisions.get(layer="decision_cache", result="grant"), before["decision_cache"] + 1)
+            self.assertEqual(decisions.get(layer="session", result="grant"), before["session"] + 1)
+            self.assertEqual(mongo_latency.get_count(query="site_roles"), site_queries + 1)
+            response = metrics_view()()
+            self.assertTrue('flask_authnz_decisions_total{layer="session",result="grant"}' in response.get_data(as_text=True))
+            self.assertTrue('flask_authnz_cache_entries{cache="decisions"} 1' in response.get_data(as_text=True))
+
+    def test_ldap_metrics(self):
+        user_groups_cache.clear()
+        usergroups = UserGroups(backend=RecordingLDAPBackend([{"cn": "ps-data"}]))
+        ldap_latency = get_registry().get("flask_authnz_ldap_query_seconds")
+        cache_requests = get_registry().get("flask_authnz_cache_requests_total")
+        queries, hits = ldap_latency.get_count(query="user_groups"), cache_requests.get(cache="user_groups", result="hit")
+        usergroups.get_user_posix_groups("alice")
+        usergroups.get_user_posix_groups("alice")
+        self.assertEqual(ldap_latency.get_count(query="user_groups"), queries + 1)
+        self.assertEqual(cache_requests.get(cache="user_groups", result="hit"), hits + 1)
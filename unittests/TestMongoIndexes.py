@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+import logging
+
+from flask_authnz.mongodb_dal import MongoDBRoles
+from flask_authnz.mongo_indexes import roles_databases, plan_stages, main, ROLES_INDEX_NAME
+
+from .TestFlaskAuthz import mock_mongo_client, mock_user_groups, MockDB, MockDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class TestMongoIndexes(unittest.TestCase):
+    def setUp(self):
+        self.mgClient = mock_mongo_client()
+        self.mgClient["admin"] = MockDB({"roles": MockDatabase([])})
+        self.mgClient["no_roles"] = MockDB({"info": MockDatabase([{}])})
+        self.dal = MongoDBRoles(self.mgClient, mock_user_groups())
+
+    def test_ensure_indexes(self):
+        self.assertEqual(roles_databases(self.mgClient), ["site", "mec987654", "restricted_experiment", "xpp123456"])
+        report = self.dal.verify_indexes("LogBook", ["Reader", "Editor"])
+        self.assertEqual(sorted(report.keys()), ["mec987654", "restricted_experiment", "site", "xpp123456"])
+        self.assertTrue(all([x["collection_scan"] and not x["has_index"] for x in report.values()]))
+
+        self.assertEqual(self.dal.ensure_indexes(), ["site", "mec987654", "restricted_experiment", "xpp123456"])
+        self.assertIn(ROLES_INDEX_NAME, self.mgClient["xpp123456"]["roles"].index_information())
+        report = self.dal.verify_indexes("LogBook", ["Reader", "Editor"])
+        self.assertTrue(all([x["has_index"] and not x["collection_scan"] for x in report.values()]))
+        self.assertEqual(report["site"]["stages"], ["PROJECTION_SIMPLE", "FETCH", "IXSCAN"])
+        # Existing indexes are left alone.
+        self.assertEqual(self.dal.ensure_indexes(), [])
+
+    def test_main_needs_app_and_roles(self):
+        # The role queries are explained with the application and role names that the caller gives us; there are no defaults.
+        for argv in (["mongodb://localhost"], ["mongodb://localhost", "--app", "LogBook"], ["mongodb://localhost", "--role", "Reader"]):
+            with mock.patch("sys.argv", ["mongo_indexes"] + argv), mock.patch("sys.stderr"):
+                with self.assertRaises(SystemExit):
+                    main()
+
+    def test_plan_stages(self):
+        sharded = {"stage": "SHARD_MERGE", "shards": [{"winningPlan": {"queryPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}, {"winningPlan": {"stage": "COLLSCAN"}}]}
+        self.assertEqual(plan_stages(sharded), ["SHARD_MERGE", "FETCH", "IXSCAN", "COLLSCAN"])
+
+    def test_lean_projections(self):
+        roles = self.mgClient["site"]["roles"]
+        with mock.patch.object(roles, "find", wraps=roles.find) as find:
+            self.assertEqual(self.dal.getPrivilegesForApplicationRoles("LogBook")["experiment_switch"], set(["Operator"]))
+            self.dal.get_role_players("LogBook", ["Reader"], "xpp123456")
+        self.assertEqual([x[0][1] for x in find.call_args_list], [{"_id": 0, "name": 1, "privileges": 1}, {"_id": 0, "name": 1, "players": 1}])
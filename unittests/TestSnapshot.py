@@ -0,0 +1,71 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import logging
+
+from flask_authnz.usergroups import UserGroups, user_groups_cache_max_staleness_in_seconds
+from flask_authnz.mongodb_dal import MongoDBRoles
+from flask_authnz.cache_backends import InProcessCache
+from flask_authnz.snapshot import CacheSnapshot, write_snapshot, read_snapshot, SNAPSHOT_VERSION
+
+from .TestFlaskAuthz import mock_mongo_client, query_count
+from .TestUserGroups import RecordingLDAPBackend
+
+logger = logging.getLogger(__name__)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "authz_snapshot.json.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_warm_start(self):
+        usergroups = UserGroups(backend=RecordingLDAPBackend([{"cn": "ps-data"}]), cache=InProcessCache(100, 3600))
+        dal = MongoDBRoles(mock_mongo_client(), usergroups)
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["ps-data"])
+        self.assertFalse(dal.is_experiment_restricted("xpp123456"))
+        self.assertTrue(dal.is_experiment_restricted("restricted_experiment"))
+        self.assertEqual(dal.get_instrument_roles("XPP"), {"LogBook": {"Operator": frozenset(["ps_xpp"])}})
+        CacheSnapshot(self.path, dal, usergroups).save()
+
+        # A new worker; the caches are loaded from the snapshot and revalidated in the background.
+        backend = RecordingLDAPBackend([{"cn": "ps-data"}, {"cn": "ps-users"}])
+        usergroups = UserGroups(backend=backend, cache=InProcessCache(100, 3600))
+        mgClient = mock_mongo_client()
+        dal = MongoDBRoles(mgClient, usergroups)
+        self.assertTrue(CacheSnapshot(self.path, dal, usergroups).load())
+        self.assertTrue(wait_for(lambda: query_count(mgClient) == 3))
+        self.assertTrue(dal.is_experiment_restricted("restricted_experiment"))
+        self.assertEqual(dal.get_instrument_roles("XPP"), {"LogBook": {"Operator": frozenset(["ps_xpp"])}})
+        self.assertEqual(query_count(mgClient), 3)
+        # The stale groups are served and refreshed in the background.
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["ps-data"])
+        self.assertTrue(wait_for(lambda: usergroups.get_user_posix_groups("alice") == ["ps-data", "ps-users"]))
+        self.assertEqual(len(backend.queries), 1)
+
+    def test_snapshot_file(self):
+        self.assertIsNone(read_snapshot(self.path))
+        with open(self.path, "w") as f:
+            f.write("Not a snapshot")
+        self.assertIsNone(read_snapshot(self.path))
+        now = time.time()
+        write_snapshot(self.path, {"version": SNAPSHOT_VERSION, "written_at": now, "user_groups": {
+            "alice": [["ps-data"], now - 10],
+            "bob": [["ps-data"], now - user_groups_cache_max_staleness_in_seconds - 10]}})
+        self.assertEqual(os.listdir(self.tmpdir), ["authz_snapshot.json.gz"])
+        usergroups = UserGroups(backend=RecordingLDAPBackend([]), cache=InProcessCache(100, 3600))
+        self.assertTrue(CacheSnapshot(self.path, usergroups=usergroups).load())
+        # Entries past the maximum staleness are not loaded.
+        self.assertEqual(sorted(usergroups.get_cache_snapshot().keys()), ["alice"])
@@ -0,0 +1,428 @@
+import gc
+import os
+import sys
+import time
+import base64
+import unittest
+import warnings
+import threading
+from unittest import mock
+import logging
+
+from flask_authnz.usergroups import UserGroups, GroupMembershipIndex, user_groups_cache, group_members_cache
+from flask_authnz.directory_index import DirectoryIndex
+from flask_authnz.ldap_backends import PooledLDAPBackend, SubprocessLDAPBackend, LDAPSizeLimitError, parse_ldapsearch_response, iter_ldif_entries
+
+try:
+    import ldap3
+except ImportError:
+    ldap3 = None
+
+logger = logging.getLogger(__name__)
+
+LDAP_ENTRIES = {
+    "cn=ps-data,ou=Group,dc=example,dc=com": {"objectClass": ["top", "posixGroup"], "cn": "ps-data", "gidNumber": "1000", "memberUid": ["alice", "bob"]},
+    "cn=ps-users,ou=Group,dc=example,dc=com": {"objectClass": ["top", "posixGroup"], "cn": "ps-users", "gidNumber": "1001", "memberUid": ["alice", "bob", "carol"]},
+    "cn=xs,ou=Group,dc=example,dc=com": {"objectClass": ["top", "posixGroup"], "cn": "xs", "gidNumber": "1002", "memberUid": ["alice"]},
+    "uid=alice,ou=People,dc=example,dc=com": {"objectClass": ["top", "posixAccount"], "uid": "alice", "cn": "Alice Liddell", "gecos": "Alice Liddell", "uidNumber": "2000"},
+    "uid=bob,ou=People,dc=example,dc=com": {"objectClass": ["top", "posixAccount"], "uid": "bob", "cn": "Bob Builder", "gecos": "Bob Builder", "uidNumber": "2001"},
+}
+
+LDAPSEARCH_RESPONSE = """# extended LDIF
+#
+# LDAPv3
+# base <dc=example,dc=com> (default) with scope subtree
+# filter: (&(objectclass=posixGroup)(cn=ps-*))
+# requesting: cn memberUid
+#
+
+# ps-data, Group, example.com
+dn: cn=ps-data,ou=Group,dc=example,dc=com
+cn: ps-data
+memberUid: alice
+memberUid: bob
+
+# ps-users, Group, example.com
+dn: cn=ps-users,ou=Group,dc=example,dc=com
+cn: ps-users
+memberUid: carol
+
+# search result
+search: 2
+result: 0 Success
+
+# numResponses: 3
+# numEntries: 2
+"""
+
+
+FAKE_LDAPSEARCH = [sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_ldapsearch.py")]
+
+
+def mock_ldap_connection():
+    server = ldap3.Server("mock_ldap")
+    conn = ldap3.Connection(server, user="cn=reader,dc=example,dc=com", password="secret", client_strategy=ldap3.MOCK_SYNC)
+    conn.strategy.add_entry("cn=reader,dc=example,dc=com", {"objectClass": "person", "sn": "reader", "userPassword": "secret"})
+    for dn, attrs in LDAP_ENTRIES.items():
+        conn.strategy.add_entry(dn, attrs)
+    conn.bind()
+    return conn
+
+
+class RecordingLDAPBackend(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.queries = []
+    def search(self, filterstr, attributes, limit=None):
+        self.queries.append((filterstr, attributes))
+        return self.entries[:limit]
+    def iter_search(self, filterstr, attributes, limit=None):
+        return iter(self.search(filterstr, attributes, limit))
+
+
+class BlockingLDAPBackend(RecordingLDAPBackend):
+    """
+    Blocks each search until the test releases it; optionally fails the search.
+    """
+    def __init__(self, entries):
+        super(BlockingLDAPBackend, self).__init__(entries)
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.error = None
+    def search(self, filterstr, attributes, limit=None):
+        self.started.set()
+        self.release.wait(10)
+        if self.error:
+            self.queries.append((filterstr, attributes))
+            raise ValueError(self.error)
+        return super(BlockingLDAPBackend, self).search(filterstr, attributes, limit)
+
+
+class TestUserGroups(unittest.TestCase):
+    def setUp(self):
+        user_groups_cache.clear()
+
+    def run_concurrently(self, fn, count):
+        results, errors = [], []
+        def call():
+            try:
+                results.append(fn())
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+    def test_parse_ldapsearch_response(self):
+        entries = parse_ldapsearch_response(LDAPSEARCH_RESPONSE)
+        self.assertEqual([x["cn"] for x in entries], ["ps-data", "ps-users"])
+        self.assertEqual(entries[0]["memberUid"], ["alice", "bob"])
+        self.assertEqual(entries[1]["memberUid"], "carol")
+
+    def test_parse_ldif_continuations(self):
+        ldif = [
+            "# a comment that is",
+            "  continued on the next line",
+            "dn: cn=a-group-with-a-long-name,ou=Gr",
+            " oup,dc=example,dc=com",
+            "cn:: " + base64.b64encode("a-gröup".encode("utf-8")).decode("ascii"),
+            "description: A description that is fol",
+            " ded",
+            "memberUid: alice",
+            "",
+            "dn: cn=b,ou=Group,dc=example,dc=com",
+            "cn: b"
+        ]
+        entries = iter_ldif_entries(ldif)
+        entry = next(entries)
+        self.assertEqual(entry["dn"], "cn=a-group-with-a-long-name,ou=Group,dc=example,dc=com")
+        self.assertEqual(entry["cn"], "a-gröup")
+        self.assertEqual(entry["description"], "A description that is folded")
+        self.assertEqual(entry["memberUid"], "alice")
+        self.assertEqual(next(entries)["cn"], "b")
+        with self.assertRaises(StopIteration):
+            next(entries)
+
+    @mock.patch.dict(os.environ, {"FAKE_LDAP_USERS": "30", "FAKE_LDAP_GROUPS": "10", "FAKE_LDAP_GROUPS_PER_USER": "3"})
+    def test_subprocess_backend(self):
+        usergroups = UserGroups(backend=SubprocessLDAPBackend(FAKE_LDAPSEARCH))
+        self.assertEqual(usergroups.get_user_posix_groups("user0002"), ["group0002", "group0003", "group0004"])
+        self.assertEqual(usergroups.get_group_members("group0000"), ["user0000", "user0008", "user0009", "user0010", "user0018", "user0019", "user0020", "user0028", "user0029"])
+        self.assertEqual(len(usergroups.get_groups_matching_pattern("group*")), 10)
+        self.assertEqual(usergroups.get_groups_matching_pattern("group*", limit=3), ["group0000", "group0001", "group0002"])
+        self.assertEqual([x["uid"] for x in usergroups.get_userids_matching_pattern("user001*", limit=2)], ["user0010", "user0011"])
+        # Stop reading early; the ldapsearch process is cleaned up.
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            entries = SubprocessLDAPBackend(FAKE_LDAPSEARCH).iter_search("(objectclass=posixAccount)", ["uid"])
+            self.assertEqual(next(entries)["uid"], "user0000")
+            entries.close()
+            del entries
+            gc.collect()
+        self.assertEqual([str(x.message) for x in caught if issubclass(x.category, ResourceWarning)], [])
+
+    def test_subprocess_backend_size_limit(self):
+        with mock.patch.dict(os.environ, {"FAKE_LDAP_SIZE_LIMIT": "5"}):
+            # Paged searches get all the entries.
+            self.assertEqual(len(SubprocessLDAPBackend(FAKE_LDAPSEARCH).search("(objectclass=posixGroup)", ["cn"])), 200)
+            self.assertEqual(len(SubprocessLDAPBackend(FAKE_LDAPSEARCH).search("(objectclass=posixGroup)", ["cn"], limit=3)), 3)
+            backend = SubprocessLDAPBackend(FAKE_LDAPSEARCH, page_size=0)
+            with self.assertRaises(LDAPSizeLimitError):
+                backend.search("(objectclass=posixGroup)", ["cn"])
+            # A truncated refresh does not replace the current snapshot.
+            index = GroupMembershipIndex(SubprocessLDAPBackend(FAKE_LDAPSEARCH), refresh_interval=3600)
+            index.refresh()
+            index.backend = backend
+            with self.assertRaises(ValueError):
+                index.refresh()
+            self.assertEqual(index.size()["groups"], 200)
+            self.assertIn("group0199", index.get_user_posix_groups("user0999"))
+
+    def test_directory_index_size_limit(self):
+        with mock.patch.dict(os.environ, {"FAKE_LDAP_SIZE_LIMIT": "5"}):
+            index = DirectoryIndex(SubprocessLDAPBackend(FAKE_LDAPSEARCH), refresh_interval=3600)
+            index.refresh()
+            self.assertEqual(index.size(), {"users": 1000, "groups": 200})
+            self.assertEqual([x["uid"] for x in index.search_users("user0999")], ["user0999"])
+            # A truncated refresh does not replace the current snapshot.
+            loaded_at = index.snapshot.loaded_at
+            index.backend = SubprocessLDAPBackend(FAKE_LDAPSEARCH, page_size=0)
+            with self.assertRaises(ValueError):
+                index.refresh()
+            self.assertEqual(index.snapshot.loaded_at, loaded_at)
+            self.assertEqual(index.size(), {"users": 1000, "groups": 200})
+
+    @unittest.skipUnless(ldap3, "The pooled LDAP backend needs ldap3")
+    def test_pooled_backend_paging(self):
+        backend = PooledLDAPBackend(base="dc=example,dc=com", pool_size=1, connection_factory=mock_ldap_connection, page_size=1)
+        self.assertEqual(sorted([x["cn"] for x in backend.search("(objectClass=posixGroup)", ["cn"])]), ["ps-data", "ps-users", "xs"])
+        self.assertEqual(len(backend.search("(objectClass=posixGroup)", ["cn"], limit=2)), 2)
+
+        def size_limited_connection():
+            conn = mock_ldap_connection()
+            search = conn.search
+            def size_limited_search(*args, **kwargs):
+                search(*args, **kwargs)
+                if len(conn.response) > 1:
+                    conn.response = conn.response[:1]
+                    raise ldap3.core.exceptions.LDAPSizeLimitExceededResult()
+            conn.search = size_limited_search
+            return conn
+        fallback = RecordingLDAPBackend([{"cn": "xs"}])
+        backend = PooledLDAPBackend(base="dc=example,dc=com", pool_size=1, connection_factory=size_limited_connection, fallback=fallback, page_size=0)
+        with self.assertRaises(LDAPSizeLimitError):
+            backend.search("(objectClass=posixGroup)", ["cn"])
+        # Truncated results are not passed on to the fallback backend, which is subject to the same size limit.
+        self.assertEqual(fallback.queries, [])
+        self.assertEqual(len(backend.search("(objectClass=posixGroup)", ["cn"], limit=2)), 1)
+        backend = PooledLDAPBackend(base="dc=example,dc=com", pool_size=1, connection_factory=size_limited_connection, page_size=1)
+        self.assertEqual(len(backend.search("(objectClass=posixGroup)", ["cn"])), 3)
+
+    @unittest.skipUnless(ldap3, "The pooled LDAP backend needs ldap3")
+    def test_pooled_backend(self):
+        backend = PooledLDAPBackend(base="dc=example,dc=com", pool_size=2, connection_factory=mock_ldap_connection)
+        usergroups = UserGroups(backend=backend)
+        self.assertEqual(sorted(usergroups.get_user_posix_groups("alice")), ["ps-data", "ps-users", "xs"])
+        self.assertEqual(usergroups.get_group_members("ps-data"), ["alice", "bob"])
+        self.assertEqual(usergroups.get_group_members("xs"), ["alice"])
+        self.assertEqual(usergroups.get_group_members("no_such_group"), [])
+        self.assertEqual(sorted(usergroups.get_groups_matching_pattern("ps-*")), ["ps-data", "ps-users"])
+        users = usergroups.get_userids_matching_pattern("b*")
+        self.assertEqual(len(users), 1)
+        self.assertEqual(users[0]["gecos"], "Bob Builder")
+        self.assertEqual(len(usergroups.get_groups_matching_pattern("*", limit=2)), 2)
+        # The connection is reused across queries.
+        self.assertEqual(backend.connections_created, 1)
+        backend.close()
+        self.assertEqual(backend.connections_created, 0)
+
+    @unittest.skipUnless(ldap3, "The pooled LDAP backend needs ldap3")
+    def test_pooled_backend_fallback(self):
+        def broken_connection():
+            raise Exception("Cannot reach the directory")
+        fallback = RecordingLDAPBackend([{"dn": "cn=xs,ou=Group,dc=example,dc=com", "memberUid": "alice"}])
+        backend = PooledLDAPBackend(base="dc=example,dc=com", connection_factory=broken_connection, fallback=fallback)
+        self.assertEqual(UserGroups(backend=backend).get_group_members("xs"), ["alice"])
+        self.assertEqual(len(fallback.queries), 1)
+        self.assertEqual(backend.connections_created, 0)
+        with self.assertRaises(ValueError):
+            PooledLDAPBackend(base="dc=example,dc=com", connection_factory=broken_connection).search("(cn=xs)", ["memberUid"])
+
+    def test_group_membership_index(self):
+        backend = RecordingLDAPBackend([
+            {"dn": "cn=ps-data,ou=Group,dc=example,dc=com", "cn": "ps-data", "memberUid": ["alice", "bob"]},
+            {"dn": "cn=xs,ou=Group,dc=example,dc=com", "cn": "xs", "memberUid": "alice"},
+            {"dn": "cn=empty,ou=Group,dc=example,dc=com", "cn": "empty"}
+            ])
+        usergroups = UserGroups(backend=backend, group_index_refresh_interval=3600)
+        try:
+            self.assertEqual(len(backend.queries), 1)
+            self.assertEqual(usergroups.get_user_posix_groups("alice"), ["ps-data", "xs"])
+            self.assertEqual(usergroups.get_user_posix_groups("bob"), ["ps-data"])
+            self.assertEqual(usergroups.get_user_posix_groups("carol"), [])
+            self.assertEqual(usergroups.get_group_members("ps-data"), ["alice", "bob"])
+            self.assertEqual(usergroups.get_group_members("xs"), ["alice"])
+            self.assertEqual(usergroups.get_group_members("empty"), [])
+            # All of these are answered from the snapshot.
+            self.assertEqual(len(backend.queries), 1)
+            self.assertEqual(usergroups.membership_index.size(), {"groups": 3, "users": 2, "memberships": 3})
+            self.assertTrue(usergroups.membership_index.age() < 60)
+
+            backend.entries = backend.entries[1:]
+            usergroups.membership_index.refresh()
+            self.assertEqual(usergroups.get_user_posix_groups("alice"), ["xs"])
+            self.assertEqual(usergroups.membership_index.size()["groups"], 2)
+        finally:
+            usergroups.membership_index.stop_refresher()
+
+    def test_stale_group_membership_index(self):
+        backend = RecordingLDAPBackend([{"dn": "cn=xs,ou=Group,dc=example,dc=com", "cn": "xs", "memberUid": "alice"}])
+        index = GroupMembershipIndex(backend, refresh_interval=60, max_age=60)
+        self.assertIsNone(index.get_user_posix_groups("alice"))
+        self.assertIsNone(index.age())
+        index.refresh()
+        self.assertEqual(index.get_user_posix_groups("alice"), ["xs"])
+        index.snapshot = index.snapshot._replace(loaded_at=index.snapshot.loaded_at - 120)
+        self.assertIsNone(index.get_user_posix_groups("alice"))
+        self.assertIsNone(index.get_group_members("xs"))
+
+    def test_directory_index(self):
+        users = [{"uid": "bob", "cn": "Bob Builder", "gecos": "Bob Builder", "uidNumber": "2001"}, {"uid": "alice", "cn": "Alice Liddell", "gecos": "Alice Liddell", "uidNumber": "2000"}, {"uid": "carol", "cn": "Carol Alice", "gecos": "Carol Alice", "uidNumber": "2002"}]
+        groups = [{"cn": "xs", "gidNumber": "1002"}, {"cn": "ps-users", "gidNumber": "1001"}, {"cn": "ps-data", "gidNumber": "1000"}]
+        backend = RecordingLDAPBackend([])
+        backend.search = lambda filterstr, attributes, limit=None: backend.queries.append((filterstr, attributes)) or (users if "posixAccount" in filterstr else groups)[:limit]
+        usergroups = UserGroups(backend=backend, directory_index_refresh_interval=3600)
+        try:
+            self.assertEqual(len(backend.queries), 2)
+            self.assertEqual(usergroups.directory_index.size(), {"users": 3, "groups": 3})
+            self.assertEqual(usergroups.get_groups_matching_pattern("ps-*"), ["ps-data", "ps-users"])
+            self.assertEqual(usergroups.get_groups_matching_pattern("PS-*", limit=1, offset=1), ["ps-users"])
+            self.assertEqual(usergroups.get_groups_matching_pattern("*users*"), ["ps-users"])
+            self.assertEqual(usergroups.get_groups_matching_pattern("p*-data"), ["ps-data"])
+            self.assertEqual([x["uid"] for x in usergroups.get_userids_matching_pattern("alice*")], ["alice"])
+            self.assertEqual([x["uid"] for x in usergroups.get_userids_matching_pattern("*ALICE*")], ["alice", "carol"])
+            self.assertEqual([x["uid"] for x in usergroups.get_userids_matching_pattern("*build*")], ["bob"])
+            self.assertEqual([x["uid"] for x in usergroups.get_userids_matching_pattern("carol")], ["carol"])
+            self.assertEqual(len(backend.queries), 2)
+            # Patterns that do not match anything in the snapshot are looked up in LDAP in case they are new.
+            self.assertEqual(usergroups.get_userids_matching_pattern("dave*"), users)
+            self.assertEqual(len(backend.queries), 3)
+            # We do not use snapshots that are too old.
+            index = usergroups.directory_index
+            index.snapshot = index.snapshot._replace(loaded_at=index.snapshot.loaded_at - index.max_age - 1)
+            self.assertIsNone(index.search_groups("ps-*"))
+            self.assertEqual(usergroups.get_groups_matching_pattern("ps-*", limit=2, offset=1), ["ps-users", "ps-data"])
+            self.assertEqual(backend.queries[-1][0], "(&(objectclass=posixGroup)(cn=ps-*))")
+        finally:
+            usergroups.directory_index.stop_refresher()
+
+    def test_coalesce_concurrent_lookups(self):
+        backend = BlockingLDAPBackend([{"dn": "cn=xs,ou=Group,dc=example,dc=com", "cn": "xs", "memberUid": "alice"}])
+        usergroups = UserGroups(backend=backend)
+        threads, results, errors = self.run_concurrently(lambda: usergroups.get_user_posix_groups("alice"), 8)
+        backend.started.wait(10)
+        while usergroups.inflight.coalesced < 7:
+            threading.Event().wait(0.001)
+        backend.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [["xs"]]*8)
+        self.assertEqual(len(backend.queries), 1)
+        self.assertEqual(usergroups.inflight.in_flight(), 0)
+        # The result is now cached.
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["xs"])
+        self.assertEqual(len(backend.queries), 1)
+
+    def test_coalesce_concurrent_errors(self):
+        backend = BlockingLDAPBackend([{"dn": "cn=xs,ou=Group,dc=example,dc=com", "cn": "xs", "memberUid": "alice"}])
+        backend.error = "Cannot reach the directory"
+        usergroups = UserGroups(backend=backend)
+        threads, results, errors = self.run_concurrently(lambda: usergroups.get_group_members("xs"), 4)
+        backend.started.wait(10)
+        while usergroups.inflight.coalesced < 3:
+            threading.Event().wait(0.001)
+        backend.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(len(backend.queries), 1)
+        # Errors are not remembered.
+        backend.error = None
+        self.assertEqual(usergroups.get_group_members("xs"), ["alice"])
+
+    def wait_for_background_refresh(self, usergroups):
+        for _ in range(1000):
+            with usergroups.refreshing_lock:
+                if not usergroups.refreshing:
+                    return
+            time.sleep(0.01)
+
+    def test_refresh_ahead(self):
+        backend = RecordingLDAPBackend([{"dn": "cn=ps-data,ou=Group,dc=example,dc=com", "cn": "ps-data"}])
+        usergroups = UserGroups(backend=backend)
+        user_groups_cache.set(("alice",), (["xs"], time.time() - usergroups.refresh_after - 1))
+        # The old entry is served while it is refreshed in the background.
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["xs"])
+        self.wait_for_background_refresh(usergroups)
+        self.assertEqual(len(backend.queries), 1)
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["ps-data"])
+        self.assertEqual(len(backend.queries), 1)
+
+    def test_bulk_user_groups(self):
+        backend = RecordingLDAPBackend([{"cn": x["cn"], "memberUid": x["memberUid"]} for x in LDAP_ENTRIES.values() if "memberUid" in x])
+        usergroups = UserGroups(backend=backend)
+        user_groups_cache.set(("dave",), (["admins"], time.time()))
+        with mock.patch("flask_authnz.usergroups.bulk_lookup_chunk_size", 2):
+            user_groups = usergroups.get_user_posix_groups_bulk(["alice", "bob", "carol", "dave", "alice"])
+        self.assertEqual(user_groups, {"alice": ["ps-data", "ps-users", "xs"], "bob": ["ps-data", "ps-users"], "carol": ["ps-users"], "dave": ["admins"]})
+        self.assertEqual([x[0] for x in backend.queries], [
+            "(&(objectclass=posixGroup)(|(memberUid=alice)(memberUid=bob)))",
+            "(&(objectclass=posixGroup)(|(memberUid=carol)))"])
+        # The results are in the cache.
+        self.assertEqual(usergroups.get_user_posix_groups("carol"), ["ps-users"])
+        self.assertEqual(len(backend.queries), 2)
+        # Multi valued cn's; we use the first value.
+        user_groups_cache.clear()
+        backend.entries = [{"cn": ["ps-data", "ps-data-alias"], "memberUid": ["alice", "bob"]}, {"cn": "xs", "memberUid": "alice"}]
+        self.assertEqual(usergroups.get_user_posix_groups_bulk(["alice", "bob"]), {"alice": ["ps-data", "xs"], "bob": ["ps-data"]})
+
+    def test_bulk_group_members(self):
+        group_members_cache.clear()
+        backend = RecordingLDAPBackend([{"cn": x["cn"], "memberUid": x["memberUid"]} for x in LDAP_ENTRIES.values() if "memberUid" in x])
+        usergroups = UserGroups(backend=backend)
+        self.assertEqual(usergroups.get_group_members_bulk(["ps-data", "xs", "no_such_group"]), {"ps-data": ["alice", "bob"], "xs": ["alice"], "no_such_group": []})
+        self.assertEqual([x[0] for x in backend.queries], ["(&(objectclass=posixGroup)(|(cn=ps-data)(cn=xs)(cn=no_such_group)))"])
+        # Only the groups that are not in the cache are looked up.
+        self.assertEqual(usergroups.get_group_members_bulk(["xs", "ps-users"]), {"xs": ["alice"], "ps-users": ["alice", "bob", "carol"]})
+        self.assertEqual([x[0] for x in backend.queries][1:], ["(&(objectclass=posixGroup)(|(cn=ps-users)))"])
+        # Multi valued cn's; the group may be asked for by any of its names.
+        group_members_cache.clear()
+        backend.entries = [{"cn": ["ps-data", "ps-data-alias"], "memberUid": ["alice", "bob"]}, {"cn": "xs", "memberUid": "alice"}]
+        self.assertEqual(usergroups.get_group_members_bulk(["ps-data-alias", "xs"]), {"ps-data-alias": ["alice", "bob"], "xs": ["alice"]})
+        self.assertEqual(usergroups.get_groups_matching_pattern("*", limit=1, offset=0), ["ps-data"])
+        self.assertEqual(usergroups.get_groups_matching_pattern("*", limit=1, offset=1), ["xs"])
+
+    def test_max_staleness(self):
+        backend = RecordingLDAPBackend([{"cn": "ps-data", "memberUid": ["alice", "bob"]}])
+        usergroups = UserGroups(backend=backend)
+        # A maximum staleness below the cache time; entries older than this are not served even if they are still in the cache.
+        usergroups.max_staleness = usergroups.refresh_after/2
+        user_groups_cache.set(("alice",), (["xs"], time.time() - usergroups.max_staleness - 1))
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["ps-data"])
+        self.assertEqual(len(backend.queries), 1)
+        user_groups_cache.set(("bob",), (["xs"], time.time() - usergroups.max_staleness - 1))
+        self.assertEqual(usergroups.get_user_posix_groups_bulk(["bob"]), {"bob": ["ps-data"]})
+        self.assertEqual(len(backend.queries), 2)
+
+    def test_refresh_ahead_errors(self):
+        backend = BlockingLDAPBackend([])
+        backend.error = "Cannot reach the directory"
+        backend.release.set()
+        usergroups = UserGroups(backend=backend)
+        user_groups_cache.set(("alice",), (["xs"], time.time() - usergroups.refresh_after - 1))
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["xs"])
+        self.wait_for_background_refresh(usergroups)
+        self.assertEqual(len(backend.queries), 1)
+        # We continue to serve the old entry if the refresh fails.
+        self.assertEqual(usergroups.get_user_posix_groups("alice"), ["xs"])
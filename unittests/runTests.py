@@ -6,7 +6,7 @@ import os
 import logging
 
 def suite():
-    suite = unittest.TestLoader().loadTestsFromNames(['unittests.TestFlaskAuthz'])
+    suite = unittest.TestLoader().loadTestsFromNames(['unittests.TestFlaskAuthz', 'unittests.TestUserGroups', 'unittests.TestCacheBackends', 'unittests.TestAsyncAuthnz', 'unittests.TestMetrics', 'unittests.TestAudit', 'unittests.TestSnapshot', 'unittests.TestMongoIndexes'])
     return suite
 
 if __name__ == '__main__':